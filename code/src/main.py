@@ -1,42 +1,260 @@
+import time
+IMPORT_STARTED = time.perf_counter()  # Cold-start profile: how long importing this module takes
 import pandas as pd
+import numpy as np
 import openai
 import os
 import sys
 import webbrowser
 from pathlib import Path
 import logging
-import pyttsx3
-from moviepy.editor import TextClip, CompositeVideoClip, AudioFileClip, VideoFileClip, concatenate_videoclips, CompositeAudioClip
-from moviepy.config import change_settings
+import logging.handlers
+import atexit
+import importlib
+import importlib.util
+import importlib.machinery
 import textwrap
-from pytubefix import YouTube
 from dotenv import load_dotenv
-import openpyxl
 from io import BytesIO
-import msoffcrypto
-import time
-from flask import Flask, request, render_template_string
-from flask_socketio import SocketIO, emit
+import threading
+import weakref
+import hashlib
+import json
+import argparse
+import random
+import shutil
+import uuid
+import sqlite3
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import queue
+import re
+import subprocess
+import wave
+import signal
+from datetime import datetime, timezone
+from flask import Flask, request, render_template_string, jsonify, Response
+from flask_socketio import SocketIO, emit, join_room
+from contextlib import contextmanager
+from collections import deque
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
+# Optional columnar snapshot support
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+class LazyModule:
+    # Stands in for a module until one of its attributes is used. Attribute writes and deletes go to the
+    # real module as well, so monkeypatching and unittest.mock.patch work as with a normal import.
+    def __init__(self, name, group, registry):
+        object.__setattr__(self, '_lazy', (name, group, registry))
+
+    def _load(self):
+        name, group, registry = self._lazy
+        return registry.load(name, group)
+
+    def __getattr__(self, attribute):
+        return getattr(self._load(), attribute)
+
+    def __setattr__(self, attribute, value):
+        setattr(self._load(), attribute, value)
+
+    def __delattr__(self, attribute):
+        delattr(self._load(), attribute)
+
+    def __bool__(self):
+        # Whether the module is installed, without importing it or its parent packages
+        name = self._lazy[0]
+        if name in sys.modules:
+            return sys.modules[name] is not None
+        parts = name.split('.')
+        try:
+            spec = importlib.util.find_spec(parts[0])
+            for i in range(1, len(parts)):
+                if spec is None or spec.submodule_search_locations is None:
+                    return False
+                spec = importlib.machinery.PathFinder.find_spec('.'.join(parts[:i + 1]), spec.submodule_search_locations)
+        except (ImportError, ValueError):
+            return False
+        return spec is not None
+
+    def __repr__(self):
+        return f"<lazy module '{self._lazy[0]}'>"
+
+class LazyImports:
+    # Registry of the modules loaded on first use, by subsystem. Importing a module of a disabled group
+    # raises ImportError, which is how text-only servers stay off the video stack; load_times records
+    # what each first use cost.
+    def __init__(self):
+        self.modules = {}
+        self.load_times = {}
+        self._disabled = set()
+        self._lock = threading.Lock()
+
+    def module(self, name, group):
+        self.modules[name] = LazyModule(name, group, self)
+        return self.modules[name]
+
+    def disable(self, *groups):
+        self._disabled.update(groups)
+
+    def load(self, name, group):
+        if name in self.load_times:
+            return sys.modules[name]
+        if group in self._disabled:
+            raise ImportError(f"{name} belongs to the {group} subsystem, which is disabled in text-only mode.")
+        with self._lock:
+            if name not in self.load_times:
+                start = time.perf_counter()
+                importlib.import_module(name)
+                self.load_times[name] = time.perf_counter() - start
+                logger.info(f"Imported {name} on first use in {self.load_times[name]:.2f} seconds.")
+        return sys.modules[name]
+
+LAZY_IMPORTS = LazyImports()
+mpy = LAZY_IMPORTS.module('moviepy.editor', 'video')
+moviepy_config = LAZY_IMPORTS.module('moviepy.config', 'video')
+Image = LAZY_IMPORTS.module('PIL.Image', 'video')
+ImageDraw = LAZY_IMPORTS.module('PIL.ImageDraw', 'video')
+ImageFont = LAZY_IMPORTS.module('PIL.ImageFont', 'video')
+pyttsx3 = LAZY_IMPORTS.module('pyttsx3', 'tts')
+pytubefix = LAZY_IMPORTS.module('pytubefix', 'download')
+openpyxl = LAZY_IMPORTS.module('openpyxl', 'data')
+msoffcrypto = LAZY_IMPORTS.module('msoffcrypto', 'data')
 
 # Initialize Flask app and SocketIO
 app = Flask(__name__)
 socketio = SocketIO(app)
 
-# Logging setup
+# Load environment variables
+load_dotenv()
+
+# Logging setup: records are stamped, capped and queued on the calling thread; a listener thread writes
+# them to the console and forwards them to Socket.IO, so request latency never waits on log I/O
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))  # Records beyond this are dropped and counted instead of blocking
+LOG_MAX_MESSAGE_CHARS = int(os.getenv('LOG_MAX_MESSAGE_CHARS', '2000'))  # Longer messages are truncated before queueing
+LOG_DEBUG_SAMPLE_EVERY = int(os.getenv('LOG_DEBUG_SAMPLE_EVERY', '100'))  # Keep 1 in N DEBUG records per call site
+LOG_SAMPLE_ROWS = int(os.getenv('LOG_SAMPLE_ROWS', '3'))  # Rows or IDs shown in DEBUG payloads
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', handlers=[logging.StreamHandler()])
 logger = logging.getLogger(__name__)
 
+# Socket.IO room (job id or client session id) that events produced on this thread belong to
+_event_context = threading.local()
+
+@contextmanager
+def event_room(room):
+    previous = getattr(_event_context, 'room', None)
+    _event_context.room = room
+    try:
+        yield
+    finally:
+        _event_context.room = previous
+
+def emit_event(event, data):
+    # Events only go to the room of the job/session being served; CLI and batch runs have no audience
+    room = getattr(_event_context, 'room', None)
+    if room is not None:
+        socketio.emit(event, data, to=room)
+
 class SocketIOHandler(logging.Handler):
+    # Forwards INFO and ERROR+ records to the room that produced them. Messages are buffered per room
+    # and sent as one 'log' event per flush interval; a flooding room keeps only its latest messages.
+    def __init__(self, flush_interval, buffer_size):
+        super().__init__()
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self._buffers = {}  # room -> [deque of messages, dropped count]
+        self._buffer_lock = threading.Lock()
+        self._flusher = None
+
     def emit(self, record):
-        if record.levelno == logging.INFO or record.levelno >= logging.ERROR:
-            log_message = self.format(record).split(' - ')[-1]
-            socketio.emit('log', {'message': log_message})
+        # Behind the log queue this runs on the listener thread, so the room comes from the record
+        room = getattr(record, 'room', None) or getattr(_event_context, 'room', None)
+        if room is None or not (record.levelno == logging.INFO or record.levelno >= logging.ERROR):
+            return
+        log_message = record.getMessage()
+        with self._buffer_lock:
+            buffer = self._buffers.setdefault(room, [deque(maxlen=self.buffer_size), 0])
+            if len(buffer[0]) == self.buffer_size:
+                buffer[1] += 1
+            buffer[0].append(log_message)
+            if self._flusher is None:
+                self._flusher = socketio.start_background_task(self._flush_loop)
 
-socketio_handler = SocketIOHandler()
-logger.addHandler(socketio_handler)
+    def _flush_loop(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        with self._buffer_lock:
+            buffers, self._buffers = self._buffers, {}
+        for room, (messages, dropped) in buffers.items():
+            socketio.emit('log', {'message': messages[-1], 'messages': list(messages), 'dropped': dropped}, to=room)
+
+class LogRecordFilter(logging.Filter):
+    # Runs on the logging thread before a record is queued: stamps the Socket.IO room, keeps one in
+    # sample_every DEBUG records per call site and truncates messages longer than max_chars.
+    def __init__(self, max_chars, sample_every):
+        super().__init__()
+        self.max_chars = max_chars
+        self.sample_every = max(1, sample_every)
+        self._debug_counts = {}  # (path, line) -> DEBUG records seen
+        self.sampled_out = 0
+        self.truncated = 0
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG:
+            site = (record.pathname, record.lineno)
+            seen = self._debug_counts.get(site, 0)
+            self._debug_counts[site] = seen + 1
+            if seen % self.sample_every:
+                self.sampled_out += 1
+                return False
+        record.room = getattr(_event_context, 'room', None)
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = f"{message[:self.max_chars]}... [{len(message) - self.max_chars} characters truncated]"
+            record.args = None
+            self.truncated += 1
+        return True
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    # Never blocks the caller: when the listener falls behind, records are dropped and counted
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'dropped': self.dropped, 'truncated': self.filters[0].truncated, 'sampled_out': self.filters[0].sampled_out}
+
+socketio_handler = SocketIOHandler(float(os.getenv('LOG_FLUSH_INTERVAL', '0.25')), int(os.getenv('LOG_BUFFER_SIZE', '50')))
+log_handler = LogQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+log_handler.addFilter(LogRecordFilter(LOG_MAX_MESSAGE_CHARS, LOG_DEBUG_SAMPLE_EVERY))
+log_listener = logging.handlers.QueueListener(log_handler.queue, *logging.getLogger().handlers, socketio_handler, respect_handler_level=True)
+logger.addHandler(log_handler)
+logger.propagate = False  # The listener already writes to the console handlers
+log_listener.start()
+atexit.register(log_listener.stop)  # Drain queued records on exit
 
-# Load environment variables
-load_dotenv()
 openai_key = os.getenv('OPENAI_API_KEY')
 excel_password = os.getenv('EXCEL_PASSWORD')
 logger.info(f"Current working directory: {os.getcwd()}")
@@ -46,13 +264,10 @@ logger.info(f"Loaded EXCEL_PASSWORD: {'Set' if excel_password else 'Not Set'}")
 # Securely load API keys and password
 openai.api_key = os.getenv('OPENAI_API_KEY', openai_key)
 EXCEL_PASSWORD = os.getenv('EXCEL_PASSWORD', excel_password)
+openai.api_base = os.getenv('OPENAI_API_BASE', openai.api_base)  # Point at a local stub for offline runs
 logger.info(f"Final openai.api_key: {'Set' if openai.api_key else 'Not Set'}")
 logger.info(f"Final EXCEL_PASSWORD: {'Set' if EXCEL_PASSWORD else 'Not Set'}")
 
-# Set ImageMagick path
-IMAGEMAGICK_BINARY_PATH = r"C:\Program Files\ImageMagick-7.1.1-Q16-HDRI\magick.exe"
-change_settings({"IMAGEMAGICK_BINARY": IMAGEMAGICK_BINARY_PATH})
-
 # Define base directory (assuming script is in code\src)
 BASE_DIR = Path(__file__).resolve().parent.parent  # Moves up from code\src to code
 
@@ -61,15 +276,93 @@ INPUT_FILE_TRANSACTIONS = BASE_DIR / 'data' / 'customer_transactions.xlsx'
 INPUT_FILE_PROFILE = BASE_DIR / 'data' / 'customer_profile.xlsx'
 INPUT_FILE_TWITTER = BASE_DIR / 'data' / 'twitter_data.xlsx'
 OUTPUT_FILE = BASE_DIR / 'artifacts' / 'output' / 'recommendations.txt'
-VIDEO_OUTPUT_FILE = BASE_DIR / 'artifacts' / 'output' / 'recommendations_video.mp4'
-TEMP_AUDIO_FILE = BASE_DIR / 'artifacts' / 'temp' / 'temp_audio.mp3'
-TEMP_VIDEO_FILE = BASE_DIR / 'artifacts' / 'temp' / 'temp_background_video.mp4'
+BATCH_OUTPUT_FILE = BASE_DIR / 'artifacts' / 'output' / 'batch_recommendations.jsonl'
+VIDEO_OUTPUT_DIR = BASE_DIR / 'artifacts' / 'output' / 'videos'  # One <job_id>.mp4 per render
+VIDEO_OUTPUT_MAX_FILES = int(os.getenv('VIDEO_OUTPUT_MAX_FILES', '500'))  # Interactive videos kept; older ones are pruned, 0 = no limit
+VIDEO_OUTPUT_MAX_AGE = float(os.getenv('VIDEO_OUTPUT_MAX_AGE', str(7 * 24 * 3600)))  # Seconds an interactive video is kept, 0 = no limit
+TEMP_DIR = BASE_DIR / 'artifacts' / 'temp'  # One workspace directory per render
 YOUTUBE_URL = "https://www.youtube.com/watch?v=PuR_hbA38oI"
-BACKGROUND_MUSIC_FILE = BASE_DIR / 'data' / 'background_music.mp3'
+BACKGROUND_VIDEO_FILE = os.getenv('BACKGROUND_VIDEO_FILE')  # Local background clip for offline use instead of YOUTUBE_URL
+BACKGROUND_CACHE_DIR = BASE_DIR / 'artifacts' / 'cache' / 'backgrounds'
+MIN_VIDEO_FILE_BYTES = int(os.getenv('MIN_VIDEO_FILE_BYTES', '1024'))  # Smaller downloads or cached clips are treated as incomplete
+VIDEO_SIZE = (1280, 720)
+VIDEO_FPS = 24
+BACKGROUND_MUSIC_FILE = Path(os.getenv('BACKGROUND_MUSIC_FILE', str(BASE_DIR / 'data' / 'background_music.mp3')))
+BACKGROUND_MUSIC_GAIN = float(os.getenv('BACKGROUND_MUSIC_GAIN', '0.15'))  # Music level under the narration
+MUSIC_CACHE_DIR = BASE_DIR / 'artifacts' / 'cache' / 'music'  # Decoded, ducked music beds
+RENDER_BACKEND = os.getenv('RENDER_BACKEND', 'moviepy').lower()  # moviepy | ffmpeg
+TEXT_ONLY = os.getenv('TEXT_ONLY', 'false').lower() == 'true'  # Recommendations only; the video, TTS and download stacks are never imported
+VIDEO_SUBSYSTEMS = ('video', 'tts', 'download')
+if TEXT_ONLY:
+    LAZY_IMPORTS.disable(*VIDEO_SUBSYSTEMS)
+FFMPEG_BINARY = os.getenv('FFMPEG_BINARY')  # Defaults to the ffmpeg MoviePy uses, resolved on first render
+TTS_CACHE_DIR = BASE_DIR / 'artifacts' / 'cache' / 'tts'
+TTS_RATE = int(os.getenv('TTS_RATE', '140'))
+TTS_VOICE = os.getenv('TTS_VOICE')  # pyttsx3 voice id; engine default when unset
+TTS_SEGMENT_PAUSE = float(os.getenv('TTS_SEGMENT_PAUSE', '0.35'))  # Silence between narrated lines
+TTS_CACHE_MAX_ENTRIES = int(os.getenv('TTS_CACHE_MAX_ENTRIES', '5000'))
+CAPTION_CACHE_SIZE = int(os.getenv('CAPTION_CACHE_SIZE', '512'))  # Rasterized caption sprites kept per process
+SNAPSHOT_CACHE_DIR = BASE_DIR / 'artifacts' / 'cache' / 'snapshots'
+
+# OpenAI request pool settings
+OPENAI_MODEL = "gpt-4o-mini"
+RECOMMENDATION_MAX_TOKENS = 250
+RECOMMENDATION_TEMPERATURE = 0.7
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '300'))  # Per user prompt; 0 disables the budget
+PROMPT_FIELDS = [field.strip() for field in os.getenv('PROMPT_FIELDS', 'age,income,profession,occupation,spend by category,transaction count,*').split(',') if field.strip()]  # Whitelist in priority order; '*' = all other fields
+PROMPT_TWEET_MAX_TOKENS = int(os.getenv('PROMPT_TWEET_MAX_TOKENS', '48'))
+TIKTOKEN_LOAD_TIMEOUT = float(os.getenv('TIKTOKEN_LOAD_TIMEOUT', '10'))  # Seconds to wait for the BPE ranks before estimating tokens from length
+STREAM_RECOMMENDATIONS = os.getenv('STREAM_RECOMMENDATIONS', 'true').lower() == 'true'
+STREAM_FLUSH_INTERVAL = float(os.getenv('STREAM_FLUSH_INTERVAL', '0.05'))  # Seconds between token events
+LLM_MAX_CONCURRENCY = int(os.getenv('LLM_MAX_CONCURRENCY', '4'))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('LLM_REQUESTS_PER_MINUTE', '500'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('LLM_TOKENS_PER_MINUTE', '200000'))
+LLM_REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', '30'))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', '5'))
+
+# Recommendation response cache; set LLM_CACHE_DB to a file path to add the SQLite tier
+LLM_CACHE_ENABLED = os.getenv('LLM_CACHE_ENABLED', 'true').lower() == 'true'
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '1024'))
+LLM_CACHE_TTL = float(os.getenv('LLM_CACHE_TTL', '86400'))
+LLM_CACHE_DB = os.getenv('LLM_CACHE_DB')
+
+# Job workers: recommendations and renders each run on their own pool
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+VIDEO_WORKERS = int(os.getenv('VIDEO_WORKERS', '2'))
+JOB_HISTORY = int(os.getenv('JOB_HISTORY', '500'))
+
+# Render farm: encodes run in worker processes; 0 processes renders on the calling thread
+RENDER_PROCESSES = int(os.getenv('RENDER_PROCESSES', str(max(1, (os.cpu_count() or 2) // 2))))
+RENDER_QUEUE_SIZE = int(os.getenv('RENDER_QUEUE_SIZE', str(max(1, RENDER_PROCESSES) * 4)))
+RENDER_TIMEOUT = float(os.getenv('RENDER_TIMEOUT', '900'))
+RENDER_RETRIES = int(os.getenv('RENDER_RETRIES', '1'))
+RENDER_REPORT_WINDOW = float(os.getenv('RENDER_REPORT_WINDOW', '300'))  # Seconds of recent renders behind the throughput and utilization figures
+
+# Stage tracing
+TRACE_WINDOW = int(os.getenv('TRACE_WINDOW', '2048'))  # Recent samples per stage behind the /metrics quantiles
+TRACE_DUMP_DIR = os.getenv('TRACE_DUMP_DIR')  # When set, each request's spans are appended to <dir>/<job id>.folded
+
+# Health: prerequisites are validated once and revalidated in the background
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '300'))  # Seconds between full revalidations
+HEALTH_WATCH_INTERVAL = float(os.getenv('HEALTH_WATCH_INTERVAL', '5'))  # Seconds between polls of the watched files; 0 disables the monitor thread
+
+# Encrypted Parquet snapshots of the decrypted workbooks (requires pyarrow)
+SNAPSHOT_CACHE_ENABLED = os.getenv('SNAPSHOT_CACHE_ENABLED', 'true').lower() == 'true'
+# Columns each source contributes to aggregate_customer_features and the prompt. With '*' in PROMPT_FIELDS
+# any customer detail can reach the prompt, so every column is kept (None); an explicit PROMPT_FIELDS list
+# narrows both the snapshot read and the Excel path to these columns.
+SOURCE_BASE_COLUMNS = ['first name', 'consent_social_media'] + [field for field in PROMPT_FIELDS if field != '*']
+SNAPSHOT_COLUMNS = {} if '*' in PROMPT_FIELDS else {
+    'transactions': ['consent', 'category', 'transaction amount'] + SOURCE_BASE_COLUMNS,
+    'profile': SOURCE_BASE_COLUMNS,
+    'twitter': ['sentiment', 'tweet'] + SOURCE_BASE_COLUMNS,
+}
 
 # Ensure output and temp directories exist
 os.makedirs(OUTPUT_FILE.parent, exist_ok=True)
-os.makedirs(TEMP_AUDIO_FILE.parent, exist_ok=True)
+os.makedirs(VIDEO_OUTPUT_DIR, exist_ok=True)
+os.makedirs(TEMP_DIR, exist_ok=True)
+os.makedirs(SNAPSHOT_CACHE_DIR, exist_ok=True)
 
 # Default system prompt (moved to global scope for consistency)
 DEFAULT_SYSTEM_PROMPT = """You are a Wells Fargo bank financial advisor for the customers. Design the top three dynamic banking products and services recommendations specific to "check_box_selection" category based on customer demographic data, transaction categories, profile, income, expenditure, loan values, profession, and other provided values, along with Twitter sentiment from the provided data. Generate the recommendation as if you are speaking directly to the customer in a powerful, engaging speech to make them interested in buying the products. Follow this exact format:
@@ -268,32 +561,52 @@ HTML_TEMPLATE = """
     <script>
         document.addEventListener('DOMContentLoaded', () => {
             const socket = io.connect('http://' + document.domain + ':' + location.port);
-            socket.on('log', (data) => { document.getElementById('log-output').innerText = data.message; });
+            socket.on('log', (data) => { document.getElementById('log-output').innerText = data.messages[data.messages.length - 1]; });
             socket.on('recommendation', (data) => {
                 const resultDiv = document.getElementById('result');
                 if (!resultDiv.innerHTML) { resultDiv.innerHTML = '<h2>Recommendations:</h2>'; }
                 resultDiv.innerHTML += '<p>' + data.content + '</p>';
             });
-            socket.on('recommendations_complete', (data) => {
+            socket.on('recommendation_token', (data) => {
+                let liveText = document.getElementById('live-recommendation');
+                if (!liveText) {
+                    document.getElementById('result').innerHTML = '<h2>Recommendations:</h2><p id="live-recommendation"></p>';
+                    liveText = document.getElementById('live-recommendation');
+                }
+                liveText.textContent += data.delta;
+            });
+            function showRecommendations(content) {
                 document.getElementById('recommendation-spinner').classList.add('hidden');
                 document.getElementById('recommendation-text').classList.add('hidden');
                 document.getElementById('video-spinner').classList.remove('hidden');
                 document.getElementById('video-text').classList.remove('hidden');
-                const recommendations = data.content.split('\\n\\n');
+                const recommendations = content.split('\\n\\n');
                 let formattedContent = '<h2>Recommendations:</h2>';
                 recommendations.forEach(rec => {
                     if (rec.trim()) { formattedContent += '<p>' + rec.trim() + '</p>'; }
                 });
                 document.getElementById('result').innerHTML = formattedContent;
-            });
-            socket.on('video_link', (data) => {
+            }
+            function showVideoLink(link) {
+                document.getElementById('recommendation-spinner').classList.add('hidden');
+                document.getElementById('recommendation-text').classList.add('hidden');
                 document.getElementById('video-spinner').classList.add('hidden');
                 document.getElementById('video-text').classList.add('hidden');
-                if (data.link) {
-                    document.getElementById('video-link').innerHTML = '<h2>Video Recommendation:</h2><a href="' + data.link + '" target="_blank">Watch the Recommendation Video</a>';
+                if (link) {
+                    document.getElementById('video-link').innerHTML = '<h2>Video Recommendation:</h2><a href="' + link + '" target="_blank">Watch the Recommendation Video</a>';
                 } else {
                     document.getElementById('video-link').innerHTML = 'No video generated.';
                 }
+            }
+            socket.on('recommendations_complete', (data) => { showRecommendations(data.content); });
+            socket.on('video_link', (data) => { showVideoLink(data.link); });
+            // Snapshot sent on joining a job room, and on every job state change
+            socket.on('job_status', (job) => {
+                if (job.recommendation && job.status === 'rendering_video') { showRecommendations(job.recommendation); }
+                if (job.status === 'completed' || job.status === 'failed') {
+                    if (job.recommendation) { showRecommendations(job.recommendation); }
+                    showVideoLink(job.video_link);
+                }
             });
             function clearAndGenerate() {
                 document.getElementById('result').innerHTML = '';
@@ -303,10 +616,16 @@ HTML_TEMPLATE = """
                 document.getElementById('recommendation-text').classList.remove('hidden');
                 document.getElementById('video-spinner').classList.add('hidden');
                 document.getElementById('video-text').classList.add('hidden');
+                const formData = new FormData(document.getElementById('recommendation-form'));
+                if (socket.id) {
+                    formData.append('sid', socket.id);
+                }
                 fetch('/', {
                     method: 'POST',
-                    body: new FormData(document.getElementById('recommendation-form')),
+                    body: formData,
                     headers: { 'Accept': 'application/json' }
+                }).then(response => response.json()).then(job => {
+                    socket.emit('join_job', { job_id: job.job_id });
                 }).catch(error => {
                     console.error('Error:', error);
                     document.getElementById('recommendation-spinner').classList.add('hidden');
@@ -361,6 +680,10 @@ HTML_TEMPLATE = """
                     <input type="checkbox" id="commercialBanking" name="categories" value="Commercial Banking">
                     <label for="commercialBanking">Commercial Banking</label>
                 </div>
+                <div class="checkbox-item">
+                    <input type="checkbox" id="bypassCache" name="bypass_cache">
+                    <label for="bypassCache">Regenerate (ignore cached recommendation)</label>
+                </div>
             </div>
             <div class="button-section">
                 <button type="submit">Generate</button>
@@ -396,79 +719,594 @@ HTML_TEMPLATE = """
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
-        user_prompt = request.form.get('prompt', DEFAULT_SYSTEM_PROMPT)
-        customer_id = request.form.get('customer_id').strip()
-        selected_categories = request.form.getlist('categories')
-        
-        if not selected_categories:
-            logger.info("No categories selected, defaulting to 'Consumer and Small Business Banking'")
-            categories_str = "Consumer and Small Business Banking"
-            socketio.emit('log', {'message': "No categories selected, proceeding with default 'Consumer and Small Business Banking'"})
-        else:
-            categories_str = ", ".join(selected_categories)
-        
-        system_prompt = user_prompt.replace("check_box_selection", categories_str)
-        logger.info(f"System prompt used: {system_prompt}")
-        logger.info(f"Generating for Customer ID: {customer_id}")
-        
-        # Generate recommendations and video sequentially
-        recommendations = generate_recommendations(system_prompt, customer_id)
-        if recommendations and "Error" not in recommendations[0]:
-            generate_video_with_moviepy(recommendations[0])
-        return render_template_string(HTML_TEMPLATE, prompt=system_prompt, result=None, video_link=None)
+        # Each Socket.IO client sits in a room named after its session id; the page posts it as 'sid'
+        session_id = request.form.get('sid') or None
+        if session_id and not socketio.server.manager.is_connected(session_id, '/'):
+            session_id = None  # Posted before the socket connected, or the client has gone
+        with event_room(session_id):
+            user_prompt = request.form.get('prompt', DEFAULT_SYSTEM_PROMPT)
+            customer_id = request.form.get('customer_id').strip()
+            selected_categories = request.form.getlist('categories')
+            
+            if not selected_categories:
+                logger.info("No categories selected, defaulting to 'Consumer and Small Business Banking'")
+                categories_str = "Consumer and Small Business Banking"
+            else:
+                categories_str = ", ".join(selected_categories)
+            
+            bypass_cache = request.form.get('bypass_cache') == 'on'
+            system_prompt = user_prompt.replace("check_box_selection", categories_str)
+            logger.debug(f"System prompt used: {system_prompt}")
+            logger.info(f"Generating for Customer ID: {customer_id}")
+            
+            # Recommendation and video run on the job workers; progress goes to the job's Socket.IO room
+            job = JOB_MANAGER.submit(system_prompt, customer_id, bypass_cache=bypass_cache, session_id=session_id)
+        return jsonify(job.to_dict()), 202
     
     return render_template_string(HTML_TEMPLATE, prompt=DEFAULT_SYSTEM_PROMPT, result=None, video_link=None)
 
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    job = JOB_MANAGER.get(job_id)
+    if job is None:
+        return jsonify({'error': f"Unknown job {job_id}"}), 404
+    return jsonify(job.to_dict())
+
+@socketio.on('join_job')
+def join_job(data):
+    job = JOB_MANAGER.get((data or {}).get('job_id'))
+    if job is None:
+        emit('job_status', {'status': 'unknown', 'error': "Unknown job"})
+        return
+    join_room(job.job_id)
+    emit('job_status', job.to_dict())  # Catch up on anything emitted before the join
+
+@app.route('/cache/stats')
+def cache_stats():
+    return jsonify({**LLM_CACHE.stats(), 'prompt': PROMPT_BUDGET.stats()})
+
+@app.route('/healthz')
+def healthz():
+    # Liveness: the process is up and answering
+    return jsonify({'status': 'ok', 'uptime_seconds': round(time.time() - HEALTH.started_at, 1)})
+
+@app.route('/readyz')
+def readyz():
+    # Readiness from the cached validation: 503 until text recommendations can be served
+    report = HEALTH.report()
+    return jsonify(report), 200 if report['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format: stage latency summaries plus the cache, prompt and render counters
+    lines = TRACER.prometheus()
+    for prefix, stats in [('llm_cache', LLM_CACHE.stats()), ('prompt', PROMPT_BUDGET.stats()), ('render', RENDER_FARM.report())]:
+        lines += prometheus_gauges(prefix, stats)
+    lines += prometheus_gauges('startup', {'import_seconds': round(IMPORT_SECONDS, 3)})
+    lines += prometheus_gauges('log', log_handler.stats())
+    lines += prometheus_gauges('capability', {capability: int(HEALTH.has(capability)) for capability in HEALTH.CAPABILITIES})
+    lines.append("# TYPE aidhp_lazy_import_seconds gauge")
+    lines += [f'aidhp_lazy_import_seconds{{module="{name}"}} {seconds:.3f}' for name, seconds in sorted(LAZY_IMPORTS.load_times.items())]
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
 # Serve static files (adjusted to artifacts/output for video serving)
 app.static_folder = str(BASE_DIR / 'artifacts' / 'output')  # Convert Path to string
 app.static_url_path = '/static'
 
-def check_prerequisites():
-    logger.info("Checking prerequisites...")
-    for module, name in [(openai, "OpenAI"), (pyttsx3, "pyttsx3"), (TextClip, "MoviePy"), (YouTube, "pytubefix"), (openpyxl, "openpyxl"), (msoffcrypto, "msoffcrypto")]:
-        if not module:
-            logger.error(f"{name} library is not installed.")
-            raise ImportError(f"{name} library is not installed.")
-    if not openai.api_key or not EXCEL_PASSWORD:
-        logger.error("API key or Excel password are not set.")
-        raise ValueError("API key or Excel password are not set.")
-    if not os.path.exists(IMAGEMAGICK_BINARY_PATH):
-        logger.error(f"ImageMagick binary not found at {IMAGEMAGICK_BINARY_PATH}.")
-        raise FileNotFoundError("ImageMagick binary not found.")
-    if not os.path.exists(str(BACKGROUND_MUSIC_FILE)):  # Convert Path to string
-        logger.error(f"Background music file not found at {BACKGROUND_MUSIC_FILE}.")
-        raise FileNotFoundError("Background music file not found.")
-    logger.info("All prerequisites are met.")
+class Tracer:
+    # Times nested pipeline stages. Every span feeds its stage's sample window (p50/p95/p99 on /metrics).
+    # Spans under a root opened with a trace_id are also collected per request and, with a dump directory,
+    # written as collapsed stacks ("root;stage;substage <self microseconds>" per line) for flamegraph.pl
+    # or speedscope. Stages timed in another process are attached with add().
+    QUANTILES = (0.5, 0.95, 0.99)
 
-def load_data(transactions_file_path, profile_file_path, twitter_file_path, customer_id):
-    transactions_file_path = str(transactions_file_path)  # Convert Path to string
-    profile_file_path = str(profile_file_path)  # Convert Path to string
-    twitter_file_path = str(twitter_file_path)  # Convert Path to string
+    def __init__(self, window, dump_dir=None):
+        self.window = window
+        self.dump_dir = Path(dump_dir) if dump_dir else None
+        self._samples = {}  # stage -> deque of recent durations
+        self._totals = {}  # stage -> [count, sum]
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def current(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    @contextmanager
+    def span(self, stage, trace_id=None):
+        stack = self._local.__dict__.setdefault('stack', [])
+        parent = stack[-1] if stack and trace_id is None else None
+        frame = {
+            'path': f"{parent['path']};{stage}" if parent else stage,
+            'stacks': [] if trace_id else parent['stacks'] if parent else None,  # None outside a request trace
+            'children': 0.0,
+        }
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield frame
+        finally:
+            stack.pop()
+            self._close(stage, frame, time.perf_counter() - start, parent)
+            if trace_id:
+                self.dump(trace_id, frame['stacks'])
+
+    def add(self, stage, seconds, parent=None):
+        frame = {'path': f"{parent['path']};{stage}" if parent else stage, 'stacks': parent['stacks'] if parent else None, 'children': 0.0}
+        self._close(stage, frame, seconds, parent)
+
+    def add_timings(self, timings, parent=None):
+        # Per-stage timings returned by render_worker; 'total' is the enclosing span itself
+        for stage, seconds in timings.items():
+            if stage != 'total':
+                self.add(stage, seconds, parent)
+
+    def _close(self, stage, frame, seconds, parent):
+        with self._lock:
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+            totals = self._totals.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+            if parent is not None:
+                parent['children'] += seconds
+            if frame['stacks'] is not None:
+                frame['stacks'].append((frame['path'], max(seconds - frame['children'], 0.0)))
+
+    def dump(self, trace_id, stacks):
+        if self.dump_dir is None or not stacks:
+            return
+        folded = {}
+        for path, seconds in stacks:
+            folded[path] = folded.get(path, 0.0) + seconds
+        trace_file = self.dump_dir / f"{trace_id}.folded"
+        try:
+            os.makedirs(self.dump_dir, exist_ok=True)
+            with open(str(trace_file), 'a') as f:  # Convert Path to string
+                f.writelines(f"{path} {round(seconds * 1e6)}\n" for path, seconds in folded.items())
+        except OSError as e:
+            logger.warning(f"Could not write trace {trace_file}: {e}")
+
+    def snapshot(self):
+        with self._lock:
+            samples = {stage: sorted(window) for stage, window in self._samples.items()}
+            totals = {stage: list(total) for stage, total in self._totals.items()}
+        return {
+            stage: {
+                'count': totals[stage][0],
+                'sum': round(totals[stage][1], 6),
+                **{f"p{round(q * 100)}": round(values[min(len(values) - 1, int(len(values) * q))], 6) for q in self.QUANTILES},
+            }
+            for stage, values in samples.items()
+        }
+
+    def prometheus(self):
+        lines = [
+            "# HELP aidhp_stage_seconds Pipeline stage durations; quantiles over the most recent samples.",
+            "# TYPE aidhp_stage_seconds summary",
+        ]
+        for stage, summary in sorted(self.snapshot().items()):
+            for q in self.QUANTILES:
+                lines.append(f'aidhp_stage_seconds{{stage="{stage}",quantile="{q}"}} {summary[f"p{round(q * 100)}"]}')
+            lines.append(f'aidhp_stage_seconds_sum{{stage="{stage}"}} {summary["sum"]}')
+            lines.append(f'aidhp_stage_seconds_count{{stage="{stage}"}} {summary["count"]}')
+        return lines
+
+TRACER = Tracer(TRACE_WINDOW, TRACE_DUMP_DIR)
+
+def prometheus_gauges(prefix, stats):
+    # Top-level numeric entries of a stats dict as aidhp_<prefix>_<key> gauges
+    lines = []
+    for key, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            name = f"aidhp_{prefix}_{re.sub(r'[^a-zA-Z0-9_]', '_', key)}"
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+    return lines
+
+class HealthMonitor:
+    # Validates the prerequisites once and caches what this process can serve: 'text' (OpenAI, workbook
+    # libraries, credentials) and 'video' (media libraries and background music, unless
+    # TEXT_ONLY). A monitor thread revalidates every check_interval seconds, or as soon as a watched file
+    # changes; require() on the request path only reads the cached result.
+    CAPABILITIES = ('text', 'video')
+
+    def __init__(self, check_interval, watch_interval):
+        self.check_interval = check_interval
+        self.watch_interval = watch_interval
+        self.capabilities = frozenset()
+        self.problems = {}  # capability -> exception describing why it is unavailable
+        self.checked_at = None
+        self.started_at = time.time()
+        self._signatures = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._monitor = None
+
+    @staticmethod
+    def watched_files():
+        return [BACKGROUND_MUSIC_FILE]
+
+    @staticmethod
+    def _signature(file_path):
+        try:
+            stat = os.stat(str(file_path))  # Convert Path to string
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _check(self):
+        # Lazy modules are only checked for being installed here, not imported
+        problems = {}
+        for module, name in [(openai, "OpenAI"), (openpyxl, "openpyxl"), (msoffcrypto, "msoffcrypto")]:
+            if not module:
+                problems.setdefault('text', ImportError(f"{name} library is not installed."))
+        if not openai.api_key or not EXCEL_PASSWORD:
+            problems.setdefault('text', ValueError("API key or Excel password are not set."))
+        
+        if TEXT_ONLY:
+            problems['video'] = RuntimeError("Video is disabled in text-only mode.")
+            return problems  # The video stack need not be installed
+        for module, name in [(pyttsx3, "pyttsx3"), (mpy, "MoviePy"), (Image, "Pillow"), (pytubefix, "pytubefix")]:
+            if not module:
+                problems.setdefault('video', ImportError(f"{name} library is not installed."))
+        if not os.path.exists(str(BACKGROUND_MUSIC_FILE)):  # Convert Path to string
+            problems.setdefault('video', FileNotFoundError(f"Background music file not found at {BACKGROUND_MUSIC_FILE}."))
+        return problems
+
+    def validate(self):
+        signatures = {str(file_path): self._signature(file_path) for file_path in self.watched_files()}
+        problems = self._check()
+        with self._lock:
+            previous = self.capabilities if self.checked_at is not None else None
+            self.capabilities = frozenset(capability for capability in self.CAPABILITIES if capability not in problems)
+            self.problems = problems
+            self.checked_at = time.time()
+            self._signatures = signatures
+        if self.capabilities != previous:
+            logger.info(f"Prerequisites validated, serving in {self.mode()} mode.")
+            for capability, problem in problems.items():
+                logger.warning(f"{capability.capitalize()} unavailable: {problem}")
+        return self.capabilities
+
+    def mode(self):
+        if 'text' not in self.capabilities:
+            return 'unavailable'
+        return 'full' if 'video' in self.capabilities else 'text-only'
+
+    def has(self, capability):
+        if self.checked_at is None:
+            self.validate()
+        return capability in self.capabilities
+
+    def require(self, capability):
+        if self.has(capability):
+            return
+        problem = self.problems.get(capability) or RuntimeError(f"{capability} is unavailable.")
+        logger.error(str(problem))
+        raise type(problem)(str(problem))
+
+    def start(self):
+        self.validate()
+        if self._monitor is None and self.watch_interval > 0:
+            self._monitor = threading.Thread(target=self._watch, name='health-monitor', daemon=True)
+            self._monitor.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _watch(self):
+        while not self._stop.wait(self.watch_interval):
+            changed = [str(file_path) for file_path in self.watched_files() if self._signature(file_path) != self._signatures.get(str(file_path))]
+            if not changed and time.time() - self.checked_at < self.check_interval:
+                continue
+            if changed:
+                logger.info(f"Revalidating prerequisites after changes to {', '.join(changed)}")
+            try:
+                self.validate()
+            except Exception as e:
+                logger.error(f"Prerequisite validation failed: {e}")
+
+    def report(self):
+        if self.checked_at is None:
+            self.validate()  # A probe may arrive before anything else needed the result
+        with self._lock:
+            capabilities, problems, checked_at = self.capabilities, self.problems, self.checked_at
+        return {
+            'ready': 'text' in capabilities,
+            'mode': self.mode(),
+            'capabilities': sorted(capabilities),
+            'problems': {capability: str(problem) for capability, problem in problems.items()},
+            'checked_at': checked_at,
+        }
+
+HEALTH = HealthMonitor(HEALTH_CHECK_INTERVAL, HEALTH_WATCH_INTERVAL)
+
+def decrypt_workbook(file_path):
+    with open(file_path, 'rb') as f:
+        encrypted_file = msoffcrypto.OfficeFile(f)
+        encrypted_file.load_key(password=EXCEL_PASSWORD)
+        decrypted_stream = BytesIO()
+        encrypted_file.decrypt(decrypted_stream)
+        decrypted_stream.seek(0)
+    return decrypted_stream
+
+class SnapshotCache:
+    # Encrypted-at-rest Parquet snapshots of decrypted workbooks, keyed by the SHA-256 of the source file.
+    # Layout: magic | salt | nonce | AES-GCM(parquet bytes), with the source hash as associated data.
+    MAGIC = b'HPSNAP1'
+    SALT_SIZE = 16
+    NONCE_SIZE = 12
+    KDF_ITERATIONS = 200_000
+
+    def __init__(self, cache_dir):
+        self.cache_dir = Path(cache_dir)
+        self._keys = {}  # salt -> derived key
+
+    @property
+    def enabled(self):
+        return SNAPSHOT_CACHE_ENABLED and pq is not None and bool(EXCEL_PASSWORD)
+
+    @staticmethod
+    def file_hash(file_path):
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _key(self, salt):
+        if salt not in self._keys:
+            kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=salt, iterations=self.KDF_ITERATIONS)
+            self._keys[salt] = kdf.derive(EXCEL_PASSWORD.encode('utf-8'))
+        return self._keys[salt]
+
+    def _path(self, label, source_hash):
+        return self.cache_dir / f"{label}-{source_hash}.parquet.enc"
+
+    def read(self, label, source_hash, columns=None):
+        snapshot_path = self._path(label, source_hash)
+        if not snapshot_path.is_file():
+            return None
+        try:
+            with pa.memory_map(str(snapshot_path), 'r') as source:  # Convert Path to string
+                payload = memoryview(source.read_buffer()).cast('B')
+                header = len(self.MAGIC)
+                if bytes(payload[:header]) != self.MAGIC:
+                    raise ValueError("unrecognized snapshot header")
+                salt = bytes(payload[header:header + self.SALT_SIZE])
+                nonce = bytes(payload[header + self.SALT_SIZE:header + self.SALT_SIZE + self.NONCE_SIZE])
+                ciphertext = payload[header + self.SALT_SIZE + self.NONCE_SIZE:]
+                parquet_bytes = AESGCM(self._key(salt)).decrypt(nonce, ciphertext, source_hash.encode('ascii'))
+            parquet = pq.ParquetFile(pa.BufferReader(parquet_bytes))
+            if columns is not None:
+                # Snapshots hold every column; ones a source does not have are simply not read
+                available = set(parquet.schema_arrow.names)
+                columns = [column for column in dict.fromkeys(['customer id'] + list(columns)) if column in available]
+            frame = parquet.read(columns=columns).to_pandas()
+            logger.info(f"Loaded {label} snapshot {snapshot_path.name}")
+            return frame
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable {label} snapshot {snapshot_path.name}: {e}")
+            return None
+
+    def write(self, label, source_hash, frame):
+        snapshot_path = self._path(label, source_hash)
+        try:
+            sink = pa.BufferOutputStream()
+            pq.write_table(pa.Table.from_pandas(frame, preserve_index=False), sink)
+            salt = os.urandom(self.SALT_SIZE)
+            nonce = os.urandom(self.NONCE_SIZE)
+            ciphertext = AESGCM(self._key(salt)).encrypt(nonce, sink.getvalue().to_pybytes(), source_hash.encode('ascii'))
+            
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = snapshot_path.with_suffix('.tmp')
+            with open(temp_path, 'wb') as f:
+                f.write(self.MAGIC + salt + nonce + ciphertext)
+            os.replace(temp_path, snapshot_path)
+            logger.info(f"Wrote {label} snapshot {snapshot_path.name}")
+        except Exception as e:
+            logger.warning(f"Could not write {label} snapshot: {e}")
+            return
+        
+        # Snapshots of older versions of the same workbook are never read again
+        for stale in self.cache_dir.glob(f"{label}-*.parquet.enc"):
+            if stale != snapshot_path:
+                stale.unlink(missing_ok=True)
+
+SNAPSHOT_CACHE = SnapshotCache(SNAPSHOT_CACHE_DIR)
+
+class CustomerIndex:
+    # Rows grouped by 'customer id' (original order kept within each customer) plus a dict of
+    # customer id -> (start, stop) row range, so a customer's rows are an O(1) slice.
+    def __init__(self, frame):
+        codes, customer_ids = pd.factorize(frame['customer id'], sort=False)
+        order = np.argsort(codes, kind='stable')
+        counts = np.bincount(codes[codes >= 0], minlength=len(customer_ids))
+        stops = np.cumsum(counts)
+        starts = stops - counts
+        self.frame = frame.take(order[codes[order] >= 0]).reset_index(drop=True)
+        self.ranges = dict(zip(customer_ids.tolist(), zip(starts.tolist(), stops.tolist())))
+
+    def __contains__(self, customer_id):
+        return customer_id in self.ranges
+
+    def __len__(self):
+        return len(self.ranges)
+
+    @property
+    def customer_ids(self):
+        return list(self.ranges)
+
+    def rows(self, customer_id):
+        row_range = self.ranges.get(customer_id)
+        if row_range is None:
+            return self.frame.iloc[0:0]
+        return self.frame.iloc[row_range[0]:row_range[1]]
+
+def customer_rows(data, customer_id):
+    if isinstance(data, CustomerIndex):
+        return data.rows(customer_id)
+    return data[data['customer id'] == customer_id]
+
+class CustomerDataStore:
+    # Process-wide cache of the decrypted workbooks. Each file is decrypted and parsed once,
+    # normalized ('customer id' as stripped strings), indexed by customer and reloaded only
+    # when its mtime/size changes. The per-customer features joined from all three files are
+    # aggregated once per version of the files as well.
+    def __init__(self):
+        self._indexes = {}  # file path -> (signature, CustomerIndex)
+        self._features = {}  # (transactions, profile, twitter paths) -> (source indexes, CustomerIndex)
+        self._locks = {}
+        self._guard = threading.Lock()
+
+    @staticmethod
+    def _signature(file_path):
+        stat = os.stat(file_path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _lock_for(self, file_path):
+        with self._guard:
+            return self._locks.setdefault(file_path, threading.Lock())
+
+    def index(self, file_path, label, require_ids=False):
+        file_path = str(file_path)  # Convert Path to string
+        if not Path(file_path).is_file():
+            logger.error(f"Input file {file_path} not found!")
+            raise FileNotFoundError(f"Input file {file_path} not found!")
+        
+        signature = self._signature(file_path)
+        entry = self._indexes.get(file_path)
+        if entry and entry[0] == signature:
+            return entry[1]
+        
+        with self._lock_for(file_path):
+            entry = self._indexes.get(file_path)
+            if entry and entry[0] == signature:
+                return entry[1]
+            index = CustomerIndex(self._load(file_path, label, require_ids))
+            self._indexes[file_path] = (signature, index)
+            return index
+
+    def get(self, file_path, label, require_ids=False):
+        return self.index(file_path, label, require_ids).frame
+
+    def features(self, transactions_file_path, profile_file_path, twitter_file_path):
+        sources = (self.index(transactions_file_path, 'transactions', require_ids=True),
+                   self.index(profile_file_path, 'profile'),
+                   self.index(twitter_file_path, 'twitter'))
+        key = tuple(str(file_path) for file_path in (transactions_file_path, profile_file_path, twitter_file_path))  # Convert Path to string
+        entry = self._features.get(key)
+        if entry and all(built is current for built, current in zip(entry[0], sources)):
+            return entry[1]
+        
+        with self._lock_for(key):
+            entry = self._features.get(key)
+            if entry and all(built is current for built, current in zip(entry[0], sources)):
+                return entry[1]
+            start = time.perf_counter()
+            features = CustomerIndex(aggregate_customer_features(*(index.frame for index in sources)))
+            self._features[key] = (sources, features)
+            logger.info(f"Aggregated features for {len(features)} customers in {time.perf_counter() - start:.2f} seconds.")
+            return features
+
+    def _load(self, file_path, label, require_ids):
+        start = time.perf_counter()
+        source_hash = SNAPSHOT_CACHE.file_hash(file_path) if SNAPSHOT_CACHE.enabled else None
+        columns = SNAPSHOT_COLUMNS.get(label)
+        with TRACER.span('snapshot_read'):
+            frame = SNAPSHOT_CACHE.read(label, source_hash, columns) if source_hash else None
+        
+        if frame is None:
+            logger.info(f"Decrypting and parsing {file_path}...")
+            with TRACER.span('decrypt'):
+                workbook = decrypt_workbook(file_path)
+            with TRACER.span('read_excel'):
+                frame = pd.read_excel(workbook)
+            frame.columns = frame.columns.str.strip().str.lower()
+            
+            if 'customer id' not in frame.columns or (require_ids and frame['customer id'].isnull().any()):
+                qualifier = "non-null " if require_ids else ""
+                logger.error(f"{label.capitalize()} file must contain {qualifier}'Customer ID' column.")
+                raise ValueError(f"Invalid 'Customer ID' data in {label} file.")
+            
+            frame['customer id'] = frame['customer id'].astype(str).str.strip()
+            if source_hash:
+                SNAPSHOT_CACHE.write(label, source_hash, frame)  # Every column, so changing PROMPT_FIELDS needs no new snapshot
+            if columns is not None:
+                frame = frame[[column for column in dict.fromkeys(['customer id'] + columns) if column in frame.columns]]
+        
+        logger.info(f"{label.capitalize()} data columns: {frame.columns.tolist()}")
+        logger.info(f"{label.capitalize()} data has {frame['customer id'].nunique()} unique Customer IDs.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Sample Customer IDs in {label}: {frame['customer id'].drop_duplicates().head(LOG_SAMPLE_ROWS).tolist()}")
+        logger.info(f"Loaded {len(frame)} {label} rows in {time.perf_counter() - start:.2f} seconds.")
+        return frame
+
+    def preload(self, sources):
+        for file_path, label, require_ids in sources:
+            self.index(file_path, label, require_ids)
+
+    def invalidate(self):
+        with self._guard:
+            self._indexes.clear()
+            self._features.clear()
+
+DATA_STORE = CustomerDataStore()
+DATA_SOURCES = [
+    (INPUT_FILE_TRANSACTIONS, 'transactions', True),
+    (INPUT_FILE_PROFILE, 'profile', False),
+    (INPUT_FILE_TWITTER, 'twitter', False),
+]
+
+def join_per_customer(customer_ids, values, index, sep=", "):
+    # sep.join(values) for each customer in row order, aligned to index; one vectorized pass per position
+    # rather than a Python join per group
+    position = customer_ids.groupby(customer_ids, sort=False).cumcount()
+    joined = pd.Series(np.nan, index=index, dtype=object)
+    for k in range(int(position.max()) + 1 if len(position) else 0):
+        at = (position == k).to_numpy()
+        part = pd.Series(values.to_numpy()[at], index=customer_ids.to_numpy()[at]).reindex(index)
+        joined = part if k == 0 else joined.where(part.isna(), joined + sep + part)
+    return joined
+
+def aggregate_customer_features(transactions_data, profile_data, twitter_data):
+    # Reduces every source to one row per customer before joining, so the joins are 1:1 instead of
+    # transactions x tweets. Per-transaction columns become recent categories, spend by category and a
+    # count; other transaction columns, the profile and the latest tweet are taken as they are.
+    transaction_level = ['category', 'transaction amount'] + [col for col in transactions_data.columns if pd.api.types.is_datetime64_any_dtype(transactions_data[col])]
+    features = transactions_data.drop(columns=[col for col in transaction_level if col in transactions_data.columns]).drop_duplicates('customer id').set_index('customer id')
+    customer_ids = transactions_data['customer id']
     
-    logger.info(f"Loading data from {transactions_file_path} for Customer ID: {customer_id}...")
-    if not Path(transactions_file_path).is_file():
-        logger.error(f"Input file {transactions_file_path} not found!")
-        raise FileNotFoundError(f"Input file {transactions_file_path} not found!")
+    # A customer is consented only if every one of their transactions carries explicit consent
+    consent_given = transactions_data['consent'].notna() & transactions_data['consent'].astype(bool)
+    features['consent'] = consent_given.groupby(customer_ids, sort=False).all()
+    if 'consent_social_media' not in features.columns:
+        features['consent_social_media'] = False
+    
+    if 'category' in transactions_data.columns:
+        recent = transactions_data.groupby('customer id', sort=False).tail(5)
+        features['recent categories'] = join_per_customer(recent['customer id'], recent['category'].map(str), features.index)
+        if 'transaction amount' in transactions_data.columns:
+            spend = transactions_data.groupby(['customer id', 'category'], sort=False, dropna=False)['transaction amount'].sum().reset_index()
+            amounts = spend['transaction amount'].map('{:.2f}'.format).astype(object)  # Stays float64 when spend is empty
+            features['spend by category'] = join_per_customer(spend['customer id'], spend['category'].map(str).astype(object) + ": " + amounts, features.index)
+    features['transaction count'] = customer_ids.groupby(customer_ids, sort=False).size()
+    
+    combined_data = pd.merge(features.reset_index(), profile_data.drop_duplicates('customer id'), on='customer id', how='left', suffixes=('_trans', '_profile'), validate='one_to_one')
+    combined_data = pd.merge(combined_data, twitter_data.drop_duplicates('customer id', keep='last'), on='customer id', how='left', validate='one_to_one')
+    combined_data['consent_social_media'] = combined_data['consent_social_media'].astype(bool).fillna(False)
     
+    # Customers missing from the profile or twitter sheet turn integer columns into floats; keep them
+    # integers so an age still reads "34" and not "34.0"
+    for source in (profile_data, twitter_data):
+        for col in source.columns:
+            if pd.api.types.is_integer_dtype(source[col]) and col in combined_data.columns and pd.api.types.is_float_dtype(combined_data[col]):
+                combined_data[col] = combined_data[col].astype('Int64')
+    return combined_data
+
+def load_data(transactions_file_path, profile_file_path, twitter_file_path, customer_id):
+    logger.info(f"Loading data from {transactions_file_path} for Customer ID: {customer_id}...")
     try:
-        with open(transactions_file_path, 'rb') as f:
-            encrypted_file = msoffcrypto.OfficeFile(f)
-            encrypted_file.load_key(password=EXCEL_PASSWORD)
-            decrypted_stream = BytesIO()
-            encrypted_file.decrypt(decrypted_stream)
-            decrypted_stream.seek(0)
-        
-        transactions_data = pd.read_excel(decrypted_stream)
-        transactions_data.columns = transactions_data.columns.str.strip().str.lower()
-        logger.info(f"Transactions data columns: {transactions_data.columns.tolist()}")
-        logger.info(f"Unique Customer IDs in transactions: {transactions_data['customer id'].unique().tolist()}")
-        
-        if 'customer id' not in transactions_data.columns or transactions_data['customer id'].isnull().any():
-            logger.error("Transactions file must contain non-null 'Customer ID' column.")
-            raise ValueError("Invalid 'Customer ID' data in transactions file.")
-        
-        transactions_data['customer id'] = transactions_data['customer id'].astype(str).str.strip()
-        transactions_data = transactions_data[transactions_data['customer id'] == customer_id]
+        transactions_data = DATA_STORE.index(transactions_file_path, 'transactions', require_ids=True).rows(customer_id)
         if transactions_data.empty:
             logger.warning(f"No transactions found for Customer ID {customer_id}")
         
@@ -476,9 +1314,6 @@ def load_data(transactions_file_path, profile_file_path, twitter_file_path, cust
             logger.error("All customers in transactions file must have provided explicit consent.")
             raise ValueError("Missing or invalid consent in transactions file.")
         
-        if 'consent_social_media' not in transactions_data.columns:
-            transactions_data['consent_social_media'] = False
-        
         logger.info("Transactions data loaded successfully.")
     
     except Exception as e:
@@ -486,29 +1321,8 @@ def load_data(transactions_file_path, profile_file_path, twitter_file_path, cust
         raise
     
     logger.info(f"Loading data from {profile_file_path} for Customer ID: {customer_id}...")
-    if not Path(profile_file_path).is_file():
-        logger.error(f"Input file {profile_file_path} not found!")
-        raise FileNotFoundError(f"Input file {profile_file_path} not found!")
-    
     try:
-        with open(profile_file_path, 'rb') as f:
-            encrypted_file = msoffcrypto.OfficeFile(f)
-            encrypted_file.load_key(password=EXCEL_PASSWORD)
-            decrypted_stream = BytesIO()
-            encrypted_file.decrypt(decrypted_stream)
-            decrypted_stream.seek(0)
-        
-        profile_data = pd.read_excel(decrypted_stream)
-        profile_data.columns = profile_data.columns.str.strip().str.lower()
-        logger.info(f"Profile data columns: {profile_data.columns.tolist()}")
-        logger.info(f"Unique Customer IDs in profile: {profile_data['customer id'].unique().tolist()}")
-        
-        if 'customer id' not in profile_data.columns:
-            logger.error("Profile file must contain 'Customer ID' column.")
-            raise ValueError("Profile file must contain 'Customer ID' column.")
-        
-        profile_data['customer id'] = profile_data['customer id'].astype(str).str.strip()
-        profile_data = profile_data[profile_data['customer id'] == customer_id]
+        DATA_STORE.index(profile_file_path, 'profile')
         logger.info("Profile data loaded successfully.")
     
     except Exception as e:
@@ -516,47 +1330,28 @@ def load_data(transactions_file_path, profile_file_path, twitter_file_path, cust
         raise
     
     logger.info(f"Loading data from {twitter_file_path} for Customer ID: {customer_id}...")
-    if not Path(twitter_file_path).is_file():
-        logger.error(f"Input file {twitter_file_path} not found!")
-        raise FileNotFoundError(f"Input file {twitter_file_path} not found!")
-    
     try:
-        with open(twitter_file_path, 'rb') as f:
-            encrypted_file = msoffcrypto.OfficeFile(f)
-            encrypted_file.load_key(password=EXCEL_PASSWORD)
-            decrypted_stream = BytesIO()
-            encrypted_file.decrypt(decrypted_stream)
-            decrypted_stream.seek(0)
-        
-        twitter_data = pd.read_excel(decrypted_stream)
-        twitter_data.columns = twitter_data.columns.str.strip().str.lower()
-        logger.info(f"Twitter data columns: {twitter_data.columns.tolist()}")
-        logger.info(f"Unique Customer IDs in twitter: {twitter_data['customer id'].unique().tolist()}")
-        
-        if 'customer id' not in twitter_data.columns:
-            logger.error("Twitter file must contain 'Customer ID' column.")
-            raise ValueError("Twitter file must contain 'Customer ID' column.")
-        
-        twitter_data['customer id'] = twitter_data['customer id'].astype(str).str.strip()
-        twitter_data = twitter_data[twitter_data['customer id'] == customer_id]
+        DATA_STORE.index(twitter_file_path, 'twitter')
         logger.info("Twitter data loaded successfully.")
     
     except Exception as e:
         logger.error(f"Failed to read twitter Excel file: {e}")
         raise
     
-    combined_data = pd.merge(transactions_data, profile_data, on='customer id', how='left', suffixes=('_trans', '_profile'))
-    combined_data = pd.merge(combined_data, twitter_data, on='customer id', how='left')
+    with TRACER.span('merge'):
+        combined_data = DATA_STORE.features(transactions_file_path, profile_file_path, twitter_file_path).rows(customer_id)
     logger.info(f"Combined data columns after merge: {combined_data.columns.tolist()}")
     if not combined_data.empty:
-        logger.info(f"Data for Customer ID {customer_id} after merge: {combined_data.to_dict(orient='records')}")
+        logger.info(f"Merged {len(combined_data)} rows for Customer ID {customer_id}.")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Data for Customer ID {customer_id} after merge: {combined_data.head(LOG_SAMPLE_ROWS).to_dict(orient='records')}")
     else:
         logger.info(f"No combined data for Customer ID {customer_id}")
     
     return combined_data
 
 def generate_user_prompt(customer_id, data):
-    customer_data = data[data['customer id'] == customer_id]
+    customer_data = customer_rows(data, customer_id)
     if customer_data.empty:
         logger.info(f"No data found for Customer ID {customer_id}")
         return f"No data found for Customer ID {customer_id}"
@@ -579,204 +1374,1488 @@ def generate_user_prompt(customer_id, data):
         logger.warning(f"Customer ID {customer_id}: No 'first name' found, using 'Customer'.")
         first_name = "Customer"
     
-    transaction_summary = ', '.join(f"{row['category']}" for _, row in customer_data[['category']].tail(5).iterrows()) or "no recent transactions"
-    sentiment_summary = "Twitter sentiment: " + (f"{customer_data['sentiment'].iloc[0]} based on tweet: {customer_data['tweet'].iloc[0]}" if pd.notna(customer_data['sentiment'].iloc[0]) and customer_data['consent_social_media'].iloc[0] else "not available or not consented")
-    
-    customer_info = customer_data.to_dict(orient='records')[0]
-    customer_info_str = ", ".join(f"{key}: {value}" for key, value in customer_info.items() if key not in ['customer id', 'transaction amount'])
+    if 'recent categories' in customer_data.columns:
+        transaction_summary = customer_data['recent categories'].iloc[0] if pd.notna(customer_data['recent categories'].iloc[0]) else "no recent transactions"
+    else:
+        transaction_summary = ', '.join(f"{row['category']}" for _, row in customer_data[['category']].tail(5).iterrows()) or "no recent transactions"
     
-    prompt = (
-        f"Generate a recommendation for {first_name} based on the following consented data:\n"
-        f"Recent transaction categories: {transaction_summary}. {sentiment_summary}\n"
-        f"Customer details: {customer_info_str}"
-    )
-    logger.info(f"Generated user prompt for {customer_id}: {prompt}")
+    details = dict(zip(customer_data.columns, customer_data.iloc[0].tolist()))  # The row is object dtype: 'customer id' is a string
+    details.pop('customer id')
+    prompt, prompt_tokens, tokens_saved = PROMPT_BUDGET.render_one(str(first_name), str(transaction_summary), details)
+    logger.info(f"Generated user prompt for {customer_id} ({prompt_tokens} tokens, {tokens_saved} saved by compaction).")
+    logger.debug(f"User prompt for {customer_id}: {prompt}")
     return prompt
 
-def get_recommendation(system_prompt, user_prompt):
+class PromptBudget:
+    # Renders user prompts with compact "Customer details": _trans/_profile duplicates merged, empty
+    # values and fields already stated elsewhere in the prompt left out, fields kept in PROMPT_FIELDS
+    # order, tweets truncated, and the lowest-priority fields dropped once the token budget is used up.
+    # render() takes one row per customer for batches and render_one() the single customer of an
+    # interactive request; both go through _render() so the two always produce the same prompt.
+    OMITTED_FIELDS = {'customer id', 'transaction amount', 'recent categories', 'consent', 'consent_social_media', 'sentiment', 'tweet',
+                      'first name', 'first name_trans', 'first name_profile'}  # Used or stated in the prompt's first lines
+
+    def __init__(self, budget, fields, tweet_max_tokens, model):
+        self.budget = budget
+        self.fields = fields
+        self.tweet_max_tokens = tweet_max_tokens
+        self.model = model
+        self._encoding = None
+        self._encoding_loaded = False
+        self._encoding_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.prompts = 0
+        self.prompt_tokens = 0
+        self.tokens_saved = 0
+
+    def load_encoding(self, timeout=TIKTOKEN_LOAD_TIMEOUT):
+        # Once per process, at startup or on first use. tiktoken downloads its BPE ranks without a timeout
+        # unless TIKTOKEN_CACHE_DIR already holds them, so the load runs on a thread that is given up on
+        # after timeout seconds; without an encoding, tokens are estimated at ~4 chars each.
+        with self._encoding_lock:
+            if self._encoding_loaded:
+                return self._encoding
+            cache_dir = os.getenv('TIKTOKEN_CACHE_DIR')
+            if tiktoken is None:
+                pass
+            elif cache_dir and not os.path.isdir(cache_dir):
+                logger.warning(f"TIKTOKEN_CACHE_DIR {cache_dir} does not exist, estimating tokens from length.")
+            else:
+                result = {}
+                
+                def load():
+                    try:
+                        result['encoding'] = tiktoken.encoding_for_model(self.model)
+                    except Exception as e:
+                        result['error'] = e
+                loader = threading.Thread(target=load, name='tiktoken-load', daemon=True)
+                loader.start()
+                loader.join(timeout)
+                if 'encoding' in result:
+                    self._encoding = result['encoding']
+                else:
+                    reason = result.get('error', f"not loaded within {timeout:g} seconds")
+                    logger.warning(f"tiktoken encoding for {self.model} unavailable, estimating tokens from length: {reason}")
+            self._encoding_loaded = True
+            return self._encoding
+
+    def encoding(self):
+        if not self._encoding_loaded:
+            return self.load_encoding()
+        return self._encoding
+
+    def count(self, texts):
+        encoding = self.encoding()
+        if encoding is None:
+            return [-(-len(text) // 4) for text in texts]
+        if len(texts) == 1:
+            return [len(encoding.encode_ordinary(texts[0]))]  # encode_ordinary_batch starts a thread pool
+        return [len(tokens) for tokens in encoding.encode_ordinary_batch(texts)]
+
+    def count_one(self, text):
+        return self.count([text])[0]
+
+    def truncate(self, texts, max_tokens):
+        encoding = self.encoding()
+        truncated = []
+        for text, tokens in zip(texts, self.count(texts)):
+            if tokens > max_tokens:
+                text = encoding.decode(encoding.encode_ordinary(text)[:max_tokens]) if encoding is not None else text[:max_tokens * 4]
+                text = text.rstrip() + "..."
+            truncated.append(text)
+        return truncated
+
+    def _priority(self, label):
+        base = label.rsplit('_', 1)[0] if label.endswith(('_trans', '_profile')) else label
+        if base in self.fields:
+            return self.fields.index(base)
+        return self.fields.index('*') if '*' in self.fields else None
+
+    def _detail_fields(self, details):
+        # (label, values) in priority order with blank values as None; a _trans/_profile pair collapses into one field when equal
+        fields = {}
+        for col, values in details.items():
+            if col in self.OMITTED_FIELDS:
+                continue
+            values = [None if pd.isna(value) or str(value).strip() in ('', 'nan') else str(value) for value in values]
+            base = col[:-len('_profile')] if col.endswith('_profile') else col[:-len('_trans')] if col.endswith('_trans') else None
+            if base and col.endswith('_profile') and f"{base}_trans" in fields:
+                trans_values = fields.pop(f"{base}_trans")
+                same = [t is None or v is None or t == v for t, v in zip(trans_values, values)]
+                fields[base] = [(t if t is not None else v) if s else None for t, v, s in zip(trans_values, values, same)]
+                fields[col] = [None if s else v for v, s in zip(values, same)]
+                fields[f"{base}_trans"] = [None if s else t for t, s in zip(trans_values, same)]
+            else:
+                fields[col] = values
+        ranked = [(self._priority(label), i, label) for i, label in enumerate(fields)]
+        return [(label, fields[label]) for rank, _, label in sorted(item for item in ranked if item[0] is not None)]
+
+    def _render(self, first_names, transaction_summaries, details):
+        # The one implementation behind render() and render_one(): details maps column -> list of values,
+        # one per customer; returns (prompts, tokens, saved) as lists
+        count = len(first_names)
+        raw_tweets = [str(tweet) for tweet in details['tweet']] if 'tweet' in details else [''] * count
+        tweets = self.truncate(raw_tweets, self.tweet_max_tokens)
+        if 'sentiment' in details:
+            has_sentiment = [not pd.isna(sentiment) and bool(consent) for sentiment, consent in zip(details['sentiment'], details['consent_social_media'])]
+            sentiments = details['sentiment']
+        else:
+            has_sentiment, sentiments = [False] * count, [''] * count
+        headers = [
+            f"Generate a recommendation for {first_name} based on the following consented data:\n"
+            f"Recent transaction categories: {transaction_summary}. "
+            + (f"Twitter sentiment: {sentiment} based on tweet: {tweet}" if consented else "Twitter sentiment: not available or not consented")
+            + "\nCustomer details: "
+            for first_name, transaction_summary, sentiment, tweet, consented in zip(first_names, transaction_summaries, sentiments, tweets, has_sentiment)
+        ]
+        
+        header_tokens = self.count(headers)
+        used = list(header_tokens)
+        customer_info = [[] for _ in range(count)]
+        for label, values in self._detail_fields(details):
+            present = [i for i, value in enumerate(values) if value is not None]
+            parts = [f"{label}: {values[i]}" for i in present]
+            for i, part, tokens in zip(present, parts, self.count(parts)):
+                tokens += 1  # For the separator
+                if not self.budget or used[i] + tokens <= self.budget:
+                    used[i] += tokens
+                    customer_info[i].append(part)
+        
+        # What the prompt would have cost with the full tweet and every column dumped as key: value
+        uncompacted = list(header_tokens)
+        if 'tweet' in details:
+            for i, full, short in zip(range(count), self.count(raw_tweets), self.count(tweets)):
+                if has_sentiment[i]:
+                    uncompacted[i] += full - short
+        for col, values in details.items():
+            if col not in ('customer id', 'transaction amount'):
+                for i, tokens in enumerate(self.count([f"{col}: {value}" for value in values])):
+                    uncompacted[i] += tokens + 1
+        saved = [max(full - tokens, 0) for full, tokens in zip(uncompacted, used)]
+        with self._lock:
+            self.prompts += count
+            self.prompt_tokens += sum(used)
+            self.tokens_saved += sum(saved)
+        return [header + ", ".join(info) for header, info in zip(headers, customer_info)], used, saved
+
+    def render(self, first_name, transaction_summary, details):
+        # All inputs are indexed by customer id; returns the prompts as a Series with token counts as arrays
+        columns = {col: details[col].tolist() for col in details.columns}
+        prompts, used, saved = self._render(first_name.tolist(), transaction_summary.tolist(), columns)
+        return pd.Series(prompts, index=details.index, dtype=object), np.array(used, dtype=np.int64), np.array(saved, dtype=np.int64)
+
+    def render_one(self, first_name, transaction_summary, details):
+        # render() for a single customer given as a column -> value dict; returns (prompt, tokens, saved)
+        prompts, used, saved = self._render([first_name], [transaction_summary], {col: [value] for col, value in details.items()})
+        return prompts[0], used[0], saved[0]
+
+    def stats(self):
+        with self._lock:
+            return {
+                'prompts': self.prompts,
+                'prompt_tokens': self.prompt_tokens,
+                'tokens_saved': self.tokens_saved,
+                'tokens_saved_per_prompt': round(self.tokens_saved / self.prompts, 1) if self.prompts else 0.0,
+                'token_budget': self.budget,
+                'tokenizer': 'tiktoken' if self._encoding is not None else 'estimate' if self._encoding_loaded else 'not loaded',
+            }
+
+PROMPT_BUDGET = PromptBudget(PROMPT_TOKEN_BUDGET, PROMPT_FIELDS, PROMPT_TWEET_MAX_TOKENS, OPENAI_MODEL)
+
+def build_user_prompts(data, customer_ids=None):
+    # Same prompts as generate_user_prompt, built for many customers at once with column-wise pandas
+    # operations; returns a Series of prompts indexed by customer id
+    frame = data.frame if isinstance(data, CustomerIndex) else data
+    if customer_ids is not None:
+        frame = frame[frame['customer id'].isin(set(customer_ids))]
+    if frame.empty:
+        prompts = pd.Series(dtype=object)
+    else:
+        prompts = _build_prompts(frame)
+    if customer_ids is not None:
+        missing = pd.Index(customer_ids).difference(prompts.index)
+        prompts = pd.concat([prompts, pd.Series([f"No data found for Customer ID {customer_id}" for customer_id in missing], index=missing, dtype=object)])
+    logger.info(f"Built {len(prompts)} user prompts.")
+    return prompts
+
+def _build_prompts(frame):
+    first = frame.drop_duplicates('customer id').set_index('customer id')
+    
+    # First non-blank first-name column per customer, in the same order generate_user_prompt tries them
+    first_name = pd.Series(None, index=first.index, dtype=object)
+    for col in ['first name_trans', 'first name_profile', 'first name']:
+        if col in first.columns:
+            usable = first[col].notna() & first[col].map(str).str.strip().astype(bool)
+            first_name = first_name.where(first_name.notna() | ~usable, first[col])
+    first_name = first_name.fillna("Customer").map(str)
+    
+    if 'recent categories' in first.columns:
+        transaction_summary = first['recent categories']
+    else:
+        recent = frame.groupby('customer id', sort=False).tail(5)
+        transaction_summary = join_per_customer(recent['customer id'], recent['category'].map(str), first.index)
+    transaction_summary = transaction_summary.where(transaction_summary.notna() & transaction_summary.astype(bool), "no recent transactions")
+    
+    prompts, _, _ = PROMPT_BUDGET.render(first_name, transaction_summary, first)
+    consented = first['consent'].astype(bool)  # Truthiness of the first row's value, as in generate_user_prompt
+    return prompts.where(consented, "Skipping " + first.index.to_series().map(str) + " due to lack of consent.")
+
+API_ERROR_RECOMMENDATION = "Unable to generate recommendation due to an API error. Visit wellsfargo.com."
+
+class TokenBucket:
+    # Refills continuously at rate_per_minute; acquire() blocks until enough budget is available
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate = rate_per_minute / 60.0
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                wait_seconds = (amount - self.available) / self.rate
+            time.sleep(wait_seconds)
+
+    def refund(self, amount):
+        with self._lock:
+            self._refill()
+            self.available = min(self.capacity, self.available + amount)
+
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+class LLMClientPool:
+    # Shared gateway for chat completions: caps in-flight calls, applies request and token
+    # rate limits, and retries 429/5xx/timeouts with exponential backoff and full jitter.
+    def __init__(self, max_concurrency, requests_per_minute, tokens_per_minute, timeout, max_retries):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._request_bucket = TokenBucket(requests_per_minute)
+        self._token_bucket = TokenBucket(tokens_per_minute)
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='llm')
+
+    @staticmethod
+    def _is_retryable(error):
+        if isinstance(error, (openai.error.RateLimitError, openai.error.Timeout, openai.error.APIConnectionError,
+                              openai.error.ServiceUnavailableError, openai.error.TryAgain)):
+            return True
+        if isinstance(error, openai.error.APIError):
+            return error.http_status is None or error.http_status >= 500
+        return False
+
+    @staticmethod
+    def _backoff(attempt, error):
+        retry_after = getattr(error, 'headers', None) and error.headers.get('retry-after')
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                pass
+        return random.uniform(0, min(60.0, 0.5 * 2 ** attempt))
+
+    def _wait_before_retry(self, attempt, error):
+        if attempt >= self.max_retries or not self._is_retryable(error):
+            raise error
+        delay = self._backoff(attempt, error)
+        logger.warning(f"OpenAI call failed ({error}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+        time.sleep(delay)
+
+    def _reserve(self, estimated):
+        self._request_bucket.acquire()
+        self._token_bucket.acquire(estimated)
+
+    def complete(self, messages, max_tokens, temperature, **params):
+        estimated = sum(estimate_tokens(message['content']) for message in messages) + max_tokens
+        for attempt in range(self.max_retries + 1):
+            self._reserve(estimated)
+            try:
+                with self._slots:
+                    response = openai.ChatCompletion.create(
+                        model=OPENAI_MODEL,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        request_timeout=self.timeout,
+                        **params
+                    )
+                usage = response.get('usage') if hasattr(response, 'get') else None
+                if usage and usage.get('total_tokens'):
+                    self._token_bucket.refund(max(0, estimated - usage['total_tokens']))
+                return response
+            except Exception as e:
+                self._wait_before_retry(attempt, e)
+
+    def stream(self, messages, max_tokens, temperature, **params):
+        # Yields content deltas as they arrive; an attempt is retried only if nothing was yielded yet.
+        # Returns the completion's finish_reason, which stays None if the stream ended without one.
+        estimated = sum(estimate_tokens(message['content']) for message in messages) + max_tokens
+        for attempt in range(self.max_retries + 1):
+            self._reserve(estimated)
+            received = False
+            finish_reason = None
+            try:
+                with self._slots:
+                    chunks = openai.ChatCompletion.create(
+                        model=OPENAI_MODEL,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        temperature=temperature,
+                        request_timeout=self.timeout,
+                        stream=True,
+                        **params
+                    )
+                    for chunk in chunks:
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.get('content')
+                        finish_reason = chunk.choices[0].finish_reason or finish_reason
+                        if delta:
+                            received = True
+                            yield delta
+                return finish_reason
+            except Exception as e:
+                if received:
+                    raise
+                self._wait_before_retry(attempt, e)
+
+    def submit(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+LLM_POOL = LLMClientPool(LLM_MAX_CONCURRENCY, LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE, LLM_REQUEST_TIMEOUT, LLM_MAX_RETRIES)
+
+class RecommendationCache:
+    # Content-addressed cache of completions: an in-memory LRU tier in front of an optional SQLite tier.
+    # Entries expire after ttl seconds; each remembers its original latency and token cost so hits
+    # can report what they saved.
+    def __init__(self, max_entries, ttl, db_path=None, enabled=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled
+        self._memory = OrderedDict()  # key -> (created, value, latency, tokens)
+        self._lock = threading.Lock()
+        self._db = None
+        self.counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'stores': 0, 'saved_seconds': 0.0, 'saved_tokens': 0}
+        if enabled and db_path:
+            os.makedirs(Path(db_path).parent, exist_ok=True)
+            self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS recommendations (key TEXT PRIMARY KEY, value TEXT, created REAL, latency REAL, tokens INTEGER)")
+            self._db.commit()
+
+    @staticmethod
+    def fingerprint(model, system_prompt, user_prompt, temperature, max_tokens):
+        material = json.dumps([model, system_prompt, user_prompt, temperature, max_tokens], ensure_ascii=False)
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def _record_hit(self, tier, latency, tokens):
+        self.counters[f'{tier}_hits'] += 1
+        self.counters['saved_seconds'] += latency
+        self.counters['saved_tokens'] += tokens
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry and now - entry[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self._record_hit('memory', entry[2], entry[3])
+                return entry[1]
+            self._memory.pop(key, None)
+            
+            if self._db is not None:
+                row = self._db.execute("SELECT created, value, latency, tokens FROM recommendations WHERE key = ?", (key,)).fetchone()
+                if row and now - row[0] <= self.ttl:
+                    self._remember(key, row)
+                    self._record_hit('disk', row[2], row[3])
+                    return row[1]
+                if row:
+                    self._db.execute("DELETE FROM recommendations WHERE key = ?", (key,))
+                    self._db.commit()
+            self.counters['misses'] += 1
+            return None
+
+    def _remember(self, key, entry):
+        self._memory[key] = tuple(entry)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def put(self, key, value, latency=0.0, tokens=0):
+        if not self.enabled:
+            return
+        entry = (time.time(), value, latency, tokens)
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO recommendations (key, created, value, latency, tokens) VALUES (?, ?, ?, ?, ?)", (key, *entry))
+                self._db.commit()
+            self.counters['stores'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters, memory_entries=len(self._memory))
+        lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_ratio'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+LLM_CACHE = RecommendationCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL, LLM_CACHE_DB, LLM_CACHE_ENABLED)
+
+def stream_recommendation(messages):
+    # Forwards deltas to the browser as they arrive, coalescing bursts into one event per flush interval.
+    # Returns the text together with the finish_reason so callers can tell a complete answer from a cut-off one.
+    parts = []
+    pending = []
+    last_flush = 0.0
+    finish_reason = None
+    deltas = LLM_POOL.stream(messages, max_tokens=RECOMMENDATION_MAX_TOKENS, temperature=RECOMMENDATION_TEMPERATURE)
+    while True:
+        try:
+            delta = next(deltas)
+        except StopIteration as done:
+            finish_reason = done.value
+            break
+        parts.append(delta)
+        pending.append(delta)
+        now = time.perf_counter()
+        if now - last_flush >= STREAM_FLUSH_INTERVAL:
+            emit_event('recommendation_token', {'delta': ''.join(pending)})
+            pending = []
+            last_flush = now
+    if pending:
+        emit_event('recommendation_token', {'delta': ''.join(pending)})
+    return ''.join(parts), finish_reason
+
+def get_recommendation(system_prompt, user_prompt, bypass_cache=False, stream=STREAM_RECOMMENDATIONS):
     if "Skipping" in user_prompt or "No data found" in user_prompt:
         return user_prompt
+    cache_key = RecommendationCache.fingerprint(OPENAI_MODEL, system_prompt, user_prompt, RECOMMENDATION_TEMPERATURE, RECOMMENDATION_MAX_TOKENS)
+    if not bypass_cache:
+        with TRACER.span('llm_cache'):
+            cached = LLM_CACHE.get(cache_key)
+        if cached is not None:
+            logger.info("Recommendation served from cache.")
+            emit_event('recommendation', {'content': cached})
+            return cached
+    
     logger.info("Calling OpenAI API with consented data...")
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=250,
-            temperature=0.7
-        )
-        recommendation = response.choices[0].message.content.strip()
+        start = time.perf_counter()
+        with TRACER.span('openai'):
+            if stream:
+                recommendation, finish_reason = stream_recommendation(messages)
+                recommendation = recommendation.strip()
+                tokens = estimate_tokens(system_prompt + user_prompt + recommendation)
+            else:
+                response = LLM_POOL.complete(messages, max_tokens=RECOMMENDATION_MAX_TOKENS, temperature=RECOMMENDATION_TEMPERATURE)
+                recommendation = response.choices[0].message.content.strip()
+                finish_reason = response.choices[0].finish_reason
+                usage = response.get('usage') if hasattr(response, 'get') else None
+                tokens = (usage or {}).get('total_tokens', 0)
+        # Only complete, non-empty answers are worth replaying to later callers
+        if recommendation and finish_reason == 'stop':
+            LLM_CACHE.put(cache_key, recommendation, time.perf_counter() - start, tokens)
+        else:
+            logger.warning(f"Not caching recommendation (finish_reason={finish_reason}, {len(recommendation)} chars).")
         word_count = len(recommendation.split())
-        logger.info(f"Recommendation generated successfully with {word_count} words: {recommendation}")
-        socketio.emit('recommendation', {'content': recommendation})
+        # The text is customer-specific, so it stays out of INFO, which every handler (the browser log too) receives
+        logger.info(f"Recommendation generated successfully with {word_count} words (cache key {cache_key[:16]}).")
+        logger.debug(f"Recommendation {cache_key[:16]}: {recommendation}")
+        if not stream:
+            emit_event('recommendation', {'content': recommendation})
         return recommendation
     except Exception as e:
         logger.error(f"Error calling OpenAI API: {e}")
-        socketio.emit('recommendation', {'content': "Unable to generate recommendation due to an API error. Visit wellsfargo.com."})
-        return "Unable to generate recommendation due to an API error. Visit wellsfargo.com."
+        emit_event('recommendation', {'content': API_ERROR_RECOMMENDATION})
+        return API_ERROR_RECOMMENDATION
 
 def download_youtube_video(youtube_url, output_path):
     output_path = Path(output_path)  # Ensure it's a Path object
-    output_dir = output_path.parent  # Directory: artifacts/temp
-    filename = output_path.name  # Filename: temp_background_video.mp4
-    full_path = str(output_path)  # Full path: F:\code\aidhp-himalayas\artifacts\temp\temp_background_video.mp4
+    output_dir = output_path.parent
+    full_path = str(output_path)
+    # The file only appears at its final path once complete, so a failed fetch never looks cached
+    temp_path = output_dir / f"{output_path.stem}.{os.getpid()}.{threading.get_ident()}.tmp{output_path.suffix}"
     
     logger.info(f"Downloading YouTube video from {youtube_url} to {full_path}...")
-    original_dir = os.getcwd()  # Save current working directory
-    
     try:
-        # Ensure the directory exists
         os.makedirs(output_dir, exist_ok=True)
         
-        # Change to the target directory
-        os.chdir(str(output_dir))
-        logger.info(f"Changed working directory to: {os.getcwd()}")
-        
-        yt = YouTube(youtube_url)
+        yt = pytubefix.YouTube(youtube_url)
         stream = yt.streams.filter(progressive=True, file_extension='mp4').order_by('resolution').desc().first()
         if not stream:
             raise Exception("No suitable video stream found.")
         
-        # Download to the current directory (artifacts/temp)
-        stream.download(filename=filename)
+        # Download straight into the target directory; changing the process cwd would break other threads
+        stream.download(output_path=str(output_dir), filename=temp_path.name)
+        if not temp_path.is_file():
+            raise FileNotFoundError(f"File was not downloaded to {temp_path}")
         
-        # Verify the file exists
-        if not os.path.exists(full_path):
-            # Check if it was downloaded to the base directory
-            base_file = str(BASE_DIR / filename)
-            if os.path.exists(base_file):
-                logger.warning(f"File was downloaded to base directory: {base_file}. Moving to {full_path}")
-                os.rename(base_file, full_path)
-            else:
-                raise FileNotFoundError(f"File was not downloaded to {full_path} or base directory")
-        
-        file_size = os.path.getsize(full_path)
-        if file_size < 1024:
-            logger.warning(f"Downloaded file {full_path} is unusually small ({file_size} bytes), may be incomplete.")
+        file_size = os.path.getsize(temp_path)
+        if file_size < MIN_VIDEO_FILE_BYTES:
+            raise ValueError(f"Downloaded file is too small ({file_size} bytes), likely incomplete.")
+        os.replace(temp_path, output_path)
         logger.info(f"Video downloaded to {full_path}, size: {file_size} bytes")
     
     except Exception as e:
         logger.error(f"Error downloading YouTube video: {e}")
+        temp_path.unlink(missing_ok=True)
         raise
+
+class BackgroundAssetCache:
+    # Fetches the background clip once and pre-transcodes it to a silent proxy at the render size and fps,
+    # so renders only loop and cut it. Proxies are keyed by the source URL or the local file's content hash
+    # and are never deleted per render.
+    def __init__(self, cache_dir, size, fps):
+        self.cache_dir = Path(cache_dir)
+        self.size = size
+        self.fps = fps
+        self._file_keys = {}  # (path, mtime, size) -> content hash
+        self._verified = set()  # (path, mtime, size) of cached files that passed a probe
+        self._lock = threading.Lock()
+
+    def _source_key(self, source):
+        if not Path(source).is_file():
+            return hashlib.sha256(source.encode('utf-8')).hexdigest()[:16]
+        stat = os.stat(source)
+        signature = (str(source), stat.st_mtime_ns, stat.st_size)
+        if signature not in self._file_keys:
+            self._file_keys[signature] = SnapshotCache.file_hash(source)[:16]
+        return self._file_keys[signature]
+
+    def _usable(self, path):
+        # Probes a cached file once per process (packets are copied, not decoded) and drops it if it is
+        # truncated or unreadable, so it gets fetched or transcoded again instead of failing every render
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return False
+        signature = (str(path), stat.st_mtime_ns, stat.st_size)
+        if signature in self._verified:
+            return True
+        if stat.st_size >= MIN_VIDEO_FILE_BYTES:
+            command = [ffmpeg_binary(), '-v', 'error', '-i', str(path), '-map', '0:v:0', '-c', 'copy', '-f', 'null', '-']  # Convert Path to string
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode == 0 and not result.stderr.strip():
+                self._verified.add(signature)
+                return True
+        logger.warning(f"Discarding unusable cached background {path} ({stat.st_size} bytes).")
+        Path(path).unlink(missing_ok=True)
+        return False
+
+    def proxy_path(self, source):
+        source = str(source)
+        key = self._source_key(source)
+        proxy = self.cache_dir / f"{key}_{self.size[0]}x{self.size[1]}_{self.fps}fps.mp4"
+        if self._usable(proxy):
+            return proxy
+        
+        with self._lock:
+            if self._usable(proxy):
+                return proxy
+            os.makedirs(self.cache_dir, exist_ok=True)
+            original = Path(source)
+            if not original.is_file():
+                # Keep the download too, so a re-transcode (new size/fps) does not fetch it again
+                original = self.cache_dir / f"{key}_source.mp4"
+                if not self._usable(original):
+                    download_youtube_video(source, original)
+            
+            logger.info(f"Transcoding background {original} to {self.size[0]}x{self.size[1]}@{self.fps}fps proxy...")
+            temp_proxy = proxy.with_name(f"{proxy.stem}.{os.getpid()}.tmp.mp4")  # Render processes may race here
+            clip = mpy.VideoFileClip(str(original)).without_audio().resize(self.size)  # Convert Path to string
+            try:
+                clip.write_videofile(str(temp_proxy), fps=self.fps, codec='libx264', audio=False, preset='veryfast', logger=None)
+            except Exception:
+                temp_proxy.unlink(missing_ok=True)
+                raise
+            finally:
+                clip.close()
+            os.replace(temp_proxy, proxy)
+            logger.info(f"Background proxy cached at {proxy}")
+            return proxy
+
+BACKGROUND_ASSETS = BackgroundAssetCache(BACKGROUND_CACHE_DIR, VIDEO_SIZE, VIDEO_FPS)
+
+def remove_render_workspace(workspace):
+    workspace_str = str(workspace)
+    retries = 5
+    while retries > 0:
+        try:
+            if os.path.exists(workspace_str):
+                shutil.rmtree(workspace_str)
+                logger.info(f"Deleted render workspace: {workspace_str}")
+            break
+        except PermissionError as e:
+            logger.warning(f"Failed to delete {workspace_str}: {e}. Retrying in 1 second...")
+            time.sleep(1)
+            retries -= 1
+        except Exception as e:
+            logger.error(f"Error deleting {workspace_str}: {e}")
+            raise
+    if retries == 0:
+        logger.warning(f"Could not delete {workspace_str} after retries. Files may still be in use.")
+
+def prune_output_videos(keep=None, max_files=None, max_age=None):
+    # Deletes the oldest interactive videos beyond the count and age limits. Batch videos (batch-*.mp4)
+    # are left alone: their links are recorded in the batch output and the batch owner manages them.
+    max_files = VIDEO_OUTPUT_MAX_FILES if max_files is None else max_files
+    max_age = VIDEO_OUTPUT_MAX_AGE if max_age is None else max_age
+    videos = []
+    with os.scandir(VIDEO_OUTPUT_DIR) as entries:
+        for entry in entries:
+            if entry.name.endswith('.mp4') and not entry.name.startswith('batch-') and entry.path != str(keep):  # Convert Path to string
+                try:
+                    videos.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:
+                    continue
+    videos.sort(reverse=True)
+    cutoff = time.time() - max_age
+    kept = 1 if keep else 0
+    removed = 0
+    for mtime, path in videos:
+        if (max_files and kept >= max_files) or (max_age and mtime < cutoff):
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass  # Pruned by another render
+        else:
+            kept += 1
+    if removed:
+        logger.info(f"Pruned {removed} old videos from {VIDEO_OUTPUT_DIR}.")
+    return removed
+
+class CaptionRenderer:
+    # Rasterizes caption text with Pillow into RGBA sprites, cached by text and style, so captions and
+    # the watermark are drawn once per process instead of spawning ImageMagick for every clip.
+    FONT_FALLBACKS = {
+        'Arial-Bold': ['arialbd.ttf', 'Arial Bold.ttf', 'DejaVuSans-Bold.ttf', 'LiberationSans-Bold.ttf'],
+        'Arial': ['arial.ttf', 'Arial.ttf', 'DejaVuSans.ttf', 'LiberationSans-Regular.ttf'],
+    }
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._sprites = OrderedDict()
+        self._fonts = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _font(self, font, fontsize):
+        key = (font, fontsize)
+        if key not in self._fonts:
+            for candidate in self.FONT_FALLBACKS.get(font, [font]):
+                try:
+                    self._fonts[key] = ImageFont.truetype(candidate, fontsize)
+                    break
+                except OSError:
+                    continue
+            else:
+                logger.warning(f"Font {font} not found, using Pillow's default font for captions.")
+                self._fonts[key] = ImageFont.load_default()
+        return self._fonts[key]
+
+    def _rasterize(self, text, font, fontsize, color, size, bg_color):
+        # Lines centered horizontally and the block centered vertically, like TextClip's caption method
+        image = Image.new('RGBA', size, bg_color or (0, 0, 0, 0))
+        draw = ImageDraw.Draw(image)
+        face = self._font(font, fontsize)
+        lines = text.split('\n')
+        line_height = face.getbbox('Ag')[3] + 4
+        y = (size[1] - line_height * len(lines)) // 2
+        for line in lines:
+            left, top, right, bottom = face.getbbox(line)
+            draw.text(((size[0] - (right - left)) // 2 - left, y), line, font=face, fill=color)
+            y += line_height
+        return np.array(image)
+
+    def sprite(self, text, font, fontsize, color, size, bg_color=None):
+        key = (text, font, fontsize, color, tuple(size), bg_color)
+        with self._lock:
+            if key in self._sprites:
+                self._sprites.move_to_end(key)
+                self.hits += 1
+                return self._sprites[key]
+        sprite = self._rasterize(text, font, fontsize, color, size, bg_color)
+        with self._lock:
+            self.misses += 1
+            self._sprites[key] = sprite
+            while len(self._sprites) > self.max_entries:
+                self._sprites.popitem(last=False)
+        return sprite
+
+    def clip(self, text, font, fontsize, color, size, bg_color=None):
+        sprite = self.sprite(text, font, fontsize, color, size, bg_color)
+        mask = mpy.ImageClip(sprite[:, :, 3] / 255.0, ismask=True)
+        return mpy.ImageClip(sprite[:, :, :3]).set_mask(mask)
+
+CAPTIONS = CaptionRenderer(CAPTION_CACHE_SIZE)
+
+def voiced_windows(pcm, sample_width, channels, frame_rate, window=0.01, threshold=0.05, min_gap=0.06):
+    # One flag per 10 ms window: True while speaking. Windows quieter than threshold x the loudest one
+    # are silent, except for gaps shorter than min_gap (stops inside a word).
+    dtype = {1: np.uint8, 2: '<i2', 4: '<i4'}[sample_width]
+    samples = np.frombuffer(pcm, dtype=dtype).astype(np.float32)
+    if sample_width == 1:
+        samples -= 128
+    if channels > 1:
+        samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+    hop = max(1, int(frame_rate * window))
+    count = len(samples) // hop
+    if count == 0:
+        return np.zeros(0, dtype=bool), window
+    rms = np.sqrt(np.mean(samples[:count * hop].reshape(count, hop) ** 2, axis=1))
+    voiced = rms > rms.max() * threshold
+    
+    padded = np.concatenate(([True], voiced, [True]))
+    gaps = np.flatnonzero(padded[1:] != padded[:-1]).reshape(-1, 2)  # [start, end) of each silent run
+    for start, end in gaps[(gaps[:, 1] - gaps[:, 0]) * window < min_gap]:
+        voiced[start:end] = True
+    return voiced, window
+
+def spread_words(words, voiced, window, offset):
+    # Spreads words over the voiced windows only, weighted by length
+    speech = np.flatnonzero(voiced)
+    if len(speech) == 0:
+        speech = np.arange(max(1, len(voiced)))
+    weights = np.array([len(word) + 1 for word in words], dtype=np.float64)
+    bounds = np.concatenate(([0.0], np.cumsum(weights))) / weights.sum() * len(speech)
+    first = np.minimum(bounds[:-1].astype(int), len(speech) - 1)
+    last = np.clip(np.ceil(bounds[1:]).astype(int) - 1, 0, len(speech) - 1)
+    starts = offset + speech[first] * window
+    ends = offset + (speech[last] + 1) * window
+    return [(word, float(start), float(end)) for word, start, end in zip(words, starts, ends)]
+
+def align_words(words, voiced, window, offset=0.0):
+    # (word, start, end) for each word of one narrated line. When the pauses in the audio line up with the
+    # clause (or sentence) punctuation, each clause is pinned to its own stretch of speech; otherwise words
+    # are spread over all voiced time, which still skips leading/trailing silence.
+    if not words:
+        return []
+    padded = np.concatenate(([False], voiced, [False]))
+    runs = np.flatnonzero(padded[1:] != padded[:-1]).reshape(-1, 2)  # [start, end) of each stretch of speech
+    for pattern in (r'[.,;:!?]$', r'[.!?]$'):
+        groups = [[]]
+        for word in words:
+            groups[-1].append(word)
+            if re.search(pattern, word):
+                groups.append([])
+        groups = [group for group in groups if group]
+        if 1 < len(groups) == len(runs):
+            return [timing for group, (start, end) in zip(groups, runs)
+                    for timing in spread_words(group, voiced[start:end], window, offset + start * window)]
+    return spread_words(words, voiced, window, offset)
+
+class TTSService:
+    # Keeps one warm pyttsx3 engine per process and caches synthesized lines as WAV files keyed by
+    # sha256(text, voice, rate). Narration is assembled from line segments, so fixed lines such as
+    # "Wellsfargo would like to recommend you few products" are synthesized once per campaign.
+    def __init__(self, cache_dir, rate, voice=None, pause=0.35, max_entries=5000):
+        self.cache_dir = Path(cache_dir)
+        self.rate = rate
+        self.voice = voice
+        self.pause = pause
+        self.max_entries = max_entries
+        self._engine = None
+        self._lock = threading.Lock()  # pyttsx3 engines are not safe to drive from several threads at once
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def _get_engine(self):
+        if self._engine is None:
+            self._engine = pyttsx3.init()
+            self._engine.setProperty('rate', self.rate)
+            if self.voice:
+                self._engine.setProperty('voice', self.voice)
+        return self._engine
+
+    def segment_path(self, text):
+        key = hashlib.sha256(json.dumps([text, self.voice, self.rate]).encode('utf-8')).hexdigest()
+        path = self.cache_dir / f"{key}.wav"
+        if path.is_file():
+            self.hits += 1
+            os.utime(path)  # Recently used segments survive pruning
+            return path
+        
+        with self._lock:
+            if path.is_file():
+                return path
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.wav")  # Render processes share the cache
+            engine = self._get_engine()
+            engine.save_to_file(text, str(temp_path))  # Convert Path to string
+            engine.runAndWait()
+            os.replace(temp_path, path)
+            self.misses += 1
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._prune()
+        return path
+
+    def _prune(self):
+        segments = sorted(self.cache_dir.glob('*.wav'), key=lambda segment: segment.stat().st_mtime)
+        for stale in segments[:max(0, len(segments) - self.max_entries)]:
+            stale.unlink(missing_ok=True)
+
+    def synthesize(self, text, output_file):
+        # Writes the narration for text to output_file; returns its duration and (word, start, end)
+        # for every word, or None for the words when the engine output could not be analysed
+        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        if not lines:
+            raise ValueError("Nothing to narrate.")
+        segments = [(line, self.segment_path(line)) for line in lines]
+        try:
+            return self._concatenate(segments, output_file)
+        except wave.Error as e:
+            # Some platform drivers (e.g. macOS) write AIFF, which cannot be spliced here
+            logger.warning(f"TTS segments are not WAV ({e}); synthesizing the narration in one piece.")
+            with self._lock:
+                engine = self._get_engine()
+                engine.save_to_file(text, str(output_file))  # Convert Path to string
+                engine.runAndWait()
+            narration_audio = mpy.AudioFileClip(str(output_file))  # Convert Path to string
+            audio_duration = narration_audio.duration
+            narration_audio.close()
+            return audio_duration, None
+
+    def _concatenate(self, segments, output_file):
+        word_times = []
+        offset = 0.0
+        with wave.open(str(output_file), 'wb') as out:  # Convert Path to string
+            for i, (line, path) in enumerate(segments):
+                with wave.open(str(path), 'rb') as segment:  # Convert Path to string
+                    params = segment.getparams()
+                    pcm = segment.readframes(params.nframes)
+                if i == 0:
+                    out.setparams(params)
+                    silence = b'\x80' if params.sampwidth == 1 else b'\x00'  # 8-bit PCM is unsigned, centred on 128
+                    pause = silence * (int(params.framerate * self.pause) * params.sampwidth * params.nchannels)
+                else:
+                    out.writeframes(pause)
+                    offset += self.pause
+                out.writeframes(pcm)
+                voiced, window = voiced_windows(pcm, params.sampwidth, params.nchannels, params.framerate)
+                word_times.extend(align_words(line.split(), voiced, window, offset))
+                offset += params.nframes / params.framerate
+        return offset, word_times
+
+TTS = TTSService(TTS_CACHE_DIR, TTS_RATE, TTS_VOICE, TTS_SEGMENT_PAUSE, TTS_CACHE_MAX_ENTRIES)
+
+# Caption and watermark styling shared by both render backends; y is the top edge of the band
+CAPTION_STYLE = {'font': 'Arial-Bold', 'fontsize': 30, 'color': 'red', 'size': (1280, 70)}
+CAPTION_Y = 360
+WATERMARK_TEXT = "This video uses only consented customer data"
+WATERMARK_STYLE = {'font': 'Arial', 'fontsize': 20, 'color': 'white', 'size': (1280, 50), 'bg_color': 'black'}
+WATERMARK_Y = 670
+
+def read_wav_samples(audio_file):
+    # WAV as float32 samples in [-1, 1), shape (frames, channels), and its sample rate
+    with wave.open(str(audio_file), 'rb') as wav:  # Convert Path to string
+        params = wav.getparams()
+        pcm = wav.readframes(params.nframes)
+    dtype, scale = {1: (np.uint8, 128.0), 2: ('<i2', 32768.0), 4: ('<i4', 2147483648.0)}[params.sampwidth]
+    samples = np.frombuffer(pcm, dtype=dtype).astype(np.float32)
+    if params.sampwidth == 1:
+        samples -= 128
+    return (samples / scale).reshape(-1, params.nchannels), params.framerate
+
+def decode_pcm(audio_file, sample_rate, channels):
+    # Any audio file ffmpeg can read, resampled, as float32 samples of shape (frames, channels)
+    command = [ffmpeg_binary(), '-loglevel', 'error', '-i', str(audio_file),  # Convert Path to string
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ar', str(sample_rate), '-ac', str(channels), '-']
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        logger.error(f"Decoding {audio_file} failed with exit code {result.returncode}: {result.stderr[-2000:].decode('utf-8', 'replace')}")
+        raise RuntimeError(f"Could not decode {audio_file}")
+    return (np.frombuffer(result.stdout, dtype='<i2').astype(np.float32) / 32768.0).reshape(-1, channels)
+
+class MusicBed:
+    # Decodes the background music once per file version, sample rate and gain into a ducked float32 bed,
+    # cached as .npy next to the other render caches and memory-mapped by every render process. mix()
+    # adds the narration on top with NumPy and encodes the track to AAC in one ffmpeg pass, so renders
+    # only have to mux it.
+    def __init__(self, cache_dir, gain, channels=2):
+        self.cache_dir = Path(cache_dir)
+        self.gain = gain
+        self.channels = channels
+        self._file_keys = {}  # (path, mtime, size) -> content hash
+        self._beds = {}  # bed path -> memory-mapped samples
+        self._lock = threading.Lock()
+        self.decodes = 0
+
+    def bed_path(self, music_file, sample_rate):
+        stat = os.stat(music_file)
+        signature = (str(music_file), stat.st_mtime_ns, stat.st_size)
+        if signature not in self._file_keys:
+            self._file_keys[signature] = SnapshotCache.file_hash(music_file)[:16]
+        return self.cache_dir / f"{self._file_keys[signature]}_{sample_rate}hz_{self.channels}ch_{self.gain:g}.npy"
+
+    def bed(self, music_file, sample_rate):
+        path = self.bed_path(music_file, sample_rate)
+        if path in self._beds:
+            return self._beds[path]
+        
+        with self._lock:
+            if path not in self._beds:
+                if not path.is_file():
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    logger.info(f"Decoding background music {music_file} at {sample_rate} Hz...")
+                    samples = decode_pcm(music_file, sample_rate, self.channels) * np.float32(self.gain)
+                    temp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npy")  # Render processes may race here
+                    np.save(temp_path, samples)
+                    os.replace(temp_path, path)
+                    self.decodes += 1
+                    logger.info(f"Background music bed cached at {path}")
+                self._beds[path] = np.load(path, mmap_mode='r')
+        return self._beds[path]
+
+    def mix(self, narration_file, music_file, output_file):
+        # Writes narration over the music bed, cut to the narration, as AAC; returns the duration
+        try:
+            narration, sample_rate = read_wav_samples(narration_file)
+        except wave.Error:
+            narration, sample_rate = decode_pcm(narration_file, 44100, 1), 44100  # AIFF from some TTS drivers
+        if narration.shape[1] != self.channels:
+            narration = narration.mean(axis=1, keepdims=True)  # Mono narration goes to every channel
+        bed = self.bed(music_file, sample_rate)
+        frames = len(narration)
+        
+        mixed = np.zeros((frames, self.channels), dtype=np.float32)
+        mixed[:min(frames, len(bed))] = bed[:frames]  # Silence if the music is shorter than the narration
+        mixed += narration
+        pcm = (np.clip(mixed, -1.0, 32767 / 32768) * 32768).astype('<i2')
+        command = [ffmpeg_binary(), '-y', '-loglevel', 'error',
+                   '-f', 's16le', '-ar', str(sample_rate), '-ac', str(self.channels), '-i', '-',
+                   '-c:a', 'aac', '-ar', '44100', str(output_file)]  # Convert Path to string
+        result = subprocess.run(command, input=pcm.tobytes(), capture_output=True)
+        if result.returncode != 0:
+            logger.error(f"Audio encode failed with exit code {result.returncode}: {result.stderr[-2000:].decode('utf-8', 'replace')}")
+            raise RuntimeError(f"Audio encode failed with exit code {result.returncode}")
+        return frames / sample_rate
+
+MUSIC_BED = MusicBed(MUSIC_CACHE_DIR, BACKGROUND_MUSIC_GAIN)
+
+@contextmanager
+def timed_stage(timings, stage):
+    start = time.perf_counter()
+    try:
+        yield
     finally:
-        # Restore original working directory
-        os.chdir(original_dir)
-        logger.info(f"Restored working directory to: {os.getcwd()}")
-
-def generate_video_with_moviepy(recommendation_text):
-    logger.info("Generating video with recommendation text...")
-    check_prerequisites()
-    
-    # Use the provided recommendation text directly
-    recommendations_text = recommendation_text.strip()
-    logger.info(f"Video content to be narrated: {recommendations_text}")
-    
-    # Generate audio
-    engine = pyttsx3.init()
-    engine.setProperty('rate', 140)
-    engine.save_to_file(recommendations_text, str(TEMP_AUDIO_FILE))  # Convert Path to string
-    engine.runAndWait()
-    
-    narration_audio = AudioFileClip(str(TEMP_AUDIO_FILE))  # Convert Path to string
-    audio_duration = narration_audio.duration
-    logger.info(f"Audio duration: {audio_duration} seconds")
-    
-    # Generate text clips
-    sentences = recommendations_text.split('. ')
-    text_clips = []
-    current_time = 0
-    for sentence in sentences:
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def caption_chunks(recommendations_text, audio_duration, word_times=None):
+    # Two wrapped lines per caption. With word timestamps from the TTS stage each caption runs from its
+    # first word until the next caption's first word; otherwise it gets its share by word count.
+    texts = []
+    for sentence in recommendations_text.split('. '):
         wrapped_lines = textwrap.wrap(sentence, width=50)
         for i in range(0, len(wrapped_lines), 2):
-            two_lines = "\n".join(wrapped_lines[i:i+2])
-            chunk_duration = audio_duration / len(recommendations_text.split()) * len(two_lines.split())
-            text_clip = TextClip(two_lines, fontsize=30, color='red', font='Arial-Bold', size=(1280, 70), method='caption', align='center').set_position(('center', 360)).set_duration(chunk_duration).set_start(current_time)
-            text_clips.append(text_clip)
-            current_time += chunk_duration
-    
-    watermark = TextClip(
-        "This video uses only consented customer data",
-        fontsize=20,
-        color='white',
-        font='Arial',
-        bg_color='black',
-        size=(1280, 50),
-        method='caption',
-        align='center'
-    ).set_position(('center', 670)).set_duration(audio_duration)
-    
-    # Download and prepare background video
-    download_youtube_video(YOUTUBE_URL, TEMP_VIDEO_FILE)
-    background_base = VideoFileClip(str(TEMP_VIDEO_FILE)).without_audio().resize((1280, 720))  # Convert Path to string
-    background = concatenate_videoclips([background_base] * (int(audio_duration // background_base.duration) + 1)).subclip(0, audio_duration)
-    
-    # Add background music
-    background_music = AudioFileClip(str(BACKGROUND_MUSIC_FILE)).subclip(0, audio_duration).volumex(0.15)  # Convert Path to string
-    final_audio = CompositeAudioClip([narration_audio, background_music])
-    
-    # Create and save video
-    video = CompositeVideoClip([background] + text_clips + [watermark], size=(1280, 720)).set_duration(audio_duration).set_audio(final_audio)
-    video.write_videofile(str(VIDEO_OUTPUT_FILE), fps=24, codec='libx264', audio_codec='aac')  # Convert Path to string
-    
-    # Clean up resources
-    narration_audio.close()
-    background_base.close()
-    background.close()
-    background_music.close()
-    video.close()
-    for clip in text_clips:
-        clip.close()
-    watermark.close()
-    
-    # Extended cleanup to handle misplaced file
-    temp_files = [TEMP_AUDIO_FILE, TEMP_VIDEO_FILE, BASE_DIR / 'temp_background_video.mp4']
-    for temp_file in temp_files:
-        temp_file_str = str(temp_file)
-        retries = 5
-        while retries > 0:
+            texts.append("\n".join(wrapped_lines[i:i+2]))
+    
+    word_counts = [len(two_lines.split()) for two_lines in texts]
+    if word_times and len(word_times) == sum(word_counts):
+        starts, word_index = [], 0
+        for count in word_counts:
+            starts.append(word_times[word_index][1] if starts else 0.0)  # The first caption is up from the start
+            word_index += count
+        ends = starts[1:] + [audio_duration]
+        return [(two_lines, start, end - start) for two_lines, start, end in zip(texts, starts, ends)]
+    
+    chunks = []
+    current_time = 0
+    for two_lines, count in zip(texts, word_counts):
+        chunk_duration = audio_duration / len(recommendations_text.split()) * count
+        chunks.append((two_lines, current_time, chunk_duration))
+        current_time += chunk_duration
+    return chunks
+
+def generate_video(recommendation_text, job_id=None, timings=None):
+    # RENDER_BACKEND picks the compositor; both write the same file and return the same link
+    if RENDER_BACKEND == 'ffmpeg':
+        return generate_video_with_ffmpeg(recommendation_text, job_id=job_id, timings=timings)
+    return generate_video_with_moviepy(recommendation_text, job_id=job_id, timings=timings)
+
+def generate_video_with_moviepy(recommendation_text, job_id=None, timings=None):
+    # Every render gets its own workspace and output file, so renders can run in parallel
+    job_id = job_id or uuid.uuid4().hex
+    workspace = TEMP_DIR / job_id
+    video_output_file = VIDEO_OUTPUT_DIR / f"{job_id}.mp4"
+    logger.info(f"Generating video with recommendation text in {workspace}...")
+    HEALTH.require('video')
+    
+    try:
+        os.makedirs(workspace, exist_ok=True)
+        # Use the provided recommendation text directly
+        recommendations_text = recommendation_text.strip()
+        logger.info(f"Narrating {len(recommendations_text.split())} words.")
+        logger.debug(f"Video content to be narrated: {recommendations_text}")
+        
+        # Generate audio
+        audio_file = workspace / 'narration.wav'
+        with timed_stage(timings, 'tts'):
+            audio_duration, word_times = TTS.synthesize(recommendations_text, audio_file)
+        logger.info(f"Audio duration: {audio_duration} seconds")
+        
+        # Narration over the cached music bed, encoded once; the video encode copies it
+        mix_file = workspace / 'mix.m4a'
+        with timed_stage(timings, 'audio'):
+            MUSIC_BED.mix(audio_file, BACKGROUND_MUSIC_FILE, mix_file)
+        
+        # Generate text clips
+        with timed_stage(timings, 'captions'):
+            text_clips = [
+                CAPTIONS.clip(two_lines, **CAPTION_STYLE).set_position(('center', CAPTION_Y)).set_duration(chunk_duration).set_start(chunk_start)
+                for two_lines, chunk_start, chunk_duration in caption_chunks(recommendations_text, audio_duration, word_times)
+            ]
+            watermark = CAPTIONS.clip(WATERMARK_TEXT, **WATERMARK_STYLE).set_position(('center', WATERMARK_Y)).set_duration(audio_duration)
+        
+        # Background comes from the proxy cache, already silent and at the render size
+        with timed_stage(timings, 'background'):
+            background_base = mpy.VideoFileClip(str(BACKGROUND_ASSETS.proxy_path(BACKGROUND_VIDEO_FILE or YOUTUBE_URL)))  # Convert Path to string
+            background = mpy.concatenate_videoclips([background_base] * (int(audio_duration // background_base.duration) + 1)).subclip(0, audio_duration)
+        
+        # Create and save video
+        video = mpy.CompositeVideoClip([background] + text_clips + [watermark], size=VIDEO_SIZE).set_duration(audio_duration)
+        with timed_stage(timings, 'encode'):
+            video.write_videofile(str(video_output_file), fps=VIDEO_FPS, codec='libx264', audio=str(mix_file))  # Convert Path to string
+        
+        # Clean up resources
+        background_base.close()
+        background.close()
+        video.close()
+        for clip in text_clips:
+            clip.close()
+        watermark.close()
+    finally:
+        # The background proxy stays cached; only the render workspace is removed
+        remove_render_workspace(workspace)
+    
+    logger.info(f"Video generated and saved as {video_output_file}")
+    video_link = f"/static/videos/{job_id}.mp4" if os.path.exists(str(video_output_file)) else None  # Convert Path to string
+    emit_event('video_link', {'link': video_link})
+    return video_link
+
+def ffmpeg_binary():
+    return FFMPEG_BINARY or moviepy_config.get_setting('FFMPEG_BINARY')
+
+def build_ffmpeg_command(background, audio, captions, watermark, audio_duration, output_file):
+    # One filter graph: looped background, timed caption overlays, watermark; the premixed AAC track is copied
+    command = [ffmpeg_binary(), '-y', '-loglevel', 'error',
+               '-stream_loop', '-1', '-i', str(background),  # Convert Path to string
+               '-i', str(audio),
+               '-i', str(watermark)]
+    filters = []
+    video_label = '0:v'
+    for i, (png, chunk_start, chunk_duration) in enumerate(captions):
+        command += ['-i', str(png)]
+        filters.append(f"[{video_label}][{i + 3}:v]overlay=0:{CAPTION_Y}:enable='between(t,{chunk_start:.3f},{chunk_start + chunk_duration:.3f})'[v{i}]")
+        video_label = f"v{i}"
+    filters.append(f"[{video_label}][2:v]overlay=0:{WATERMARK_Y},format=yuv420p[vout]")
+    command += ['-filter_complex', ';'.join(filters),
+                '-map', '[vout]', '-map', '1:a', '-t', f"{audio_duration:.3f}", '-r', str(VIDEO_FPS),
+                '-c:v', 'libx264', '-c:a', 'copy', '-movflags', '+faststart', str(output_file)]
+    return command
+
+def generate_video_with_ffmpeg(recommendation_text, job_id=None, timings=None):
+    # Same video as generate_video_with_moviepy, composited and encoded by a single ffmpeg process
+    job_id = job_id or uuid.uuid4().hex
+    workspace = TEMP_DIR / job_id
+    video_output_file = VIDEO_OUTPUT_DIR / f"{job_id}.mp4"
+    logger.info(f"Generating video with ffmpeg in {workspace}...")
+    HEALTH.require('video')
+    
+    try:
+        os.makedirs(workspace, exist_ok=True)
+        recommendations_text = recommendation_text.strip()
+        logger.info(f"Narrating {len(recommendations_text.split())} words.")
+        logger.debug(f"Video content to be narrated: {recommendations_text}")
+        
+        audio_file = workspace / 'narration.wav'
+        with timed_stage(timings, 'tts'):
+            audio_duration, word_times = TTS.synthesize(recommendations_text, audio_file)
+        logger.info(f"Audio duration: {audio_duration} seconds")
+        
+        mix_file = workspace / 'mix.m4a'
+        with timed_stage(timings, 'audio'):
+            MUSIC_BED.mix(audio_file, BACKGROUND_MUSIC_FILE, mix_file)
+        
+        # Caption sprites go to disk as PNGs for the overlay filter
+        with timed_stage(timings, 'captions'):
+            captions = []
+            for i, (two_lines, chunk_start, chunk_duration) in enumerate(caption_chunks(recommendations_text, audio_duration, word_times)):
+                png = workspace / f"caption_{i}.png"
+                Image.fromarray(CAPTIONS.sprite(two_lines, **CAPTION_STYLE)).save(png)
+                captions.append((png, chunk_start, chunk_duration))
+            watermark = workspace / 'watermark.png'
+            Image.fromarray(CAPTIONS.sprite(WATERMARK_TEXT, **WATERMARK_STYLE)).save(watermark)
+        
+        with timed_stage(timings, 'background'):
+            background = BACKGROUND_ASSETS.proxy_path(BACKGROUND_VIDEO_FILE or YOUTUBE_URL)
+        
+        command = build_ffmpeg_command(background, mix_file, captions, watermark, audio_duration, video_output_file)
+        with timed_stage(timings, 'encode'):
+            result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            logger.error(f"ffmpeg failed with exit code {result.returncode}: {result.stderr[-2000:]}")
+            raise RuntimeError(f"ffmpeg failed with exit code {result.returncode}")
+    finally:
+        remove_render_workspace(workspace)
+    
+    logger.info(f"Video generated and saved as {video_output_file}")
+    video_link = f"/static/videos/{job_id}.mp4" if os.path.exists(str(video_output_file)) else None  # Convert Path to string
+    emit_event('video_link', {'link': video_link})
+    return video_link
+
+def register_render_process(pids):
+    # Pool initializer: tells the farm which processes belong to the pool so a hung one can be killed
+    pids.put(os.getpid())
+
+def render_worker(recommendation_text, job_id):
+    # Entry point inside a render process; returns the video link and per-stage timings
+    timings = {}
+    start = time.perf_counter()
+    video_link = generate_video(recommendation_text, job_id=job_id, timings=timings)
+    timings['total'] = time.perf_counter() - start
+    return video_link, timings
+
+def summarize_timings(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        'count': len(samples),
+        'mean': round(sum(samples) / len(samples), 3),
+        'p50': round(samples[len(samples) // 2], 3),
+        'p95': round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 3),
+        'max': round(samples[-1], 3),
+    }
+
+class RenderFarm:
+    # Fans renders out to a pool of worker processes. At most queue_size renders are accepted at once
+    # (submit blocks or raises queue.Full beyond that); a render that times out or takes its process down
+    # gets the pool replaced and is retried, without affecting the web process. Renders that were only
+    # caught in another render's timeout are resubmitted without using up their own retries.
+    # Throughput and utilization are reported over the last report_window seconds.
+    def __init__(self, processes, queue_size, timeout, retries, window=2048, report_window=RENDER_REPORT_WINDOW):
+        self.processes = processes
+        self.timeout = timeout
+        self.retries = retries
+        self.window = window
+        self.report_window = report_window
+        self._queue_slots = threading.BoundedSemaphore(queue_size)
+        self._process_slots = threading.BoundedSemaphore(max(1, processes))
+        self._supervisors = ThreadPoolExecutor(max_workers=queue_size, thread_name_prefix='render')
+        self._pool = None
+        self._pool_pids = weakref.WeakKeyDictionary()  # pool -> queue its processes put their pid on
+        self._pool_lock = threading.Lock()
+        self._killed_pools = weakref.WeakSet()  # Pools taken down on purpose to stop a hung render
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.stats = {'completed': 0, 'failed': 0, 'retried': 0, 'requeued': 0, 'first_submit': None, 'stages': {}}
+        self._finished_at = deque(maxlen=self.window)  # Completion times of recent renders
+        self._busy = deque(maxlen=self.window)  # (start, end) of recent render attempts
+        self._running = {}  # attempt id -> start, for attempts still in a process
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                context = multiprocessing.get_context('spawn')
+                pids = context.SimpleQueue()
+                self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context, initializer=register_render_process, initargs=(pids,))
+                self._pool_pids[self._pool] = pids
+            return self._pool
+
+    def _replace_pool(self, broken_pool, hung=False):
+        with self._pool_lock:
+            if self._pool is not broken_pool:
+                return  # Another render already replaced it
+            self._pool = None
+            if hung:
+                self._killed_pools.add(broken_pool)
+            pids = self._pool_pids.pop(broken_pool, None)
+        if hung and pids is not None:
+            while not pids.empty():
+                try:
+                    os.kill(pids.get(), getattr(signal, 'SIGKILL', signal.SIGTERM))  # A hung encode never returns on its own
+                except OSError:
+                    pass  # Already gone
+        broken_pool.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, recommendation_text, job_id, block=True, timeout=None):
+        acquired = self._queue_slots.acquire(blocking=block, timeout=timeout if block else None)
+        if not acquired:
+            raise queue.Full("Render queue is full.")
+        with self._stats_lock:
+            self.stats['first_submit'] = self.stats['first_submit'] or time.perf_counter()
+        # The render's stage timings come back from the worker process and are attached to the caller's span
+        future = self._supervisors.submit(self._render_with_retries, recommendation_text, job_id, TRACER.current())
+        future.add_done_callback(lambda _: self._queue_slots.release())
+        return future
+
+    def render(self, recommendation_text, job_id):
+        return self.submit(recommendation_text, job_id).result()
+
+    @contextmanager
+    def _attempt(self):
+        # Counts the enclosed render as busy process time for the utilization figure
+        attempt = uuid.uuid4().hex
+        with self._stats_lock:
+            self._running[attempt] = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._stats_lock:
+                self._busy.append((self._running.pop(attempt), time.perf_counter()))
+
+    def _render_with_retries(self, recommendation_text, job_id, span=None):
+        if self.processes <= 0:
+            with self._attempt():
+                result = render_worker(recommendation_text, job_id)
+            return self._finish(*result, span)
+        
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                with self._stats_lock:
+                    self.stats['retried'] += 1
+                logger.warning(f"Retrying render for job {job_id} (attempt {attempt + 1}/{self.retries + 1})")
             try:
-                if os.path.exists(temp_file_str):
-                    os.remove(temp_file_str)
-                    logger.info(f"Deleted temporary file: {temp_file_str}")
-                break
-            except PermissionError as e:
-                logger.warning(f"Failed to delete {temp_file_str}: {e}. Retrying in 1 second...")
-                time.sleep(1)
-                retries -= 1
+                return self._finish(*self._render_in_pool(recommendation_text, job_id), span)
+            except TimeoutError as e:
+                last_error = e
+                logger.error(str(e))
+            except BrokenProcessPool as e:
+                last_error = e
+                logger.error(f"Render process for job {job_id} crashed: {e}")
             except Exception as e:
-                logger.error(f"Error deleting {temp_file_str}: {e}")
-                raise
-        if retries == 0:
-            logger.warning(f"Could not delete {temp_file_str} after retries. File may still be in use.")
-    
-    logger.info(f"Video generated and saved as {VIDEO_OUTPUT_FILE}")
-    socketio.emit('video_link', {'link': f"/static/recommendations_video.mp4" if os.path.exists(str(VIDEO_OUTPUT_FILE)) else None})  # Convert Path to string
+                last_error = e
+                logger.error(f"Render for job {job_id} failed: {e}")
+        
+        with self._stats_lock:
+            self.stats['failed'] += 1
+        raise RuntimeError(f"Render for job {job_id} failed after {self.retries + 1} attempts: {last_error}")
+
+    def _render_in_pool(self, recommendation_text, job_id):
+        # One attempt: returns render_worker's (video_link, timings)
+        BACKGROUND_ASSETS.proxy_path(BACKGROUND_VIDEO_FILE or YOUTUBE_URL)  # Warm once here rather than in every process
+        while True:
+            with self._process_slots:
+                pool = self._executor()
+                try:
+                    with self._attempt():
+                        return pool.submit(render_worker, recommendation_text, job_id).result(timeout=self.timeout)
+                except FutureTimeoutError:
+                    self._replace_pool(pool, hung=True)
+                    raise TimeoutError(f"Render for job {job_id} exceeded {self.timeout} seconds")
+                except BrokenProcessPool:
+                    if pool not in self._killed_pools:
+                        self._replace_pool(pool)
+                        raise
+            with self._stats_lock:
+                self.stats['requeued'] += 1
+            logger.warning(f"Render for job {job_id} was stopped by another render's timeout; resubmitting.")
+
+    def _finish(self, video_link, timings, span=None):
+        TRACER.add_timings(timings, span)
+        with self._stats_lock:
+            self.stats['completed'] += 1
+            self._finished_at.append(time.perf_counter())
+            for stage, seconds in timings.items():
+                self.stats['stages'].setdefault(stage, deque(maxlen=self.window)).append(seconds)
+        return video_link
+
+    def report(self):
+        now = time.perf_counter()
+        with self._stats_lock:
+            stats = dict(self.stats)
+            stages = {stage: summarize_timings(samples) for stage, samples in stats['stages'].items()}
+            since = max(now - self.report_window, stats['first_submit'] or now)
+            finished = sum(1 for finished_at in self._finished_at if finished_at >= since)
+            periods = list(self._busy) + [(start, now) for start in self._running.values()]
+            active = len(self._running)
+        window = now - since
+        busy = sum(max(0.0, end - max(start, since)) for start, end in periods)
+        return {
+            'processes': self.processes,
+            'completed': stats['completed'],
+            'failed': stats['failed'],
+            'retried': stats['retried'],
+            'requeued': stats['requeued'],
+            'active': active,
+            'window_seconds': round(window, 2),
+            'videos_per_minute': round(finished / window * 60, 2) if window else 0.0,
+            'utilization': round(busy / (window * max(1, self.processes)), 3) if window else 0.0,
+            'stage_seconds': stages,
+        }
+
+RENDER_FARM = RenderFarm(RENDER_PROCESSES, RENDER_QUEUE_SIZE, RENDER_TIMEOUT, RENDER_RETRIES, TRACE_WINDOW)
+
+class Job:
+    def __init__(self, system_prompt, customer_id, bypass_cache=False):
+        self.job_id = uuid.uuid4().hex
+        self.system_prompt = system_prompt
+        self.customer_id = customer_id
+        self.bypass_cache = bypass_cache
+        self.status = 'queued'
+        self.recommendation = None
+        self.video_link = None
+        self.error = None
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        self.done = threading.Event()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'customer_id': self.customer_id,
+            'status': self.status,
+            'recommendation': self.recommendation,
+            'video_link': self.video_link,
+            'error': self.error,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at,
+        }
+
+class JobManager:
+    # Runs each request as a job: the text stage on one pool, then the video stage on another.
+    # State changes are pushed to the job's Socket.IO room and kept for /jobs/<id>.
+    def __init__(self, text_workers, video_workers, history):
+        self.history = history
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._text_executor = ThreadPoolExecutor(max_workers=text_workers, thread_name_prefix='job-text')
+        self._video_executor = ThreadPoolExecutor(max_workers=video_workers, thread_name_prefix='job-video')
+
+    def submit(self, system_prompt, customer_id, bypass_cache=False, session_id=None):
+        job = Job(system_prompt, customer_id, bypass_cache)
+        if session_id:
+            # Subscribe the submitting client before any job event is emitted; a sid that is not (or no
+            # longer) connected just means nobody is watching the live log
+            try:
+                socketio.server.enter_room(session_id, job.job_id, namespace='/')
+            except (ValueError, KeyError):
+                logger.warning(f"Session {session_id} is not connected; job {job.job_id} has no live log room.")
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._evict()
+        logger.info(f"Queued job {job.job_id} for Customer ID: {customer_id}")
+        self._text_executor.submit(self._run_stage, job, self._recommendation_stage)
+        return job
 
-def generate_recommendations(system_prompt, customer_id):
+    def _evict(self):
+        # Drops the oldest finished jobs beyond the history cap; queued and running jobs are kept even if
+        # that leaves the history over the cap for a while, so their status stays reachable
+        excess = len(self._jobs) - self.history
+        if excess <= 0:
+            return
+        finished = []
+        for job_id, job in self._jobs.items():
+            if job.done.is_set():
+                finished.append(job_id)
+                if len(finished) == excess:
+                    break
+        for job_id in finished:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def wait(self, job_id, timeout=None):
+        job = self.get(job_id)
+        return job is not None and job.done.wait(timeout)
+
+    def _update(self, job, **fields):
+        for key, value in fields.items():
+            setattr(job, key, value)
+        job.updated_at = time.time()
+        emit_event('job_status', job.to_dict())
+
+    def _run_stage(self, job, stage):
+        # Both stages of a job land in the same trace, rooted at recommendation_stage / video_stage
+        with event_room(job.job_id), TRACER.span(stage.__name__.strip('_'), trace_id=job.job_id):
+            try:
+                stage(job)
+            except Exception as e:
+                logger.error(f"Job {job.job_id} failed: {e}")
+                if stage == self._video_stage:
+                    emit_event('video_link', {'link': None})
+                self._update(job, status='failed', error=str(e))
+                job.done.set()
+
+    def _recommendation_stage(self, job):
+        self._update(job, status='generating_recommendation')
+        recommendations = generate_recommendations(job.system_prompt, job.customer_id, bypass_cache=job.bypass_cache)
+        recommendation = recommendations[0] if recommendations else None
+        if not recommendation or "Error" in recommendation:
+            self._update(job, status='failed', recommendation=recommendation, error=recommendation or "No recommendation generated")
+            job.done.set()
+            return
+        if TEXT_ONLY:
+            self._update(job, status='completed', recommendation=recommendation)
+            job.done.set()
+            return
+        self._update(job, status='rendering_video', recommendation=recommendation)
+        self._video_executor.submit(self._run_stage, job, self._video_stage)
+
+    def _video_stage(self, job):
+        with TRACER.span('render'):
+            video_link = RENDER_FARM.render(job.recommendation, job.job_id)
+        emit_event('video_link', {'link': video_link})
+        try:
+            prune_output_videos(keep=VIDEO_OUTPUT_DIR / f"{job.job_id}.mp4")
+        except OSError as e:
+            logger.warning(f"Could not prune old videos: {e}")
+        self._update(job, status='completed', video_link=video_link)
+        job.done.set()
+
+JOB_MANAGER = JobManager(JOB_WORKERS, VIDEO_WORKERS, JOB_HISTORY)
+
+def generate_recommendations(system_prompt, customer_id, bypass_cache=False):
     logger.info(f"Starting recommendation generation for Customer ID: {customer_id}...")
     try:
-        check_prerequisites()
-        data = load_data(INPUT_FILE_TRANSACTIONS, INPUT_FILE_PROFILE, INPUT_FILE_TWITTER, customer_id)
+        HEALTH.require('text')
+        with TRACER.span('load_data'):
+            data = load_data(INPUT_FILE_TRANSACTIONS, INPUT_FILE_PROFILE, INPUT_FILE_TWITTER, customer_id)
         data['consent_social_media'] = data['consent_social_media'].astype(bool).fillna(False)
         
         recommendations = []
         logger.info(f"Processing Customer ID: {customer_id}")
-        user_prompt = generate_user_prompt(customer_id, data)
-        recommendation = get_recommendation(system_prompt, user_prompt)
+        with TRACER.span('prompt'):
+            user_prompt = generate_user_prompt(customer_id, data)
+        recommendation = get_recommendation(system_prompt, user_prompt, bypass_cache=bypass_cache)
         recommendations.append(recommendation.strip())
         
         # Write to file for consistency and debugging
         with open(str(OUTPUT_FILE), 'w') as f:  # Convert Path to string
             f.write(recommendation)
-        logger.info(f"Written to {OUTPUT_FILE}: {recommendation}")
+        logger.info(f"Written to {OUTPUT_FILE}.")
         
-        socketio.emit('recommendations_complete', {'content': recommendation})
+        emit_event('recommendations_complete', {'content': recommendation})
         return recommendations
     except Exception as e:
         logger.error(f"Recommendation generation failed: {e}")
-        socketio.emit('recommendations_complete', {'content': f"Error: {str(e)}"})
+        emit_event('recommendations_complete', {'content': f"Error: {str(e)}"})
         return [f"Error: {str(e)}"]
 
 def generate_all_recommendations_and_video():
@@ -790,20 +2869,238 @@ def generate_all_recommendations_and_video():
     logger.info(f"CLI mode system prompt: {system_prompt}")
     
     try:
-        recommendations = generate_recommendations(system_prompt, customer_id)
-        if recommendations and "Error" not in recommendations[0]:
-            generate_video_with_moviepy(recommendations[0])
+        with TRACER.span('cli', trace_id=uuid.uuid4().hex):
+            recommendations = generate_recommendations(system_prompt, customer_id)
+            if recommendations and "Error" not in recommendations[0] and not TEXT_ONLY:
+                timings = {}
+                with TRACER.span('render') as render_span:
+                    video_link = generate_video(recommendations[0], timings=timings)
+                    TRACER.add_timings(timings, render_span)
+                if video_link:
+                    prune_output_videos(keep=VIDEO_OUTPUT_DIR / Path(video_link).name)
         logger.info("Process completed successfully.")
     except Exception as e:
         logger.error(f"Script failed: {e}")
         sys.exit(1)
 
+def read_customer_ids(customer_ids_file):
+    with open(customer_ids_file, 'r') as f:
+        customer_ids = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    return list(dict.fromkeys(customer_ids))  # Drop duplicates, keep file order
+
+def load_batch_data(transactions_file_path, profile_file_path, twitter_file_path, customer_ids=None):
+    # Aggregates the three sources to one row per customer once for the whole batch and indexes the result
+    transactions_data = DATA_STORE.get(transactions_file_path, 'transactions', require_ids=True)
+    profile_data = DATA_STORE.get(profile_file_path, 'profile')
+    twitter_data = DATA_STORE.get(twitter_file_path, 'twitter')
+    
+    if 'consent' not in transactions_data.columns:
+        logger.error("All customers in transactions file must have provided explicit consent.")
+        raise ValueError("Missing or invalid consent in transactions file.")
+    if customer_ids is not None:
+        wanted = set(customer_ids)
+        transactions_data = transactions_data[transactions_data['customer id'].isin(wanted)]
+        profile_data = profile_data[profile_data['customer id'].isin(wanted)]
+        twitter_data = twitter_data[twitter_data['customer id'].isin(wanted)]
+    if 'consent_social_media' not in transactions_data.columns:
+        transactions_data = transactions_data.assign(consent_social_media=False)
+    
+    combined_data = aggregate_customer_features(transactions_data, profile_data, twitter_data)
+    consented = combined_data.set_index('customer id')['consent']
+    logger.info(f"Batch features built for {len(combined_data)} customers from {len(transactions_data)} transactions.")
+    return CustomerIndex(combined_data), consented
+
+def read_batch_checkpoint(output_path):
+    # Customers already finished in a previous run; errors are retried on resume
+    completed = set()
+    if not Path(output_path).is_file():
+        return completed
+    with open(output_path, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # Partially written line from an interrupted run
+            if record.get('status') == 'error':
+                completed.discard(record.get('customer_id'))
+            else:
+                completed.add(record.get('customer_id'))
+    return completed
+
+def write_batch_parquet(jsonl_path, parquet_path):
+    records = pd.read_json(jsonl_path, lines=True, dtype={'customer_id': str})
+    records = records.drop_duplicates('customer_id', keep='last')
+    records.to_parquet(parquet_path, index=False)
+    logger.info(f"Wrote {len(records)} batch records to {parquet_path}")
+
+def batch_recommendation(system_prompt, user_prompt, record):
+    try:
+        recommendation = get_recommendation(system_prompt, user_prompt, stream=False).strip()
+        if recommendation == API_ERROR_RECOMMENDATION:
+            return {**record, 'status': 'error', 'error': recommendation}
+        return {**record, 'recommendation': recommendation}
+    except Exception as e:
+        logger.error(f"Batch recommendation failed for Customer ID {record['customer_id']}: {e}")
+        return {**record, 'status': 'error', 'error': str(e)}
+
+def run_batch(system_prompt, customer_ids=None, output_path=BATCH_OUTPUT_FILE, output_format='jsonl'):
+    output_path = Path(output_path)
+    HEALTH.require('text')
+    data, consented = load_batch_data(INPUT_FILE_TRANSACTIONS, INPUT_FILE_PROFILE, INPUT_FILE_TWITTER, customer_ids)
+    if customer_ids is None:
+        customer_ids = consented[consented].index.tolist()
+        logger.info(f"Batch covers all {len(customer_ids)} consented customers.")
+    
+    completed = read_batch_checkpoint(output_path)
+    pending = [customer_id for customer_id in customer_ids if customer_id not in completed]
+    logger.info(f"Batch: {len(customer_ids)} customers, {len(customer_ids) - len(pending)} already done, {len(pending)} pending.")
+    
+    summary = {'ok': 0, 'skipped': 0, 'error': 0}
+    start = time.perf_counter()
+    os.makedirs(output_path.parent, exist_ok=True)
+    with open(output_path, 'a') as out:
+        def write_record(record):
+            record['generated_at'] = datetime.now(timezone.utc).isoformat()
+            out.write(json.dumps(record) + '\n')
+            out.flush()  # Each line is a checkpoint for resuming
+            summary[record['status']] += 1
+            done = sum(summary.values())
+            if done % 100 == 0:
+                logger.info(f"Batch progress: {done}/{len(pending)} customers ({done / (time.perf_counter() - start):.1f}/s)")
+        
+        # Prompts are built for the whole batch up front; completions run on the LLM pool with a bounded number in flight
+        try:
+            prompts = build_user_prompts(data, [customer_id for customer_id in pending if customer_id in data and consented.get(customer_id, False)])
+        except Exception as e:
+            logger.error(f"Batch prompt building failed, falling back to one customer at a time: {e}")
+            prompts = {}
+        in_flight = set()
+        for customer_id in pending:
+            record = {'customer_id': customer_id, 'status': 'ok', 'recommendation': None, 'error': None}
+            if customer_id not in data:
+                write_record({**record, 'status': 'skipped', 'error': f"No data found for Customer ID {customer_id}"})
+                continue
+            if not consented.get(customer_id, False):
+                write_record({**record, 'status': 'skipped', 'error': f"Skipping {customer_id} due to lack of consent."})
+                continue
+            try:
+                user_prompt = prompts[customer_id] if customer_id in prompts else generate_user_prompt(customer_id, data)
+            except Exception as e:
+                logger.error(f"Batch prompt failed for Customer ID {customer_id}: {e}")
+                write_record({**record, 'status': 'error', 'error': str(e)})
+                continue
+            
+            if len(in_flight) >= LLM_MAX_CONCURRENCY * 2:
+                finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    write_record(future.result())
+            in_flight.add(LLM_POOL.submit(batch_recommendation, system_prompt, user_prompt, record))
+        
+        for future in wait(in_flight).done:
+            write_record(future.result())
+    
+    if output_format == 'parquet':
+        write_batch_parquet(output_path, output_path.with_suffix('.parquet'))
+    logger.info(f"Batch finished in {time.perf_counter() - start:.1f} seconds: {summary}")
+    return summary
+
+def run_video_batch(records_path):
+    # Renders a video for every successful recommendation in a batch output; resumable like run_batch
+    records_path = Path(records_path)
+    videos_path = records_path.with_suffix('.videos.jsonl')
+    report_path = records_path.with_suffix('.render_report.json')
+    records = {}
+    with open(records_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get('status') == 'ok' and record.get('recommendation'):
+                records[record['customer_id']] = record['recommendation']  # Last line for a customer wins
+    
+    rendered = read_batch_checkpoint(videos_path)
+    pending = [customer_id for customer_id in records if customer_id not in rendered]
+    logger.info(f"Video batch: {len(records)} recommendations, {len(pending)} to render on {RENDER_FARM.processes} processes.")
+    
+    summary = {'ok': 0, 'error': 0}
+    with open(videos_path, 'a') as out:
+        def write_record(customer_id, future):
+            record = {'customer_id': customer_id, 'status': 'ok', 'video_link': None, 'error': None}
+            try:
+                record['video_link'] = future.result()
+            except Exception as e:
+                record.update(status='error', error=str(e))
+            record['rendered_at'] = datetime.now(timezone.utc).isoformat()
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+            summary[record['status']] += 1
+        
+        # submit() blocks once RENDER_QUEUE_SIZE renders are outstanding
+        started = time.perf_counter()
+        futures = {}
+        for customer_id in pending:
+            job_id = re.sub(r'[^A-Za-z0-9_-]', '_', f"batch-{customer_id}")
+            futures[RENDER_FARM.submit(records[customer_id], job_id)] = customer_id
+        for future in wait(futures).done:
+            write_record(futures[future], future)
+    
+    # Throughput for this batch as a whole rather than the farm's recent window
+    elapsed = time.perf_counter() - started
+    summary['wall_seconds'] = round(elapsed, 2)
+    summary['videos_per_minute'] = round(summary['ok'] / elapsed * 60, 2) if elapsed and summary['ok'] else 0.0
+    report = {**RENDER_FARM.report(), **summary}
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info(f"Video batch finished: {report['ok']} videos at {report['videos_per_minute']}/min, report in {report_path}")
+    return report
+
+def run_batch_cli(argv):
+    parser = argparse.ArgumentParser(prog='main.py --batch', description="Generate recommendations for many customers.")
+    parser.add_argument('--customers', help="File with one customer ID per line (default: all consented customers)")
+    parser.add_argument('--output', default=str(BATCH_OUTPUT_FILE), help="JSONL output; also the resume checkpoint")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--categories', default="Consumer and Small Business Banking")
+    parser.add_argument('--video', action='store_true', help="Also render a video per recommendation on the render farm")
+    args = parser.parse_args(argv)
+    
+    if args.video and TEXT_ONLY:
+        parser.error("--video is not available in text-only mode.")
+    customer_ids = read_customer_ids(args.customers) if args.customers else None
+    system_prompt = DEFAULT_SYSTEM_PROMPT.replace("check_box_selection", args.categories)
+    try:
+        summary = run_batch(system_prompt, customer_ids, args.output, args.format)
+        if args.video:
+            summary['error'] += run_video_batch(args.output)['error']
+    except Exception as e:
+        logger.error(f"Batch failed: {e}")
+        sys.exit(1)
+    if summary['error']:
+        sys.exit(2)
+
+IMPORT_SECONDS = time.perf_counter() - IMPORT_STARTED
+logger.info(f"Module imported in {IMPORT_SECONDS:.2f} seconds.")
+
 if __name__ == "__main__":
+    if '--text-only' in sys.argv:
+        sys.argv.remove('--text-only')
+        TEXT_ONLY = True
+        LAZY_IMPORTS.disable(*VIDEO_SUBSYSTEMS)
     if len(sys.argv) > 1 and sys.argv[1] == "--cli":
         logger.info("Script started in command-line mode.")
         generate_all_recommendations_and_video()
+    elif len(sys.argv) > 1 and sys.argv[1] == "--batch":
+        logger.info("Script started in batch mode.")
+        run_batch_cli(sys.argv[2:])
     else:
-        logger.info("Starting Flask-SocketIO server...")
+        HEALTH.start()
+        try:
+            DATA_STORE.preload(DATA_SOURCES)
+            DATA_STORE.features(INPUT_FILE_TRANSACTIONS, INPUT_FILE_PROFILE, INPUT_FILE_TWITTER)
+        except Exception as e:
+            logger.warning(f"Customer data preload failed, will load on first request: {e}")
+        PROMPT_BUDGET.load_encoding()
+        logger.info(f"Starting Flask-SocketIO server{' in text-only mode' if TEXT_ONLY else ''}...")
         url = "http://127.0.0.1:5000"
         webbrowser.open(url)
         socketio.run(app, host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,455 @@
+"""Benchmarks for the recommendation and video pipeline.
+
+The full suite generates synthetic encrypted workbooks, serves completions from the stub LLM in
+fake_llm_server.py, narrates with a generated tone over generated background assets, and writes the
+results as JSON:
+
+    python code/test/benchmark.py suite --transactions 100000 --customers 10000 --latency-ms 300
+    python code/test/benchmark.py suite --transactions 100000 --customers 10000 --baseline previous.json
+
+It measures load_data (cold decrypt + parse, snapshot reload, per-customer lookups), generate_user_prompt
+and build_user_prompts, generate_recommendations end to end, and generate_video_with_moviepy. With
+--baseline it exits non-zero when a latency grew or a throughput dropped by more than --tolerance.
+Workbooks are cached per scale and seed under artifacts/benchmarks/data. The app reads the first sheet of
+each workbook only, so --transactions is capped at Excel's 1,048,575 data rows per sheet.
+
+Track cold-start time (importing main in a fresh interpreter, full and with TEXT_ONLY):
+
+    python code/test/benchmark.py startup --runs 5
+
+Compare the MoviePy and single-pass ffmpeg backends on the same narration, captions and background:
+
+    python code/test/benchmark.py render --runs 3 --backends moviepy ffmpeg --stub-tts
+
+--stub-tts replaces pyttsx3 with a tone of the same rough length so only compositing and encoding
+are measured (and so it runs on machines without a speech engine). CPU time includes child
+processes, which is where ffmpeg does its work for both backends.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from msoffcrypto.format.ooxml import OOXMLFile
+
+from fake_llm_server import start_server
+
+SRC_DIR = Path(__file__).resolve().parent.parent / 'src'
+BENCHMARK_DIR = SRC_DIR.parent / 'artifacts' / 'benchmarks'
+BENCHMARK_PASSWORD = 'benchmark'  # Synthetic data only
+EXCEL_MAX_DATA_ROWS = 1_048_575  # 1,048,576 rows per sheet, one of them the header
+
+CATEGORIES = ['Groceries', 'Dining', 'Travel', 'Fuel', 'Rent', 'Utilities', 'Shopping', 'Healthcare', 'Education', 'Entertainment']
+PROFESSIONS = ['Teacher', 'Nurse', 'Engineer', 'Accountant', 'Student', 'Retired', 'Small Business Owner', 'Sales Manager']
+LOCATIONS = ['San Francisco', 'Charlotte', 'Phoenix', 'Minneapolis', 'Des Moines', 'Dallas']
+TWEETS = [
+    ("Loving the new mobile deposit feature, saved me a trip today", 'positive'),
+    ("Still waiting on my home loan approval, the process is slow", 'negative'),
+    ("Planning a trip to Europe next summer, need a card without foreign fees", 'neutral'),
+    ("Paid off my car loan early this month", 'positive'),
+]
+
+SAMPLE_RECOMMENDATION = (
+    "Hello Customer, This message is from your Investment Advisor Jeremy Porter\n"
+    "Wellsfargo would like to recommend you few products\n\n"
+    "1. Wells Fargo Everyday Checking keeps your daily banking simple with mobile deposits and Zelle. "
+    "2. Wells Fargo Way2Save Savings builds your savings automatically with every purchase. "
+    "3. Wells Fargo Active Cash Card earns unlimited cash rewards on everything you buy."
+)
+
+
+class StubTTSEngine:
+    # Writes a 220 Hz tone at roughly 140 words per minute instead of speaking
+    sample_rate = 22050
+
+    def __init__(self):
+        self._queue = []
+
+    def setProperty(self, name, value):
+        pass
+
+    def save_to_file(self, text, path):
+        self._queue.append((text, path))
+
+    def runAndWait(self):
+        for text, path in self._queue:
+            t = np.arange(int(self.sample_rate * len(text.split()) * 60 / 140)) / self.sample_rate
+            pcm = (np.sin(2 * np.pi * 220 * t) * 8000).astype('<i2')
+            with wave.open(str(path), 'wb') as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(self.sample_rate)
+                f.writeframes(pcm.tobytes())
+        self._queue = []
+
+
+def synthetic_frames(transactions, customers, seed=0):
+    # Every customer gets at least one transaction and a profile row; roughly half have one to three tweets
+    if not 0 < customers <= transactions:
+        raise ValueError("Need at least one customer and no more customers than transactions.")
+    rng = np.random.default_rng(seed)
+    customer_ids = np.array([f"CUST{i:07d}" for i in range(customers)])
+    first_names = rng.choice(['Ann', 'Bob', 'Carla', 'Dev', 'Elena', 'Farid', 'Grace', 'Hiro'], customers)
+    social_consent = rng.random(customers) < 0.8
+    owner = rng.permutation(np.concatenate([np.arange(customers), rng.integers(0, customers, transactions - customers)]))
+
+    transactions_frame = pd.DataFrame({
+        'Customer ID': customer_ids[owner],
+        'First Name': first_names[owner],
+        'Category': rng.choice(CATEGORIES, transactions),
+        'Transaction Amount': np.round(rng.gamma(2.0, 40.0, transactions), 2),
+        'Purchase Date': pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365 * 24 * 3600, transactions), unit='s'),
+        'Consent': True,
+        'Consent_Social_Media': social_consent[owner],
+    })
+    profile_frame = pd.DataFrame({
+        'Customer ID': customer_ids,
+        'First Name': first_names,
+        'Age': rng.integers(18, 85, customers),
+        'Gender': rng.choice(['F', 'M'], customers),
+        'Income': rng.integers(20, 400, customers) * 1000,
+        'Profession': rng.choice(PROFESSIONS, customers),
+        'Location': rng.choice(LOCATIONS, customers),
+    })
+    tweeters = customer_ids[rng.random(customers) < 0.5]
+    tweet_owner = np.repeat(tweeters, rng.integers(1, 4, len(tweeters)))
+    tweet = rng.integers(0, len(TWEETS), len(tweet_owner))
+    twitter_frame = pd.DataFrame({
+        'Customer ID': tweet_owner,
+        'Tweet': [TWEETS[i][0] for i in tweet],
+        'Sentiment': [TWEETS[i][1] for i in tweet],
+    })
+    return {'transactions': transactions_frame, 'profile': profile_frame, 'twitter': twitter_frame}
+
+
+def write_encrypted_workbook(frame, path, password):
+    # Write-only openpyxl keeps memory flat for large sheets; the workbook is then encrypted the way
+    # the real input files are
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(frame.columns.tolist())
+    for row in frame.astype(object).itertuples(index=False, name=None):
+        sheet.append(row)
+    plain = BytesIO()
+    workbook.save(plain)
+    plain.seek(0)
+    temp_path = path.with_suffix('.tmp')
+    with open(temp_path, 'wb') as f:
+        OOXMLFile(plain).encrypt(password, f)
+    os.replace(temp_path, path)
+
+
+def generate_workbooks(transactions, customers, seed=0, data_dir=BENCHMARK_DIR / 'data', password=BENCHMARK_PASSWORD):
+    if transactions > EXCEL_MAX_DATA_ROWS:
+        raise ValueError(f"{transactions} transactions do not fit in one sheet (max {EXCEL_MAX_DATA_ROWS} data rows).")
+    target = Path(data_dir) / f"t{transactions}_c{customers}_s{seed}"
+    paths = {label: target / f"{label}.xlsx" for label in ('transactions', 'profile', 'twitter')}
+    if all(path.is_file() for path in paths.values()):
+        return paths
+    os.makedirs(target, exist_ok=True)
+    for label, frame in synthetic_frames(transactions, customers, seed).items():
+        write_encrypted_workbook(frame, paths[label], password)
+    return paths
+
+
+def generate_stub_assets(ffmpeg, workdir):
+    # A 10 second test pattern to loop behind the captions and two minutes of quiet tone as the music bed
+    background, music = Path(workdir) / 'background.mp4', Path(workdir) / 'music.m4a'
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=24', '-t', '10',
+                    '-pix_fmt', 'yuv420p', '-c:v', 'libx264', str(background)], check=True)
+    subprocess.run([ffmpeg, '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', 'sine=frequency=330:sample_rate=44100', '-t', '120',
+                    '-c:a', 'aac', str(music)], check=True)
+    return background, music
+
+
+def import_main():
+    # code/test/unittest.py would shadow the stdlib module, so import main with src first on the path
+    sys.path[0] = str(SRC_DIR)
+    import main
+    return main
+
+
+def cpu_seconds():
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def benchmark_render(backends, runs, stub_tts=False, text=SAMPLE_RECOMMENDATION):
+    main = import_main()
+    main.HEALTH.require = lambda capability: None  # Only the renderers are being measured
+    if stub_tts:
+        main.pyttsx3.init = StubTTSEngine
+        main.TTS.cache_dir = Path(tempfile.mkdtemp(prefix='tts_benchmark_'))  # Keep tones out of the real segment cache
+    main.BACKGROUND_ASSETS.proxy_path(main.BACKGROUND_VIDEO_FILE or main.YOUTUBE_URL)  # Warm the proxy outside the timings
+
+    results = {}
+    for backend in backends:
+        render = {'moviepy': main.generate_video_with_moviepy, 'ffmpeg': main.generate_video_with_ffmpeg}[backend]
+        walls, cpus, stages = [], [], {}
+        for run in range(runs):
+            timings = {}
+            wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+            link = render(text, job_id=f"benchmark_{backend}_{run}", timings=timings)
+            walls.append(time.perf_counter() - wall_start)
+            cpus.append(cpu_seconds() - cpu_start)
+            for stage, seconds in timings.items():
+                stages.setdefault(stage, []).append(seconds)
+            os.remove(main.VIDEO_OUTPUT_DIR / Path(link).name)
+        results[backend] = {
+            'runs': runs,
+            'wall_seconds_mean': round(sum(walls) / runs, 3),
+            'cpu_seconds_mean': round(sum(cpus) / runs, 3),
+            'stage_seconds_mean': {stage: round(sum(samples) / len(samples), 3) for stage, samples in stages.items()},
+        }
+    if {'moviepy', 'ffmpeg'} <= results.keys():
+        results['ffmpeg_speedup'] = round(results['moviepy']['wall_seconds_mean'] / results['ffmpeg']['wall_seconds_mean'], 2)
+    return results
+
+
+def configure_stubs(main, paths, server, workdir):
+    # Point the app at the synthetic workbooks, the stub LLM and the stub TTS and assets; everything it writes goes to workdir
+    main.EXCEL_PASSWORD = BENCHMARK_PASSWORD
+    main.INPUT_FILE_TRANSACTIONS, main.INPUT_FILE_PROFILE, main.INPUT_FILE_TWITTER = paths['transactions'], paths['profile'], paths['twitter']
+    main.DATA_SOURCES = [(paths['transactions'], 'transactions', True), (paths['profile'], 'profile', False), (paths['twitter'], 'twitter', False)]
+    main.OUTPUT_FILE = workdir / 'recommendations.txt'
+    main.SNAPSHOT_CACHE.cache_dir = workdir / 'snapshots'
+    os.makedirs(main.SNAPSHOT_CACHE.cache_dir, exist_ok=True)
+    main.openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    main.openai.api_key = 'fake'
+    main.pyttsx3.init = StubTTSEngine
+    main.TTS.cache_dir = workdir / 'tts'
+    main.BACKGROUND_ASSETS.cache_dir = workdir / 'backgrounds'
+    main.MUSIC_BED.cache_dir = workdir / 'music'
+    main.BACKGROUND_VIDEO_FILE, main.BACKGROUND_MUSIC_FILE = generate_stub_assets(main.ffmpeg_binary(), workdir)
+
+
+def benchmark_load_data(main, customer_ids):
+    main.DATA_STORE.invalidate()
+    started = time.perf_counter()
+    main.DATA_STORE.preload(main.DATA_SOURCES)  # Decrypt and parse every workbook, writing the snapshots
+    main.DATA_STORE.features(main.INPUT_FILE_TRANSACTIONS, main.INPUT_FILE_PROFILE, main.INPUT_FILE_TWITTER)  # As the server does at startup
+    cold = time.perf_counter() - started
+    main.DATA_STORE.invalidate()
+    started = time.perf_counter()
+    main.DATA_STORE.preload(main.DATA_SOURCES)
+    main.DATA_STORE.features(main.INPUT_FILE_TRANSACTIONS, main.INPUT_FILE_PROFILE, main.INPUT_FILE_TWITTER)
+    reload = time.perf_counter() - started
+
+    latencies = []
+    for customer_id in customer_ids:
+        started = time.perf_counter()
+        main.load_data(main.INPUT_FILE_TRANSACTIONS, main.INPUT_FILE_PROFILE, main.INPUT_FILE_TWITTER, customer_id)
+        latencies.append(time.perf_counter() - started)
+    return {
+        'cold_load_seconds': round(cold, 3),
+        ('snapshot_load_seconds' if main.SNAPSHOT_CACHE.enabled else 'reload_seconds'): round(reload, 3),
+        'lookup_seconds': main.summarize_timings(latencies),
+    }
+
+
+def benchmark_prompts(main, customer_ids):
+    latencies = []
+    for customer_id in customer_ids:
+        data = main.load_data(main.INPUT_FILE_TRANSACTIONS, main.INPUT_FILE_PROFILE, main.INPUT_FILE_TWITTER, customer_id)
+        started = time.perf_counter()
+        main.generate_user_prompt(customer_id, data)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    data, _ = main.load_batch_data(main.INPUT_FILE_TRANSACTIONS, main.INPUT_FILE_PROFILE, main.INPUT_FILE_TWITTER)
+    features = time.perf_counter() - started
+    started = time.perf_counter()
+    prompts = main.build_user_prompts(data)
+    built = time.perf_counter() - started
+    return {
+        'generate_user_prompt_seconds': main.summarize_timings(latencies),
+        'batch_features_seconds': round(features, 3),
+        'build_user_prompts_seconds': round(built, 3),
+        'prompts_per_second': round(len(prompts) / built, 1) if built else None,
+        'prompt_budget': main.PROMPT_BUDGET.stats(),
+    }
+
+
+def benchmark_recommendations(main, customer_ids, requests, concurrency):
+    system_prompt = main.DEFAULT_SYSTEM_PROMPT.replace("check_box_selection", "Consumer and Small Business Banking")
+
+    def timed_call(customer_id):
+        started = time.perf_counter()
+        result = main.generate_recommendations(system_prompt, customer_id, bypass_cache=True)
+        return time.perf_counter() - started, not result[0].startswith("Error")
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed_call, [customer_ids[i % len(customer_ids)] for i in range(requests)]))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'succeeded': sum(1 for _, ok in results if ok),
+        'latency_seconds': main.summarize_timings([latency for latency, _ in results]),
+        'requests_per_second': round(requests / elapsed, 2),
+    }
+
+
+def benchmark_startup(runs=3):
+    # Cold imports of main in fresh interpreters, with and without TEXT_ONLY, and the slowest direct
+    # imports as reported by -X importtime
+    summarize_timings = import_main().summarize_timings
+    probe = "import main, sys; print(','.join(name for name in ('moviepy.editor', 'pyttsx3', 'pytubefix') if name in sys.modules))"
+    results = {}
+    for mode, env in [('full', {}), ('text_only', {'TEXT_ONLY': 'true'})]:
+        seconds, direct = [], {}
+        for _ in range(runs):
+            completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', probe], cwd=SRC_DIR, env={**os.environ, **env},
+                                       capture_output=True, text=True, check=True)
+            for line in completed.stderr.splitlines():
+                if not line.startswith('import time:') or 'cumulative' in line:
+                    continue
+                _, cumulative, name = line.split('|')
+                depth = (len(name) - len(name.lstrip()) - 1) // 2
+                if depth == 0 and name.strip() == 'main':
+                    seconds.append(int(cumulative) / 1e6)
+                elif depth == 1:
+                    direct.setdefault(name.strip(), []).append(int(cumulative) / 1e6)
+        slowest = sorted(direct.items(), key=lambda item: -sum(item[1]) / len(item[1]))[:10]
+        results[mode] = {
+            'import_seconds': summarize_timings(seconds),
+            'slowest_imports': {name: round(sum(samples) / len(samples), 3) for name, samples in slowest},
+            'video_stack_loaded': [name for name in completed.stdout.strip().split(',') if name],
+        }
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SRC_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_suite(transactions, customers, seed=0, samples=50, requests=50, concurrency=4, latency_ms=300, video_runs=1, data_dir=BENCHMARK_DIR / 'data'):
+    started = time.perf_counter()
+    paths = generate_workbooks(transactions, customers, seed, data_dir)
+    workbook_seconds = time.perf_counter() - started
+
+    server = start_server(latency=latency_ms / 1000, jitter=0.0)
+    main = import_main()
+    main.logger.setLevel(logging.WARNING)  # Per-call INFO lines would swamp the output and the timings
+    workdir = Path(tempfile.mkdtemp(prefix='benchmark_'))
+    try:
+        configure_stubs(main, paths, server, workdir)
+        sample_ids = [f"CUST{i:07d}" for i in np.random.default_rng(seed).choice(customers, min(samples, customers), replace=False)]
+        results = {
+            'environment': {
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'pandas': pd.__version__,
+                'numpy': np.__version__,
+            },
+            'config': {
+                'transactions': transactions,
+                'customers': customers,
+                'seed': seed,
+                'samples': len(sample_ids),
+                'llm_latency_ms': latency_ms,
+                'llm_max_concurrency': main.LLM_MAX_CONCURRENCY,
+                'workbook_seconds': round(workbook_seconds, 3),  # Zero-ish when the workbooks were cached
+            },
+            'load_data': benchmark_load_data(main, sample_ids),
+            'prompts': benchmark_prompts(main, sample_ids),
+            'recommendations': benchmark_recommendations(main, sample_ids, requests, concurrency),
+            'startup': benchmark_startup(),
+        }
+        if video_runs:
+            results['video'] = benchmark_render(['moviepy'], video_runs, stub_tts=True)['moviepy']
+        return results
+    finally:
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def find_regressions(baseline, results, tolerance, path=()):
+    # Latencies (anything under a *_seconds key) that grew, and throughputs (*_per_second) that dropped,
+    # by more than tolerance relative to the baseline run
+    regressions = []
+    for key, old in baseline.items():
+        if key in ('environment', 'config', 'count') or key not in results:
+            continue
+        new = results[key]
+        name = path + (key,)
+        if isinstance(old, dict) and isinstance(new, dict):
+            regressions += find_regressions(old, new, tolerance, name)
+        elif isinstance(old, (int, float)) and isinstance(new, (int, float)) and not isinstance(old, bool) and old > 0:
+            if key.endswith('_per_second') and new < old * (1 - tolerance):
+                regressions.append(f"{'.'.join(name)}: {old} -> {new}")
+            elif any(part.endswith('_seconds') for part in name) and new > old * (1 + tolerance):
+                regressions.append(f"{'.'.join(name)}: {old} -> {new}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the recommendation pipeline.")
+    subparsers = parser.add_subparsers(dest='suite', required=True)
+    startup_parser = subparsers.add_parser('startup', help="Profile cold imports of main, full and text-only")
+    startup_parser.add_argument('--runs', type=int, default=3)
+    suite_parser = subparsers.add_parser('suite', help="Benchmark the whole pipeline on synthetic data and write JSON results")
+    suite_parser.add_argument('--transactions', type=int, default=10000, help=f"Transaction rows (max {EXCEL_MAX_DATA_ROWS})")
+    suite_parser.add_argument('--customers', type=int, help="Distinct customers (default: transactions / 10)")
+    suite_parser.add_argument('--seed', type=int, default=0)
+    suite_parser.add_argument('--samples', type=int, default=50, help="Customers used for the per-call measurements")
+    suite_parser.add_argument('--requests', type=int, default=50, help="generate_recommendations calls")
+    suite_parser.add_argument('--concurrency', type=int, default=4, help="Concurrent generate_recommendations callers")
+    suite_parser.add_argument('--latency-ms', type=float, default=300, help="Stub LLM latency")
+    suite_parser.add_argument('--video-runs', type=int, default=1, help="generate_video_with_moviepy runs; 0 skips the video benchmark")
+    suite_parser.add_argument('--data-dir', type=Path, default=BENCHMARK_DIR / 'data', help="Where generated workbooks are cached")
+    suite_parser.add_argument('--output', type=Path, help="Results file (default: artifacts/benchmarks/results_<timestamp>.json)")
+    suite_parser.add_argument('--baseline', type=Path, help="Earlier results file to check for regressions")
+    suite_parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative slowdown against the baseline")
+    render_parser = subparsers.add_parser('render', help="Compare video render backends")
+    render_parser.add_argument('--runs', type=int, default=3)
+    render_parser.add_argument('--backends', nargs='+', choices=['moviepy', 'ffmpeg'], default=['moviepy', 'ffmpeg'])
+    render_parser.add_argument('--stub-tts', action='store_true', help="Replace pyttsx3 with a generated tone")
+    args = parser.parse_args()
+
+    if args.suite == 'render':
+        print(json.dumps(benchmark_render(args.backends, args.runs, args.stub_tts), indent=2))
+        return
+    if args.suite == 'startup':
+        print(json.dumps(benchmark_startup(args.runs), indent=2))
+        return
+
+    results = benchmark_suite(args.transactions, args.customers or max(1, args.transactions // 10), args.seed, args.samples,
+                              args.requests, args.concurrency, args.latency_ms, args.video_runs, args.data_dir)
+    output = args.output or BENCHMARK_DIR / f"results_{datetime.now():%Y%m%d_%H%M%S}.json"
+    os.makedirs(output.parent, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Results written to {output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(json.load(f), results, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
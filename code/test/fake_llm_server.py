@@ -0,0 +1,180 @@
+"""Local stand-in for the OpenAI chat completions endpoint.
+
+Point the app at it to exercise the request pool offline, without API cost:
+
+    python code/test/fake_llm_server.py --port 8001 --latency-ms 800 --error-rate 0.05
+    OPENAI_API_BASE=http://127.0.0.1:8001/v1 OPENAI_API_KEY=fake python code/src/main.py --batch
+
+Or measure pool throughput (or time to first token with --stream) against an in-process stub:
+
+    python code/test/fake_llm_server.py --benchmark 200 --concurrency 8 --latency-ms 500 [--stream]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / 'src'
+
+CANNED_RECOMMENDATION = (
+    "Hello Customer, This message is from your Investment Advisor Jeremy Porter\n"
+    "Wellsfargo would like to recommend you few products\n\n"
+    "1. Wells Fargo Everyday Checking keeps your daily banking simple with mobile deposits and Zelle.\n\n"
+    "2. Wells Fargo Way2Save Savings builds your savings automatically with every purchase.\n\n"
+    "3. Wells Fargo Active Cash Card earns unlimited cash rewards on everything you buy."
+)
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.5
+    jitter = 0.1
+    error_rate = 0.0
+    token_interval = 0.01  # Delay between streamed chunks
+
+    def log_message(self, format, *args):
+        pass  # Keep benchmark output readable
+
+    def _send_json(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f"Unknown path {self.path}"}})
+            return
+        time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                self._send_json(429, {'error': {'message': "Rate limit reached (fake)", 'type': 'requests'}})
+            else:
+                self._send_json(500, {'error': {'message': "Internal error (fake)", 'type': 'server_error'}})
+            return
+
+        if request.get('stream'):
+            self._stream_completion(request)
+            return
+
+        prompt_tokens = sum(len(message.get('content', '')) // 4 for message in request.get('messages', []))
+        completion_tokens = len(CANNED_RECOMMENDATION) // 4
+        self._send_json(200, {
+            'id': f"chatcmpl-{uuid.uuid4().hex}",
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'fake'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': CANNED_RECOMMENDATION}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens},
+        })
+
+    def _stream_completion(self, request):
+        # Server-sent events in the chat.completion.chunk format; latency applies to the first chunk only
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        words = CANNED_RECOMMENDATION.split(' ')
+        for i, word in enumerate(words):
+            delta = {'role': 'assistant', 'content': word} if i == 0 else {'content': ' ' + word}
+            chunk = {
+                'id': completion_id,
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': request.get('model', 'fake'),
+                'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.token_interval)
+        chunk['choices'] = [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]
+        self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode('utf-8'))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+def start_server(port=0, latency=0.5, jitter=0.1, error_rate=0.0):
+    handler = type('ConfiguredFakeLLMHandler', (FakeLLMHandler,), {'latency': latency, 'jitter': jitter, 'error_rate': error_rate})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_benchmark(requests, server, stream=False):
+    # code/test/unittest.py would shadow the stdlib module, so import main with src first on the path
+    sys.path[0] = str(SRC_DIR)
+    import main
+
+    main.openai.api_base = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    main.openai.api_key = main.openai.api_key or 'fake'
+    user_prompt = "Generate a recommendation for Customer based on the following consented data:\nRecent transaction categories: Groceries"
+
+    messages = [{'role': 'system', 'content': main.DEFAULT_SYSTEM_PROMPT}, {'role': 'user', 'content': user_prompt}]
+
+    def timed_call():
+        started = time.perf_counter()
+        if not stream:
+            result = main.get_recommendation(main.DEFAULT_SYSTEM_PROMPT, user_prompt, bypass_cache=True, stream=False)
+            return time.perf_counter() - started, result != main.API_ERROR_RECOMMENDATION
+        first_token = None
+        for _ in main.LLM_POOL.stream(messages, max_tokens=main.RECOMMENDATION_MAX_TOKENS, temperature=main.RECOMMENDATION_TEMPERATURE):
+            first_token = first_token or time.perf_counter() - started
+        return first_token, first_token is not None
+
+    started = time.perf_counter()
+    results = [future.result() for future in [main.LLM_POOL.submit(timed_call) for _ in range(requests)]]
+    elapsed = time.perf_counter() - started
+    latencies = sorted(latency for latency, _ in results)
+    return {
+        'requests': requests,
+        'succeeded': sum(1 for _, ok in results if ok),
+        'concurrency': main.LLM_MAX_CONCURRENCY,
+        'wall_seconds': round(elapsed, 3),
+        'requests_per_second': round(requests / elapsed, 2),
+        'stream': stream,
+        'latency_p50': round(latencies[len(latencies) // 2], 3),
+        'latency_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server.")
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency-ms', type=float, default=500)
+    parser.add_argument('--jitter-ms', type=float, default=100)
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Fraction of calls answered with 429/500")
+    parser.add_argument('--benchmark', type=int, metavar='N', help="Send N requests through LLM_POOL and print throughput")
+    parser.add_argument('--concurrency', type=int, help="LLM_MAX_CONCURRENCY for the benchmark")
+    parser.add_argument('--stream', action='store_true', help="Benchmark streamed completions; latency is time to first token")
+    args = parser.parse_args()
+
+    if args.concurrency:
+        os.environ['LLM_MAX_CONCURRENCY'] = str(args.concurrency)
+    server = start_server(0 if args.benchmark else args.port, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate)
+    if args.benchmark:
+        print(json.dumps(run_benchmark(args.benchmark, server, args.stream), indent=2))
+        server.shutdown()
+        return
+
+    print(f"Fake LLM server listening on http://127.0.0.1:{server.server_address[1]}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
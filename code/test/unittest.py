@@ -1,8 +1,23 @@
 import unittest
 from unittest.mock import patch, MagicMock, mock_open
 import sys
-from code.src.main import app, generate_user_prompt, load_data
-from code.src.main import generate_all_recommendations_and_video
+from code.src.main import app, generate_user_prompt, load_data, generate_recommendations
+from code.src.main import generate_all_recommendations_and_video, CustomerDataStore, SnapshotCache, CustomerIndex
+from code.src.main import read_batch_checkpoint, LLMClientPool, RecommendationCache, get_recommendation, JOB_MANAGER, JobManager, event_room, SocketIOHandler
+from code.src.main import RenderFarm, CaptionRenderer, build_ffmpeg_command, MusicBed, TTSService, voiced_windows, align_words, caption_chunks
+from code.src.main import build_user_prompts, aggregate_customer_features, PromptBudget, Tracer, LazyImports, HealthMonitor
+from code.src.main import LogRecordFilter, LogQueueHandler, generate_video_with_moviepy, generate_video_with_ffmpeg, BackgroundAssetCache, prune_output_videos
+import numpy as np
+import openai
+import os
+import logging
+import queue
+import tempfile
+import threading
+import time
+import wave
+import pandas as pd
+from pathlib import Path
 
 # filepath: f:\code\aidhp-himalayas\code\src\test_main.py
 
@@ -20,17 +35,47 @@ class TestMain(unittest.TestCase):
 
     @patch("code.src.main.generate_recommendations")
     @patch("code.src.main.generate_video_with_moviepy")
+    @patch("code.src.main.RENDER_FARM.processes", 0)  # Render on the job thread so the mock sees the call
     def test_index_post(self, mock_generate_video, mock_generate_recommendations):
         mock_generate_recommendations.return_value = ["Test Recommendation"]
+        mock_generate_video.return_value = "/static/recommendations_video.mp4"
         response = self.app.post("/", data={
             "prompt": "Test Prompt",
             "customer_id": "12345",
             "categories": ["Consumer and Small Business Banking"]
         })
-        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.status_code, 202)
+        job_id = response.get_json()["job_id"]
+        self.assertTrue(JOB_MANAGER.wait(job_id, timeout=5))
         mock_generate_recommendations.assert_called_once()
         mock_generate_video.assert_called_once()
 
+        status = self.app.get(f"/jobs/{job_id}").get_json()
+        self.assertEqual(status["status"], "completed")
+        self.assertEqual(status["video_link"], "/static/recommendations_video.mp4")
+        self.assertEqual(self.app.get("/jobs/unknown").status_code, 404)
+
+    @patch("code.src.main.generate_recommendations")
+    def test_index_post_with_unknown_sid(self, mock_generate_recommendations):
+        mock_generate_recommendations.return_value = ["Error: no data"]
+        response = self.app.post("/", data={"prompt": "Test Prompt", "customer_id": "12345", "sid": "undefined"})
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(JOB_MANAGER.wait(response.get_json()["job_id"], timeout=5))
+        job = JOB_MANAGER.submit("Test Prompt", "12345", session_id="stale-sid")  # Disconnected after the route checked it
+        self.assertTrue(JOB_MANAGER.wait(job.job_id, timeout=5))
+
+    @patch("code.src.main.generate_recommendations")
+    def test_job_history_keeps_unfinished_jobs(self, mock_generate_recommendations):
+        release = threading.Event()
+        mock_generate_recommendations.side_effect = lambda *args, **kwargs: release.wait(5) and ["Error: no data"]
+        jobs = JobManager(text_workers=3, video_workers=1, history=2)
+        running = [jobs.submit("Test Prompt", str(i)) for i in range(3)]
+        self.assertTrue(all(jobs.get(job.job_id) is job for job in running))  # Over the cap rather than dropping live jobs
+        release.set()
+        self.assertTrue(all(jobs.wait(job.job_id, timeout=5) for job in running))
+        latest = jobs.submit("Test Prompt", "3")
+        self.assertEqual([jobs.get(job.job_id) for job in running + [latest]], [None, None, running[2], latest])
+
     @patch("code.src.main.generate_recommendations")
     @patch("code.src.main.generate_video_with_moviepy")
     @patch("builtins.input", return_value="12345")
@@ -63,5 +108,563 @@ class TestMain(unittest.TestCase):
         self.assertIn("John", prompt)
         self.assertIn("Shopping", prompt)
 
+    @patch("code.src.main.pd.read_excel")
+    @patch("code.src.main.decrypt_workbook")
+    def test_data_store_decrypts_once(self, mock_decrypt, mock_read_excel):
+        mock_read_excel.side_effect = lambda stream: pd.DataFrame({"Customer ID": [" 12345 ", "67890"], "Category": ["Shopping", "Travel"]})
+        with tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False) as f:
+            f.write(b"encrypted")
+        try:
+            store = CustomerDataStore()
+            first = store.get(f.name, "transactions", require_ids=True)
+            second = store.get(f.name, "transactions", require_ids=True)
+            self.assertIs(first, second)
+            self.assertEqual(first["customer id"].tolist(), ["12345", "67890"])
+            mock_decrypt.assert_called_once()
+
+            with open(f.name, "ab") as handle:
+                handle.write(b"changed")
+            store.get(f.name, "transactions", require_ids=True)
+            self.assertEqual(mock_decrypt.call_count, 2)
+
+            with patch("code.src.main.SNAPSHOT_COLUMNS", {"transactions": ["consent", "category"]}):
+                mock_read_excel.side_effect = lambda stream: pd.DataFrame({"Customer ID": ["1"], "Category": ["Fuel"], "Notes": ["unused"]})
+                store.invalidate()
+                with open(f.name, "ab") as handle:
+                    handle.write(b"again")
+                self.assertEqual(store.get(f.name, "transactions", require_ids=True).columns.tolist(), ["customer id", "category"])
+        finally:
+            os.remove(f.name)
+
+    @patch("code.src.main.EXCEL_PASSWORD", "secret")
+    def test_snapshot_cache_round_trip(self):
+        frame = pd.DataFrame({"customer id": ["12345"], "category": ["Shopping"], "consent": [True]})
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SnapshotCache(cache_dir)
+            cache.write("transactions", "abc123", frame)
+            with open(next(iter(os.scandir(cache_dir))).path, "rb") as f:
+                self.assertNotIn(b"Shopping", f.read())
+            restored = cache.read("transactions", "abc123", columns=["category", "not in this source"])
+            self.assertEqual(restored.columns.tolist(), ["customer id", "category"])
+            self.assertEqual(restored["category"].tolist(), ["Shopping"])
+            self.assertIsNone(cache.read("transactions", "other"))
+
+    def test_customer_index_row_ranges(self):
+        frame = pd.DataFrame({"customer id": ["2", "1", "2", "3", "1"], "category": ["a", "b", "c", "d", "e"]})
+        index = CustomerIndex(frame)
+        self.assertEqual(index.rows("2")["category"].tolist(), ["a", "c"])
+        self.assertEqual(index.rows("1")["category"].tolist(), ["b", "e"])
+        self.assertTrue(index.rows("missing").empty)
+        self.assertEqual(index.customer_ids, ["2", "1", "3"])
+
+    def test_batch_checkpoint_retries_errors(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+            f.write('{"customer_id": "1", "status": "ok"}\n')
+            f.write('{"customer_id": "2", "status": "error"}\n')
+            f.write('{"customer_id": "3", "status": "skipped"}\n')
+            f.write('{"customer_id": "4", "sta')
+        try:
+            self.assertEqual(read_batch_checkpoint(f.name), {"1", "3"})
+        finally:
+            os.remove(f.name)
+
+    @patch("code.src.main.time.sleep")
+    @patch("code.src.main.openai.ChatCompletion.create")
+    def test_llm_pool_retries_rate_limits(self, mock_create, mock_sleep):
+        mock_create.side_effect = [openai.error.RateLimitError("slow down"), {"choices": []}]
+        pool = LLMClientPool(2, 600, 100000, timeout=5, max_retries=3)
+        response = pool.complete([{"role": "user", "content": "hi"}], max_tokens=10, temperature=0)
+        self.assertEqual(response, {"choices": []})
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(mock_create.call_args.kwargs["request_timeout"], 5)
+
+        mock_create.side_effect = openai.error.InvalidRequestError("bad prompt", None)
+        with self.assertRaises(openai.error.InvalidRequestError):
+            pool.complete([{"role": "user", "content": "hi"}], max_tokens=10, temperature=0)
+
+    def test_recommendation_cache_tiers(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            db_path = os.path.join(cache_dir, "cache.sqlite")
+            key = RecommendationCache.fingerprint("gpt-4o-mini", "system", "user", 0.7, 250)
+            cache = RecommendationCache(max_entries=1, ttl=60, db_path=db_path)
+            self.assertIsNone(cache.get(key))
+            cache.put(key, "Recommendation", latency=2.5, tokens=400)
+            self.assertEqual(cache.get(key), "Recommendation")
+
+            reopened = RecommendationCache(max_entries=1, ttl=60, db_path=db_path)
+            self.assertEqual(reopened.get(key), "Recommendation")
+            stats = reopened.stats()
+            self.assertEqual(stats["disk_hits"], 1)
+            self.assertEqual(stats["saved_tokens"], 400)
+
+            expired = RecommendationCache(max_entries=1, ttl=-1, db_path=db_path)
+            self.assertIsNone(expired.get(key))
+        self.assertNotEqual(key, RecommendationCache.fingerprint("gpt-4o-mini", "system", "user", 0.2, 250))
+
+    @patch("code.src.main.socketio.emit")
+    @patch("code.src.main.openai.ChatCompletion.create")
+    def test_get_recommendation_streams_tokens(self, mock_create, mock_emit):
+        pieces = [("Hello", None), (" John", None), ("", "stop")]
+        mock_create.return_value = iter([MagicMock(choices=[MagicMock(delta={"content": piece}, finish_reason=reason)]) for piece, reason in pieces])
+        cache = RecommendationCache(max_entries=4, ttl=60)
+        with patch("code.src.main.LLM_CACHE", cache), event_room("session-1"):
+            recommendation = get_recommendation("system", "user prompt", stream=True)
+        self.assertEqual(recommendation, "Hello John")
+        self.assertEqual(cache.stats()["stores"], 1)
+        self.assertTrue(all(call.kwargs["to"] == "session-1" for call in mock_emit.call_args_list))
+        self.assertTrue(mock_create.call_args.kwargs["stream"])
+        deltas = "".join(call.args[1]["delta"] for call in mock_emit.call_args_list if call.args[0] == "recommendation_token")
+        self.assertEqual(deltas, "Hello John")
+
+    @patch("code.src.main.socketio.emit")
+    @patch("code.src.main.openai.ChatCompletion.create")
+    def test_truncated_stream_is_not_cached(self, mock_create, mock_emit):
+        cache = RecommendationCache(max_entries=4, ttl=60)
+        with patch("code.src.main.LLM_CACHE", cache):
+            for pieces in ([("Hello", None), (" Jo", None)], [("Hello", None), ("", "length")], [("", "stop")]):
+                mock_create.return_value = iter([MagicMock(choices=[MagicMock(delta={"content": piece}, finish_reason=reason)]) for piece, reason in pieces])
+                get_recommendation("system", "user prompt", stream=True)
+        self.assertEqual(cache.stats()["stores"], 0)
+        self.assertEqual(cache.stats()["memory_entries"], 0)
+
+    @patch("code.src.main.socketio.emit")
+    @patch("code.src.main.openai.ChatCompletion.create")
+    def test_truncated_completion_is_not_cached(self, mock_create, mock_emit):
+        cache = RecommendationCache(max_entries=4, ttl=60)
+        with patch("code.src.main.LLM_CACHE", cache):
+            for content, reason in (("Hello Jo", "length"), ("", "stop"), ("Hello John", "stop")):
+                mock_create.return_value = openai.util.convert_to_openai_object({
+                    "choices": [{"message": {"role": "assistant", "content": content}, "finish_reason": reason}],
+                    "usage": {"total_tokens": 12},
+                })
+                self.assertEqual(get_recommendation("system", f"user prompt {reason} {content}", stream=False), content)
+        self.assertEqual(cache.stats()["stores"], 1)
+
+    @patch("code.src.main.LLM_CACHE", RecommendationCache(max_entries=4, ttl=60))
+    @patch("code.src.main.socketio.emit")
+    @patch("code.src.main.openai.ChatCompletion.create")
+    def test_recommendation_text_is_only_logged_at_debug(self, mock_create, mock_emit):
+        mock_create.return_value = openai.util.convert_to_openai_object({
+            "choices": [{"message": {"role": "assistant", "content": "Private advice for John"}, "finish_reason": "stop"}],
+        })
+        with self.assertLogs("code.src.main", level="DEBUG") as logs:
+            get_recommendation("system", "user prompt", stream=False)
+        levels = {record.levelno for record in logs.records if "Private advice" in record.getMessage()}
+        self.assertEqual(levels, {logging.DEBUG})
+
+    @patch("code.src.main.socketio.emit")
+    def test_log_forwarding_is_scoped_and_batched(self, mock_emit):
+        handler = SocketIOHandler(flush_interval=60, buffer_size=2)
+        handler._flusher = object()  # Flush manually instead of from the background task
+        logger = logging.getLogger("test_log_forwarding")
+        logger.setLevel(logging.INFO)
+        logger.addHandler(handler)
+        try:
+            logger.info("outside any room")
+            with event_room("job-1"):
+                for i in range(3):
+                    logger.info(f"step {i}")
+            handler.flush()
+        finally:
+            logger.removeHandler(handler)
+        mock_emit.assert_called_once_with("log", {"message": "step 2", "messages": ["step 1", "step 2"], "dropped": 1}, to="job-1")
+
+    def test_log_records_are_stamped_capped_sampled_and_never_block(self):
+        handler = LogQueueHandler(queue.Queue(2))
+        handler.addFilter(LogRecordFilter(max_chars=10, sample_every=3))
+        logger = logging.getLogger("test_log_queue")
+        logger.setLevel(logging.DEBUG)
+        logger.propagate = False
+        logger.addHandler(handler)
+        try:
+            with event_room("job-1"):
+                logger.info("%s", "x" * 25)
+            for i in range(4):
+                logger.debug(f"payload {i}")  # Same call site: only the 1st and 4th are kept
+        finally:
+            logger.removeHandler(handler)
+        first = handler.queue.get_nowait()
+        self.assertEqual(first.room, "job-1")
+        self.assertEqual(first.getMessage(), "xxxxxxxxxx... [15 characters truncated]")
+        self.assertEqual(handler.queue.get_nowait().getMessage(), "payload 0")
+        self.assertEqual(handler.stats(), {"queued": 0, "dropped": 1, "truncated": 1, "sampled_out": 2})
+
+    @patch("code.src.main.generate_video_with_moviepy")
+    def test_render_farm_backpressure_and_report(self, mock_generate_video):
+        farm = RenderFarm(processes=0, queue_size=1, timeout=5, retries=0)
+        release = threading.Event()
+
+        def slow_render(text, job_id=None, timings=None):
+            release.wait(5)
+            timings["encode"] = 0.5
+            return f"/static/videos/{job_id}.mp4"
+
+        mock_generate_video.side_effect = slow_render
+        first = farm.submit("Recommendation", "job-1")
+        with self.assertRaises(queue.Full):
+            farm.submit("Recommendation", "job-2", block=False)
+        time.sleep(0.05)
+        self.assertEqual(farm.report()["active"], 1)
+        self.assertGreater(farm.report()["utilization"], 0.5)  # Busy since it was submitted
+        release.set()
+        self.assertEqual(first.result(timeout=5), "/static/videos/job-1.mp4")
+        report = farm.report()
+        self.assertEqual((report["completed"], report["active"]), (1, 0))
+        self.assertEqual(report["stage_seconds"]["encode"]["count"], 1)
+
+        farm.report_window = 0.05
+        time.sleep(0.1)
+        report = farm.report()  # Only the last report_window seconds count, and nothing ran in them
+        self.assertEqual((report["videos_per_minute"], report["utilization"]), (0.0, 0.0))
+
+    @patch("code.src.main.BACKGROUND_ASSETS.proxy_path", side_effect=OSError("download failed"))
+    @patch("code.src.main.generate_video_with_moviepy", return_value="/static/videos/job.mp4")
+    def test_render_farm_counts_background_failures_and_bounds_stage_samples(self, mock_generate_video, mock_proxy_path):
+        farm = RenderFarm(processes=1, queue_size=2, timeout=5, retries=1)
+        with self.assertRaises(RuntimeError):
+            farm.render("Recommendation", "job-1")
+        report = farm.report()
+        self.assertEqual((report["failed"], report["retried"], mock_proxy_path.call_count), (1, 1, 2))
+
+        farm = RenderFarm(processes=0, queue_size=2, timeout=5, retries=0, window=2)
+        for i in range(3):
+            farm.render("Recommendation", f"job-{i}")
+        self.assertEqual(farm.report()["stage_seconds"]["total"]["count"], 2)
+
+    def test_unavailable_video_leaves_no_workspace(self):
+        with tempfile.TemporaryDirectory() as tmp, patch("code.src.main.TEMP_DIR", Path(tmp)), \
+                patch("code.src.main.HEALTH.require", side_effect=FileNotFoundError("Background music file not found.")):
+            for render in (generate_video_with_moviepy, generate_video_with_ffmpeg):
+                with self.assertRaises(FileNotFoundError):
+                    render("Recommendation", job_id="job-1")
+            self.assertEqual(os.listdir(tmp), [])
+
+    @patch("code.src.main.mpy")
+    @patch("code.src.main.download_youtube_video")
+    @patch("code.src.main.subprocess.run")
+    def test_background_cache_replaces_truncated_files(self, mock_run, mock_download, mock_mpy):
+        mock_run.return_value = MagicMock(returncode=1, stderr="moov atom not found")
+        mock_download.side_effect = lambda url, path: Path(path).write_bytes(b"\0" * 4096)
+        mock_mpy.VideoFileClip.return_value.without_audio.return_value.resize.return_value.write_videofile.side_effect = \
+            lambda path, **kwargs: Path(path).write_bytes(b"\0" * 4096)
+        with tempfile.TemporaryDirectory() as tmp:
+            assets = BackgroundAssetCache(tmp, (640, 360), 24)
+            key = assets._source_key("https://example.com/clip")
+            (Path(tmp) / f"{key}_source.mp4").write_bytes(b"\0" * 100)  # Left behind by an interrupted download
+            (Path(tmp) / f"{key}_640x360_24fps.mp4").write_bytes(b"\0" * 4096)  # Unreadable proxy
+            proxy = assets.proxy_path("https://example.com/clip")
+            self.assertEqual(mock_download.call_count, 1)
+            self.assertEqual(sorted(os.listdir(tmp)), sorted([proxy.name, f"{key}_source.mp4"]))
+            mock_run.return_value = MagicMock(returncode=0, stderr="")
+            mock_run.reset_mock()
+            for _ in range(3):
+                self.assertEqual(assets.proxy_path("https://example.com/clip"), proxy)
+            self.assertEqual(mock_run.call_count, 1)
+
+    def test_old_videos_are_pruned_but_batch_videos_kept(self):
+        with tempfile.TemporaryDirectory() as tmp, patch("code.src.main.VIDEO_OUTPUT_DIR", Path(tmp)):
+            now = time.time()
+            for i, name in enumerate(["a.mp4", "b.mp4", "c.mp4", "batch-1.mp4", "old.mp4", "latest.mp4"]):
+                path = os.path.join(tmp, name)
+                Path(path).write_bytes(b"")
+                age = 30 * 24 * 3600 if name == "old.mp4" else 60 * (10 - i)
+                os.utime(path, (now - age, now - age))
+            removed = prune_output_videos(keep=Path(tmp) / "latest.mp4", max_files=3, max_age=7 * 24 * 3600)
+            self.assertEqual(removed, 2)
+            self.assertEqual(sorted(os.listdir(tmp)), ["b.mp4", "batch-1.mp4", "c.mp4", "latest.mp4"])
+
+    def test_caption_sprites_are_cached(self):
+        captions = CaptionRenderer(max_entries=2)
+        sprite = captions.sprite("Hello Customer", font="Arial-Bold", fontsize=30, color="red", size=(1280, 70))
+        self.assertEqual(sprite.shape, (70, 1280, 4))
+        self.assertEqual(sprite[0, 0, 3], 0)  # Transparent outside the text
+        self.assertGreater(sprite[:, :, 3].max(), 0)
+        self.assertIs(captions.sprite("Hello Customer", font="Arial-Bold", fontsize=30, color="red", size=(1280, 70)), sprite)
+        captions.sprite("Line 2", font="Arial-Bold", fontsize=30, color="red", size=(1280, 70))
+        captions.sprite("Line 3", font="Arial-Bold", fontsize=30, color="red", size=(1280, 70))
+        self.assertEqual((captions.hits, captions.misses, len(captions._sprites)), (1, 3, 2))
+
+    def test_ffmpeg_command_times_captions(self):
+        captions = [("caption_0.png", 0.0, 2.5), ("caption_1.png", 2.5, 1.25)]
+        command = build_ffmpeg_command("bg.mp4", "mix.m4a", captions, "watermark.png", 3.75, "out.mp4")
+        graph = command[command.index("-filter_complex") + 1]
+        self.assertEqual(command[command.index("-stream_loop") + 1], "-1")
+        self.assertIn("[0:v][3:v]overlay=0:360:enable='between(t,0.000,2.500)'[v0]", graph)
+        self.assertIn("[v0][4:v]overlay=0:360:enable='between(t,2.500,3.750)'[v1]", graph)
+        self.assertIn("[v1][2:v]overlay=0:670", graph)
+        self.assertEqual(command[command.index("-c:a") + 1], "copy")  # Premixed by MusicBed
+        self.assertEqual(command[command.index("-t") + 1], "3.750")
+
+    @patch("code.src.main.decode_pcm")
+    @patch("code.src.main.subprocess.run")
+    def test_music_bed_decodes_once_and_mixes_under_narration(self, mock_run, mock_decode):
+        mock_decode.return_value = np.full((6, 2), 0.5, dtype=np.float32)
+        mock_run.return_value = MagicMock(returncode=0)
+        with tempfile.TemporaryDirectory() as tmp:
+            music = os.path.join(tmp, "music.mp3")
+            with open(music, "wb") as f:
+                f.write(b"ID3")
+            narration = os.path.join(tmp, "narration.wav")
+            with wave.open(narration, "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(1000)
+                f.writeframes(np.array([8192] * 8, dtype="<i2").tobytes())
+            bed = MusicBed(os.path.join(tmp, "beds"), gain=0.5)
+            self.assertAlmostEqual(bed.mix(narration, music, os.path.join(tmp, "a.m4a")), 0.008)
+            bed.mix(narration, music, os.path.join(tmp, "b.m4a"))
+            self.assertEqual(MusicBed(os.path.join(tmp, "beds"), gain=0.5).bed(music, 1000).shape, (6, 2))  # Another process loads the cached bed
+        mock_decode.assert_called_once_with(music, 1000, 2)
+        pcm = np.frombuffer(mock_run.call_args.kwargs["input"], dtype="<i2").reshape(-1, 2)
+        np.testing.assert_array_equal(pcm[:, 0], [16384] * 6 + [8192] * 2)  # 0.25 music + 0.25 narration, then narration only
+
+    @patch("code.src.main.pyttsx3.init")
+    def test_tts_reuses_engine_and_cached_lines(self, mock_init):
+        def save_to_file(text, path):
+            with wave.open(path, "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(2)
+                f.setframerate(1000)
+                f.writeframes(b"\x01\x00" * 100 * len(text.split()))
+
+        mock_init.return_value.save_to_file.side_effect = save_to_file
+        with tempfile.TemporaryDirectory() as tmp:
+            tts = TTSService(tmp, rate=140, pause=0.5)
+            greeting = "Wellsfargo would like to recommend you few products"
+            tts.synthesize(f"Hello Ann\n{greeting}", os.path.join(tmp, "a.wav"))
+            audio_duration, word_times = tts.synthesize(f"Hello Bob\n{greeting}", os.path.join(tmp, "b.wav"))
+            self.assertAlmostEqual(audio_duration, 1.5)
+            self.assertEqual([word for word, _, _ in word_times], ["Hello", "Bob"] + greeting.split())
+            self.assertAlmostEqual(word_times[1][1], 0.12)  # Timed by length within the line
+            self.assertAlmostEqual(word_times[2][1], 0.7)  # Second line starts after the pause
+            with wave.open(os.path.join(tmp, "b.wav"), "rb") as f:
+                self.assertEqual(f.getnframes(), 200 + 500 + 800)
+        mock_init.assert_called_once()
+        self.assertEqual(mock_init.return_value.save_to_file.call_count, 3)  # Greeting synthesized once
+        self.assertEqual((tts.hits, tts.misses), (1, 3))
+
+    @patch("code.src.main.pyttsx3.init")
+    def test_tts_pause_is_silent_for_unsigned_8_bit_audio(self, mock_init):
+        def save_to_file(text, path):
+            with wave.open(path, "wb") as f:
+                f.setnchannels(1)
+                f.setsampwidth(1)
+                f.setframerate(1000)
+                f.writeframes(b"\xc0\x40" * 50)
+
+        mock_init.return_value.save_to_file.side_effect = save_to_file
+        with tempfile.TemporaryDirectory() as tmp:
+            TTSService(tmp, rate=140, pause=0.5).synthesize("Hello Ann\nSecond line", os.path.join(tmp, "a.wav"))
+            with wave.open(os.path.join(tmp, "a.wav"), "rb") as f:
+                frames = f.readframes(f.getnframes())
+        self.assertEqual(frames[100:600], b"\x80" * 500)
+
+    def test_captions_follow_speech_not_word_count(self):
+        # 0.5 s of silence, "one two" spoken over 1 s, a 1 s pause, then "three four" over 1 s
+        tone = np.full(1000, 5000, dtype="<i2")
+        silence = np.zeros(1000, dtype="<i2")
+        pcm = np.concatenate([silence[:500], tone, silence, tone]).tobytes()
+        voiced, window = voiced_windows(pcm, sample_width=2, channels=1, frame_rate=1000)
+        word_times = align_words(["one", "two.", "three", "four"], voiced, window)
+        self.assertAlmostEqual(word_times[0][1], 0.5)
+        self.assertAlmostEqual(word_times[2][1], 2.5)  # Pinned to the second stretch of speech
+        chunks = caption_chunks("one two. three four", 3.5, word_times)
+        self.assertEqual([(text, round(start, 2)) for text, start, _ in chunks], [("one two", 0.0), ("three four", 2.5)])
+        self.assertAlmostEqual(sum(duration for _, _, duration in chunks), 3.5)
+
+    def test_build_user_prompts_matches_generate_user_prompt(self):
+        data = CustomerIndex(pd.DataFrame({
+            "customer id": ["1", "2", "1", "3", "1", "1", "1", "1"],
+            "category": ["Groceries", "Travel", "Dining", "Fuel", None, "Rent", "Travel", "Books"],
+            "transaction amount": [10.0, 20.0, 30.0, 5.0, 1.0, 900.0, 40.0, 15.0],
+            "first name_trans": [" ", "Bob", " ", None, " ", " ", " ", " "],
+            "first name_profile": ["Ann", None, "Ann", None, "Ann", "Ann", "Ann", "Ann"],
+            "consent": [True, True, True, False, True, True, True, True],
+            "consent_social_media": [True, False, True, True, True, True, True, True],
+            "sentiment": ["positive", "negative", "positive", None, "positive", "positive", "positive", "positive"],
+            "tweet": ["Love it", "Meh", "Love it", None, "Love it", "Love it", "Love it", "Love it"],
+        }))
+        prompts = build_user_prompts(data, ["1", "2", "3", "4"])
+        for customer_id in ["1", "2", "3", "4"]:
+            self.assertEqual(prompts[customer_id], generate_user_prompt(customer_id, data))
+        self.assertIn("Recent transaction categories: Dining, nan, Rent, Travel, Books.", prompts["1"])
+
+    def test_features_are_one_row_per_customer(self):
+        transactions = pd.DataFrame({
+            "customer id": ["1", "1", "1", "2"],
+            "category": ["Groceries", "Travel", "Groceries", "Fuel"],
+            "transaction amount": [10.0, 200.0, 15.5, 40.0],
+            "consent": [True, True, True, True],
+            "consent_social_media": [True, True, True, False],
+        })
+        profile = pd.DataFrame({"customer id": ["1", "2"], "first name": ["Ann", "Bob"], "age": [34, 51]})
+        twitter = pd.DataFrame({"customer id": ["1", "1"], "sentiment": ["negative", "positive"], "tweet": ["old", "latest"]})
+        features = aggregate_customer_features(transactions, profile, twitter).set_index("customer id")
+        self.assertEqual(len(features), 2)  # Not 3 x 2 + 1 rows
+        self.assertEqual(features.loc["1", "recent categories"], "Groceries, Travel, Groceries")
+        self.assertEqual(features.loc["1", "spend by category"], "Groceries: 25.50, Travel: 200.00")
+        self.assertEqual(features.loc["1", "transaction count"], 3)
+        self.assertEqual(features.loc["1", "tweet"], "latest")
+        self.assertEqual(features.loc["2", "first name"], "Bob")
+        self.assertFalse(features.loc["2", "consent_social_media"])
+
+    @patch("code.src.main.aggregate_customer_features", wraps=aggregate_customer_features)
+    def test_features_are_aggregated_once_per_source_version(self, mock_aggregate):
+        sources = {
+            "transactions": CustomerIndex(pd.DataFrame({"customer id": ["1", "2"], "category": ["Fuel", "Rent"], "transaction amount": [40.0, 900.0], "consent": [True, True]})),
+            "profile": CustomerIndex(pd.DataFrame({"customer id": ["1"], "age": [34]})),
+            "twitter": CustomerIndex(pd.DataFrame({"customer id": ["1"], "sentiment": ["positive"], "tweet": ["ok"]})),
+        }
+        store = CustomerDataStore()
+        with patch.object(store, "index", side_effect=lambda file_path, label, require_ids=False: sources[label]):
+            features = store.features("t.xlsx", "p.xlsx", "w.xlsx")
+            self.assertIs(store.features("t.xlsx", "p.xlsx", "w.xlsx"), features)
+            self.assertEqual(mock_aggregate.call_count, 1)
+            self.assertEqual(str(features.rows("1")["age"].iloc[0]), "34")  # Not 34.0 although customer 2 has no profile
+            sources["profile"] = CustomerIndex(pd.DataFrame({"customer id": ["1", "2"], "age": [34, 51]}))  # Reloaded file
+            self.assertEqual(store.features("t.xlsx", "p.xlsx", "w.xlsx").rows("2")["age"].iloc[0], 51)
+            self.assertEqual(mock_aggregate.call_count, 2)
+
+    @patch("code.src.main.get_recommendation", side_effect=lambda system_prompt, user_prompt, bypass_cache=False: user_prompt)
+    def test_unknown_customer_has_no_data(self, mock_get_recommendation):
+        sources = {
+            "transactions": CustomerIndex(pd.DataFrame({"customer id": ["1"], "category": ["Fuel"], "transaction amount": [40.0], "consent": [True]})),
+            "profile": CustomerIndex(pd.DataFrame({"customer id": ["1"], "age": [34]})),
+            "twitter": CustomerIndex(pd.DataFrame({"customer id": ["1"], "sentiment": ["positive"], "tweet": ["ok"]})),
+        }
+        with tempfile.TemporaryDirectory() as tmp, patch("code.src.main.HEALTH.require"), patch("code.src.main.OUTPUT_FILE", os.path.join(tmp, "out.txt")), \
+                patch("code.src.main.DATA_STORE.index", side_effect=lambda file_path, label, require_ids=False: sources[label]):
+            self.assertEqual(generate_recommendations("system", "999"), ["No data found for Customer ID 999"])
+
+    def test_prompt_budget_loads_encoding_once_with_a_timeout(self):
+        release = threading.Event()
+        mock_tiktoken = MagicMock()
+        mock_tiktoken.encoding_for_model.side_effect = lambda model: release.wait(5)  # A download that hangs
+        budget = PromptBudget(80, ["*"], tweet_max_tokens=5, model="gpt-3.5-turbo")
+        with patch("code.src.main.tiktoken", mock_tiktoken), patch.dict(os.environ, {"TIKTOKEN_CACHE_DIR": ""}):
+            self.assertEqual(budget.stats()["tokenizer"], "not loaded")  # stats() does not trigger the load
+            mock_tiktoken.encoding_for_model.assert_not_called()
+            self.assertIsNone(budget.load_encoding(timeout=0.05))
+            self.assertEqual(budget.count_one("abcdefgh"), 2)  # Length estimate, without another attempt
+            self.assertEqual(mock_tiktoken.encoding_for_model.call_count, 1)
+        release.set()
+
+        missing_cache = PromptBudget(80, ["*"], tweet_max_tokens=5, model="gpt-3.5-turbo")
+        with patch("code.src.main.tiktoken", mock_tiktoken), patch.dict(os.environ, {"TIKTOKEN_CACHE_DIR": "/nonexistent/tiktoken"}):
+            self.assertIsNone(missing_cache.encoding())
+            self.assertEqual(missing_cache.stats()["tokenizer"], "estimate")
+        self.assertEqual(mock_tiktoken.encoding_for_model.call_count, 1)
+
+    def test_prompt_budget_dedupes_truncates_and_drops_low_priority_fields(self):
+        budget = PromptBudget(80, ["age", "income", "*"], tweet_max_tokens=5, model="gpt-3.5-turbo")
+        budget._encoding_loaded = True  # Use the length estimate so the test does not depend on tiktoken downloads
+        details = pd.DataFrame({
+            "city_trans": ["Austin"], "city_profile": ["Austin"], "income": [90000], "age": [34],
+            "notes": ["x" * 200], "blank": [None], "consent_social_media": [True],
+            "sentiment": ["positive"], "tweet": ["word " * 40],
+        }, index=pd.Index(["1"], name="customer id"))
+        prompts, used, saved = budget.render(pd.Series(["Ann"], index=details.index), pd.Series(["Travel"], index=details.index), details)
+        prompt = prompts.loc["1"]
+        self.assertIn("Customer details: age: 34, income: 90000, city: Austin", prompt)
+        self.assertNotIn("city_trans", prompt)
+        self.assertNotIn("notes", prompt)  # Over budget
+        self.assertNotIn("blank", prompt)
+        self.assertIn("based on tweet: word word word word...", prompt)
+        self.assertLessEqual(used[0], 80)
+        self.assertGreater(saved[0], 0)
+        self.assertEqual(budget.stats()["tokens_saved"], saved[0])
+        single = budget.render_one("Ann", "Travel", dict(zip(details.columns, details.iloc[0].tolist())))
+        self.assertEqual(single, (prompt, used[0], saved[0]))  # One customer renders exactly as in a batch
+
+    @patch("code.src.main.time.perf_counter")
+    def test_tracer_quantiles_and_folded_dump(self, mock_clock):
+        mock_clock.side_effect = [0.0, 1.0, 3.0, 4.0, 10.0, 12.0, 20.0, 21.0]
+        with tempfile.TemporaryDirectory() as dump_dir:
+            tracer = Tracer(window=100, dump_dir=dump_dir)
+            with tracer.span("recommendation_stage", trace_id="job-1"):  # 0 -> 12
+                with tracer.span("load_data"):  # 1 -> 3
+                    pass
+                with tracer.span("render") as render:  # 4 -> 10
+                    tracer.add_timings({"tts": 2.5, "encode": 3.0, "total": 5.5}, render)
+            with tracer.span("load_data"):  # Outside any trace: histogram only
+                pass
+            with open(os.path.join(dump_dir, "job-1.folded")) as f:
+                folded = dict(line.rsplit(" ", 1) for line in f.read().splitlines())
+        self.assertEqual(folded, {
+            "recommendation_stage;load_data": "2000000",
+            "recommendation_stage;render;tts": "2500000",
+            "recommendation_stage;render;encode": "3000000",
+            "recommendation_stage;render": "500000",
+            "recommendation_stage": "4000000",
+        })
+        snapshot = tracer.snapshot()
+        self.assertEqual(snapshot["load_data"]["count"], 2)
+        self.assertEqual(snapshot["load_data"]["p99"], 2.0)
+        self.assertNotIn("total", snapshot)
+        self.assertIn('aidhp_stage_seconds{stage="tts",quantile="0.95"} 2.5', tracer.prometheus())
+
+    def test_metrics_endpoint(self):
+        response = self.app.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"# TYPE aidhp_stage_seconds summary", response.data)
+        self.assertIn(b"aidhp_llm_cache_misses", response.data)
+
+    def test_lazy_imports_load_on_first_use(self):
+        sys.modules.pop("colorsys", None)
+        registry = LazyImports()
+        colorsys = registry.module("colorsys", "video")
+        self.assertTrue(colorsys)  # Installed, checked without importing it
+        self.assertNotIn("colorsys", sys.modules)
+        self.assertEqual(colorsys.rgb_to_hsv(1.0, 0.0, 0.0), (0.0, 1.0, 1.0))
+        self.assertIn("colorsys", registry.load_times)
+        with patch.object(colorsys, "ONE_THIRD", 0.5):
+            self.assertEqual(sys.modules["colorsys"].ONE_THIRD, 0.5)
+        self.assertAlmostEqual(colorsys.ONE_THIRD, 1.0 / 3.0)
+
+        registry.disable("tts")
+        self.assertFalse(registry.module("not_an_installed_module", "tts"))
+        with self.assertRaises(ImportError):
+            registry.module("json.tool", "tts").main
+
+    def test_text_only_health_without_the_video_stack(self):
+        registry = LazyImports()
+        missing = registry.module("not_installed_moviepy.editor", "video")
+        self.assertFalse(missing)  # The parent package is missing too
+        self.assertFalse(registry.module("json.not_a_submodule", "video"))
+        self.assertTrue(registry.module("email.mime.text", "video"))
+        monitor = HealthMonitor(check_interval=300, watch_interval=0)
+        with patch("code.src.main.TEXT_ONLY", True), patch("code.src.main.mpy", missing), patch("code.src.main.Image", missing), \
+                patch("code.src.main.pyttsx3", missing), patch("code.src.main.pytubefix", missing), patch("code.src.main.HEALTH", monitor):
+            self.assertFalse(monitor.has("video"))
+            response = self.app.get("/readyz")
+        self.assertEqual(response.get_json()["problems"]["video"], "Video is disabled in text-only mode.")
+
+    def test_health_monitor_caches_capabilities_and_readiness(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            music = os.path.join(tmp, "music.mp3")
+            monitor = HealthMonitor(check_interval=300, watch_interval=0)
+            with patch("code.src.main.BACKGROUND_MUSIC_FILE", music), patch("code.src.main.EXCEL_PASSWORD", "secret"), patch.object(openai, "api_key", "key"):
+                self.assertFalse(monitor.has("video"))
+                self.assertTrue(monitor.has("text"))
+                with self.assertRaises(FileNotFoundError):
+                    monitor.require("video")
+                with open(music, "wb") as f:
+                    f.write(b"ID3")
+                self.assertFalse(monitor.has("video"))  # Cached until revalidated
+                monitor.validate()
+                monitor.require("video")
+
+        fresh = HealthMonitor(check_interval=300, watch_interval=0)  # Never validated, e.g. HEALTH_WATCH_INTERVAL=0
+        with patch("code.src.main.HEALTH", fresh), patch("code.src.main.EXCEL_PASSWORD", "secret"), patch.object(openai, "api_key", "key"):
+            self.assertEqual(self.app.get("/readyz").status_code, 200)
+
+        with patch("code.src.main.HEALTH", monitor):
+            self.assertEqual(self.app.get("/healthz").status_code, 200)
+            self.assertEqual(self.app.get("/readyz").status_code, 200)
+            monitor.capabilities = frozenset()
+            response = self.app.get("/readyz")
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.get_json()["mode"], "unavailable")
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file